@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the decoding of the rows of full AlumnForce exports
+
+Compare AlumnForceDataC2J.decode_csv_row, which follows a plan compiled from the
+header, with the previous implementation, which split the dotted name of every
+cell and walked nested OrderedDicts.
+
+Usage: python -m benchmarks.bench_converters [number of rows]
+"""
+
+import collections
+import json
+import random
+import sys
+import timeit
+
+from xorgdata.alumnforce.full_export.lib import csv_format
+from xorgdata.alumnforce.full_export.lib.converters import AlumnForceDataC2J
+
+
+def legacy_decode_csv_row(fields, csv_row, keep_empty):
+    """Decode a row of a CSV file like the previous implementation"""
+    data_row = collections.OrderedDict()
+    for field_name_type, value in zip(fields.items(), csv_row):
+        field_name, field_type = field_name_type
+        if not keep_empty and value == "":
+            continue
+        if field_type is not None:
+            value = field_type.decode(value)
+        data_directory = data_row
+        while "." in field_name:
+            dir_name, field_name = field_name.split(".", 1)
+            if dir_name not in data_directory:
+                data_directory[dir_name] = collections.OrderedDict()
+            data_directory = data_directory[dir_name]
+        data_directory[field_name] = value
+    return data_row
+
+
+def random_cell(field_type, rng):
+    """Generate a plausible cell for a column, empty in about half of the cases"""
+    if rng.random() < 0.5:
+        return ""
+    if field_type is csv_format.BoolType:
+        return rng.choice(("0", "1"))
+    if field_type is csv_format.YesNoBoolType:
+        return rng.choice(("Oui", "Non"))
+    if field_type is csv_format.CommaListType:
+        return "Binet A,Binet B"
+    if field_type is csv_format.CommaSpaceListType:
+        return "Français, Anglais"
+    return "some text"
+
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) >= 2 else 20000
+    rng = random.Random(42)
+    header = [csv_field_name for csv_field_name, _field_name, _field_type in csv_format.ALUMNFORCE_FIELDS]
+    field_types = [field_type for _csv_field_name, _field_name, field_type in csv_format.ALUMNFORCE_FIELDS]
+    rows = [[random_cell(field_type, rng) for field_type in field_types] for _ in range(num_rows)]
+
+    for keep_empty in (True, False):
+        data = AlumnForceDataC2J()
+        data.set_fields_from_csv(header)
+        # Both implementations give the same JSON, with the same order of keys
+        for row in rows[:100]:
+            assert json.dumps(data.decode_csv_row(row, keep_empty)) == json.dumps(
+                legacy_decode_csv_row(data.fields, row, keep_empty)
+            )
+
+        def run_legacy():
+            for row in rows:
+                legacy_decode_csv_row(data.fields, row, keep_empty)
+
+        def run_plan():
+            for row in rows:
+                data.decode_csv_row(row, keep_empty)
+
+        print("Decoding {} rows of {} columns (keep_empty={})".format(num_rows, len(header), keep_empty))
+        results = {}
+        for name, func in (("legacy", run_legacy), ("plan", run_plan)):
+            results[name] = min(timeit.repeat(func, number=1, repeat=5))
+            print("{:>12}: {:.3f} s ({:.2f} us/row)".format(name, results[name], results[name] * 1e6 / num_rows))
+        print("Speed-up: {:.2f}x".format(results["legacy"] / results["plan"]))
+
+
+if __name__ == "__main__":
+    main()
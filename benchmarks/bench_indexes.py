@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Benchmark of the queries which use the indexes of accounts and logs
+
+Fill a test database with generated accounts and logs, then time the main
+queries of exportforauth, IssuesView, SummaryView and get_last_update_by_kind
+with and without the indexes defined in the models.
+
+Usage: python -m benchmarks.bench_indexes [number of accounts]
+"""
+
+import datetime
+import io
+import os
+import random
+import sys
+import timeit
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "xorgdata.settings")
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from xorgdata.alumnforce import models, views  # noqa: E402
+from xorgdata.alumnforce.issues import rebuild_account_issues, refresh_account_issues  # noqa: E402
+from xorgdata.alumnforce.management.commands import afsync, exportforauth  # noqa: E402
+
+INDEXED_MODELS = (models.Account, models.ImportLog, models.ExportLog)
+
+
+def populate(num_accounts, rng):
+    """Fill the database with accounts and logs looking like the production ones"""
+    today = datetime.date.today()
+    now = timezone.now()
+    accounts = []
+    for af_id in range(1, num_accounts + 1):
+        # About 1% of the accounts share their IDs with another one
+        shared_id = rng.randrange(1, num_accounts) if rng.random() < 0.01 else af_id
+        accounts.append(
+            models.Account(
+                af_id=af_id,
+                ax_id="X{}".format(shared_id),
+                xorg_id="prenom.nom.{}".format(shared_id) if rng.random() < 0.9 else None,
+                school_id=str(shared_id),
+                civility=rng.choice(("M", "Mme", "")),
+                user_kind=rng.choice(tuple(models.Account.KINDS)),
+                additional_roles=rng.choice(("", "4", "4,5", "5,7,17")),
+                email_1="prenom.nom.{}@example.org".format(af_id),
+                last_update=today - datetime.timedelta(days=rng.randrange(0, 3650)),
+                imported_at=now - datetime.timedelta(days=rng.randrange(0, 3650)),
+                deleted_since=today - datetime.timedelta(days=rng.randrange(0, 3650)) if rng.random() < 0.05 else None,
+            )
+        )
+    models.Account.objects.bulk_create(accounts, batch_size=1000)
+
+    import_logs = []
+    for days in range(2000):
+        for kind, _kind_name in models.ImportLog.KNOWN_EXPORT_KINDS:
+            import_logs.append(
+                models.ImportLog(
+                    date=today - datetime.timedelta(days=days),
+                    export_kind=kind,
+                    is_incremental=days % 30 != 0,
+                    error=models.ImportLog.SUCCESS,
+                )
+            )
+    models.ImportLog.objects.bulk_create(import_logs, batch_size=1000)
+    models.ExportLog.objects.bulk_create(
+        (
+            models.ExportLog(
+                date=today - datetime.timedelta(days=days),
+                export_kind=models.ExportLog.KIND_AUTH,
+                is_incremental=days % 7 != 0,
+                error=models.ExportLog.SUCCESS,
+            )
+            for days in range(2000)
+        ),
+        batch_size=1000,
+    )
+    rebuild_account_issues()
+
+
+def set_indexes(enabled):
+    """Create or drop the indexes defined in the models"""
+    with connection.schema_editor() as schema_editor:
+        for model in INDEXED_MODELS:
+            for index in model._meta.indexes:
+                if enabled:
+                    schema_editor.add_index(model, index)
+                else:
+                    schema_editor.remove_index(model, index)
+    if connection.vendor in ("sqlite", "postgresql"):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+
+def main():
+    num_accounts = int(sys.argv[1]) if len(sys.argv) >= 2 else 50000
+    rng = random.Random(42)
+    old_database_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        print("Generating {} accounts".format(num_accounts))
+        populate(num_accounts, rng)
+        since = timezone.now() - datetime.timedelta(days=7)
+        refreshed_af_ids = rng.sample(range(1, num_accounts + 1), 1000)
+
+        def view_context(view_class, params=None):
+            view = view_class()
+            view.setup(RequestFactory().get("/", params or {}))
+            return view.get_context_data()
+
+        def uncached(func):
+            # Measure the queries, not the cache of the latest logs
+            def wrapper():
+                cache.clear()
+                return func()
+
+            return wrapper
+
+        benchmarks = (
+            ("exportforauth (full)", lambda: call_command("exportforauth", stdout=io.StringIO())),
+            ("exportforauth (changed)", lambda: list(exportforauth.Command().iter_changed_accounts(since))),
+            ("refresh 1000 accounts issues", lambda: refresh_account_issues(refreshed_af_ids)),
+            ("IssuesView", lambda: view_context(views.IssuesView, {"page": 5})),
+            ("SummaryView", uncached(lambda: view_context(views.SummaryView))),
+            ("get_last_update_by_kind", uncached(afsync.get_last_update_by_kind)),
+        )
+
+        results = {}
+        # Measure both configurations twice, keeping the second measures, so that the first one
+        # does not include the warm-up of the caches
+        for indexes_enabled in (False, True, False, True):
+            set_indexes(indexes_enabled)
+            for name, func in benchmarks:
+                results[name, indexes_enabled] = min(timeit.repeat(func, number=1, repeat=3))
+
+        print("{:>30}  {:>10}  {:>10}  {:>8}".format("", "no index", "indexes", "speed-up"))
+        for name, _func in benchmarks:
+            without_indexes = results[name, False]
+            with_indexes = results[name, True]
+            print(
+                "{:>30}  {:>8.1f}ms  {:>8.1f}ms  {:>7.1f}x".format(
+                    name, without_indexes * 1e3, with_indexes * 1e3, without_indexes / with_indexes
+                )
+            )
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the conversion of the rows of incremental AlumnForce exports
+
+Compare RowDecoder with the previous implementation, which called the conversion
+function of every cell with uncompiled regular expressions.
+
+Usage: python -m benchmarks.bench_rowdecoder [number of rows]
+"""
+
+import datetime
+import os
+import random
+import re
+import sys
+import timeit
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "xorgdata.settings")
+django.setup()
+
+from xorgdata.alumnforce.management.commands import importcsv  # noqa: E402
+
+
+def legacy_bool_or_none(txt):
+    if txt == "":
+        return None
+    elif txt in ("0", "1"):
+        return bool(int(txt))
+    else:
+        raise ValueError("invalid bool value {}".format(repr(txt)))
+
+
+def legacy_int_or_none(txt):
+    if txt == "":
+        return None
+    elif re.match(r"^[0-9]+$", txt):
+        return int(txt)
+    else:
+        raise ValueError("invalid integer value: {}".format(repr(txt)))
+
+
+def legacy_phone_indicator(txt):
+    if txt == "":
+        return None
+    elif re.match(r"^\+?[0-9]+$", txt):
+        return int(txt)
+    else:
+        raise ValueError("invalid phone indicator value: {}".format(repr(txt)))
+
+
+def legacy_parse_french_date(value):
+    if not value:
+        return None
+    match = importcsv.FRENCH_DATE_RE.match(value)
+    if match:
+        kw = {k: int(v) for k, v in match.groupdict().items()}
+        return datetime.date(**kw)
+    raise ValueError("Unknown date format (%r)" % value)
+
+
+LEGACY_CONVERSIONS = {
+    importcsv.bool_or_none: legacy_bool_or_none,
+    importcsv.int_or_none: legacy_int_or_none,
+    importcsv.phone_indicator: legacy_phone_indicator,
+    importcsv.parse_french_date: legacy_parse_french_date,
+}
+
+
+def random_cell(conversion, rng):
+    """Generate a plausible cell for a column, empty in about one case out of three"""
+    if rng.random() < 0.3:
+        return "" if conversion is not int else str(rng.randrange(1, 100000))
+    if conversion in (int, importcsv.int_or_none):
+        return str(rng.randrange(1, 100000))
+    if conversion is importcsv.phone_indicator:
+        return rng.choice(("33", "+33", "+1", "44"))
+    if conversion is importcsv.bool_or_none:
+        return rng.choice(("0", "1"))
+    if conversion is importcsv.parse_french_date:
+        return "{:02d}/{:02d}/{}".format(rng.randrange(1, 29), rng.randrange(1, 13), rng.randrange(1930, 2005))
+    return "some text"
+
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) >= 2 else 20000
+    rng = random.Random(42)
+    fields = {}
+    for kind_fields in (importcsv.ALUMNFORCE_USER_FIELDS, importcsv.ALUMNFORCE_USERJOB_FIELDS):
+        fields.update(kind_fields)
+    header = list(fields.keys())
+    conversions = [fields[col_name][1] for col_name in header]
+    rows = [[random_cell(conversion, rng) for conversion in conversions] for _ in range(num_rows)]
+
+    legacy_columns = [fields[col_name][0] for col_name in header]
+    legacy_conversions = [LEGACY_CONVERSIONS.get(conversion, conversion) for conversion in conversions]
+
+    def run_legacy():
+        for row in rows:
+            dict(zip(legacy_columns, [conv(val) for (val, conv) in zip(row, legacy_conversions)]))
+
+    def run_decoder():
+        # The decoder is built once per file, like in load_csv
+        decoder = importcsv.RowDecoder(header, fields)
+        for row in rows:
+            decoder.decode(list(row))
+
+    print("Decoding {} rows of {} columns".format(num_rows, len(header)))
+    results = {}
+    for name, func in (("legacy", run_legacy), ("RowDecoder", run_decoder)):
+        results[name] = min(timeit.repeat(func, number=1, repeat=5))
+        print("{:>12}: {:.3f} s ({:.2f} us/row)".format(name, results[name], results[name] * 1e6 / num_rows))
+    print("Speed-up: {:.2f}x".format(results["legacy"] / results["RowDecoder"]))
+
+
+if __name__ == "__main__":
+    main()
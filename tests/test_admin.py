@@ -0,0 +1,88 @@
+import datetime
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from xorgdata.alumnforce.management.commands.exportforauth import Command as ExportForAuthCommand
+from xorgdata.alumnforce.models import Account, Group, GroupMembership
+
+from .test_importcsv import TEST_CSV_PATHS
+from .utils import create_account
+
+
+class AccountAdminTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser(
+            username="superuser",
+            email="superuser@localhost.localdomain",
+            password="A random insecure password",
+        )
+        self.client.login(username="superuser", password="A random insecure password")
+
+    def search(self, search_term):
+        resp = self.client.get(reverse("admin:alumnforce_account_changelist"), {"q": search_term})
+        self.assertEqual(resp.status_code, 200)
+        return sorted(account.af_id for account in resp.context["cl"].result_list)
+
+    def test_search(self):
+        create_account(1, first_name="Élodie", last_name="Dupont", xorg_id="elodie.dupont.2001")
+        create_account(2, first_name="Louis", last_name="Dupond", ax_id="A42")
+        self.assertEqual(Account.objects.get(af_id=1).search_name, "elodie.dupont.2001 elodie dupont")
+        self.assertEqual(self.search("ÉLODIE"), [1])
+        self.assertEqual(self.search("dupon"), [1, 2])
+        self.assertEqual(self.search("dupon lou"), [2])
+        self.assertEqual(self.search("a42"), [2])
+        self.assertEqual(self.search("martin"), [])
+
+        # Updating a name updates the searched value
+        account = Account.objects.get(af_id=2)
+        account.last_name = "Martin"
+        account.save(update_fields=["last_name"])
+        self.assertEqual(self.search("martin"), [2])
+
+    def test_search_imported_account(self):
+        call_command("importcsv", TEST_CSV_PATHS["users"], verbosity=0)
+        self.assertEqual(self.search("vaneau"), [1])
+
+    def test_save_model(self):
+        account = create_account(1, xorg_id="prenom.nom.2001", import_digest="0" * 64)
+        since = timezone.now()
+        self.assertEqual(list(ExportForAuthCommand().iter_changed_accounts(since)), [])
+
+        # An account edited in the admin is imported again and pushed by the next incremental export
+        account.first_name = "Prénom"
+        admin.site._registry[Account].save_model(None, account, None, True)
+        account.refresh_from_db()
+        self.assertEqual(account.import_digest, "")
+        self.assertEqual(
+            [exported["af_id"] for exported in ExportForAuthCommand().iter_changed_accounts(since)],
+            [1],
+        )
+
+    def test_change_page_queries(self):
+        """The number of queries of the change page of an account does not depend on its groups"""
+
+        def count_change_page_queries(account):
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.get(reverse("admin:alumnforce_account_change", args=(account.af_id,)))
+            self.assertEqual(resp.status_code, 200)
+            return len(ctx.captured_queries)
+
+        accounts = [create_account(af_id) for af_id in (1, 2)]
+        for af_id, num_groups in ((1, 1), (2, 5)):
+            for group_id in range(num_groups):
+                group, _created = Group.objects.get_or_create(
+                    af_id=group_id, defaults={"last_update": datetime.date(2001, 2, 3)}
+                )
+                GroupMembership.objects.create(
+                    account_id=af_id, group=group, role="member", last_update=datetime.date(2001, 2, 3)
+                )
+        # Warm up the cache of content types
+        count_change_page_queries(accounts[0])
+        self.assertEqual(count_change_page_queries(accounts[0]), count_change_page_queries(accounts[1]))
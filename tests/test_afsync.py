@@ -0,0 +1,250 @@
+import datetime
+import json
+import tempfile
+import threading
+import time
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+
+from xorgdata.alumnforce.models import Account, Group, GroupMembership, ImportLog
+
+from .test_importcsv import TEST_CSV_PATHS
+
+
+class FakeFtpServer:
+    """Stand-in for AlumnForce's FTPS server, serving the files of a local directory"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        # Delay of the download of some files, in seconds
+        self.delays = {}
+        # Number of bytes after which the next download of some files gets interrupted
+        self.interruptions = {}
+        # Sizes announced for some files, instead of their real size
+        self.fake_sizes = {}
+        # Offsets from which the downloads were resumed
+        self.resumed_offsets = []
+        self.lock = threading.Lock()
+        self.num_connections = 0
+        self.downloaded_files = []
+
+    def __call__(self, host):
+        """Open a connection, like ftplib.FTP_TLS(host)"""
+        with self.lock:
+            self.num_connections += 1
+        return FakeFtpConnection(self)
+
+
+class FakeFtpConnection:
+    def __init__(self, server):
+        self.server = server
+
+    def login(self, user, password):
+        pass
+
+    def prot_p(self):
+        pass
+
+    def cwd(self, directory):
+        pass
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def dir(self, callback):
+        for file_path in sorted(self.server.directory.iterdir()):
+            callback(
+                "-rw-r--r--    1 ftp      ftp         {} Feb 03 04:05 {}".format(
+                    file_path.stat().st_size, file_path.name
+                )
+            )
+
+    def voidcmd(self, cmd):
+        assert cmd == "TYPE I"
+
+    def size(self, filename):
+        if filename in self.server.fake_sizes:
+            return self.server.fake_sizes[filename]
+        return (self.server.directory / filename).stat().st_size
+
+    def retrbinary(self, cmd, callback, rest=None):
+        assert cmd.startswith("RETR ")
+        filename = cmd[5:]
+        time.sleep(self.server.delays.get(filename, 0))
+        data = (self.server.directory / filename).read_bytes()
+        if rest:
+            self.server.resumed_offsets.append(rest)
+            data = data[rest:]
+        interruption = self.server.interruptions.pop(filename, None)
+        if interruption is not None:
+            callback(data[:interruption])
+            raise EOFError("connection lost")
+        callback(data)
+        with self.server.lock:
+            self.server.downloaded_files.append(filename)
+
+
+class AfSyncTests(TestCase):
+    """Test synchronising with a local stand-in of AlumnForce's FTP server"""
+
+    def setUp(self):
+        # Rolling back the logs of previous tests does not invalidate the cache of the latest logs
+        cache.clear()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.remote_dir = Path(tmpdir.name) / "remote"
+        self.remote_dir.mkdir()
+        self.local_dir = Path(tmpdir.name) / "local"
+        settings_override = override_settings(
+            ALUMNFORCE_FTP_USER="user",
+            ALUMNFORCE_FTP_PASSWORD="password",
+            ALUMNFORCE_FTP_LOCAL_DIRECTORY=str(self.local_dir),
+            ALUMNFORCE_FTP_DOWNLOAD_WORKERS=3,
+            PERSISTENT_DIRECTORY=tmpdir.name,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.server = FakeFtpServer(self.remote_dir)
+        ftp_patcher = mock.patch("ftplib.FTP_TLS", self.server)
+        ftp_patcher.start()
+        self.addCleanup(ftp_patcher.stop)
+
+    def test_afsync(self):
+        for file_path in TEST_CSV_PATHS.values():
+            (self.remote_dir / file_path.name).write_bytes(file_path.read_bytes())
+        # Make the files which need to be imported first be the last ones to be downloaded
+        self.server.delays[TEST_CSV_PATHS["users"].name] = 0.2
+        self.server.delays[TEST_CSV_PATHS["groups"].name] = 0.1
+
+        # Run the invalidation of the cache of the latest logs, which happens when the imports are committed
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("afsync", stdout=StringIO())
+        self.assertEqual(len(self.server.downloaded_files), len(TEST_CSV_PATHS))
+        self.assertEqual(self.server.num_connections, 4)
+        self.assertEqual(
+            set(path.name for path in self.local_dir.glob("*.csv")), set(path.name for path in TEST_CSV_PATHS.values())
+        )
+
+        # The files were imported in the order of the kinds, so that every reference was resolved
+        self.assertEqual(
+            list(ImportLog.objects.order_by("pk").values_list("export_kind", "error")),
+            [
+                ("users", ImportLog.SUCCESS),
+                ("groups", ImportLog.SUCCESS),
+                ("groupmembers", ImportLog.SUCCESS),
+                ("userdegrees", ImportLog.SUCCESS),
+                ("userjobs", ImportLog.SUCCESS),
+            ],
+        )
+        account = Account.objects.get(af_id=1)
+        self.assertEqual(account.degrees.count(), 1)
+        self.assertEqual(account.jobs.count(), 2)
+        self.assertEqual(GroupMembership.objects.count(), 2)
+
+        # Running again does not download nor import anything
+        call_command("afsync", stdout=StringIO())
+        self.assertEqual(len(self.server.downloaded_files), len(TEST_CSV_PATHS))
+        self.assertEqual(ImportLog.objects.count(), len(TEST_CSV_PATHS))
+
+    def test_afsync_error_file(self):
+        file_name = TEST_CSV_PATHS["users"].name
+        (self.remote_dir / file_name).write_bytes(TEST_CSV_PATHS["users"].read_bytes())
+        (self.remote_dir / (file_name + ".error")).write_bytes(b"")
+
+        call_command("afsync", stdout=StringIO())
+        import_log = ImportLog.objects.get()
+        self.assertEqual(import_log.export_kind, "users")
+        self.assertEqual(import_log.date, datetime.date(2001, 2, 3))
+        self.assertEqual(import_log.error, ImportLog.ALUMNFORCE_ERROR)
+        self.assertFalse(Account.objects.exists())
+
+    def test_afsync_failed_import(self):
+        users_path = TEST_CSV_PATHS["users"]
+        groups_path = TEST_CSV_PATHS["groups"]
+        (self.remote_dir / users_path.name).write_bytes(users_path.read_bytes())
+        # Create a groups file with duplicated columns, followed by an error file of the same kind
+        content = groups_path.read_text(encoding="utf-8")
+        (self.remote_dir / groups_path.name).write_text(
+            content.replace("Matricule AX", "Identifiant AF", 1), encoding="utf-8"
+        )
+        (self.remote_dir / "exportgroups-afbo-Polytechnique-X-20010204.csv.error").write_bytes(b"")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(CommandError):
+                call_command("afsync", stdout=StringIO())
+        self.assertEqual(
+            list(ImportLog.objects.order_by("pk").values_list("export_kind", "error")),
+            [("users", ImportLog.SUCCESS), ("groups", ImportLog.XORG_ERROR)],
+        )
+
+        # AlumnForce fixes the file, and the broken copy is removed
+        (self.remote_dir / groups_path.name).write_bytes(groups_path.read_bytes())
+        (self.local_dir / groups_path.name).unlink()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("afsync", stdout=StringIO())
+        self.assertEqual(
+            list(ImportLog.objects.order_by("pk").values_list("export_kind", "date", "error")),
+            [
+                ("users", datetime.date(2001, 2, 3), ImportLog.SUCCESS),
+                ("groups", datetime.date(2001, 2, 3), ImportLog.XORG_ERROR),
+                ("groups", datetime.date(2001, 2, 3), ImportLog.SUCCESS),
+                ("groups", datetime.date(2001, 2, 4), ImportLog.ALUMNFORCE_ERROR),
+            ],
+        )
+        self.assertTrue(Group.objects.exists())
+
+    def test_afsync_resume_download(self):
+        file_path = TEST_CSV_PATHS["users"]
+        (self.remote_dir / file_path.name).write_bytes(file_path.read_bytes())
+        self.server.interruptions[file_path.name] = 100
+
+        call_command("afsync", stdout=StringIO())
+        self.assertEqual(self.server.resumed_offsets, [100])
+        self.assertEqual((self.local_dir / file_path.name).read_bytes(), file_path.read_bytes())
+        self.assertFalse((self.local_dir / (file_path.name + ".part")).exists())
+        self.assertTrue(Account.objects.filter(af_id=1).exists())
+
+        # The download is recorded in the manifest
+        with open(self.local_dir / "manifest.json") as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(manifest[file_path.name]["size"], file_path.stat().st_size)
+        self.assertEqual(len(manifest[file_path.name]["sha256"]), 64)
+
+    def test_afsync_corrupted_download(self):
+        file_path = TEST_CSV_PATHS["users"]
+        (self.remote_dir / file_path.name).write_bytes(file_path.read_bytes())
+        self.server.interruptions[file_path.name] = 100
+
+        # Download the file without importing it, then corrupt it without changing its size
+        stdout = StringIO()
+        call_command("afsync", "--dryrun", stdout=stdout)
+        self.assertIn("transfer of '{}' interrupted".format(file_path.name), stdout.getvalue())
+        local_path = self.local_dir / file_path.name
+        local_path.write_bytes(local_path.read_bytes().replace(b"Vaneau", b"Vanoau"))
+        self.assertEqual(local_path.stat().st_size, file_path.stat().st_size)
+
+        # The file does not match its digest, so it is downloaded again
+        call_command("afsync", stdout=StringIO())
+        self.assertEqual(self.server.downloaded_files, [file_path.name, file_path.name])
+        self.assertEqual(local_path.read_bytes(), file_path.read_bytes())
+        self.assertEqual(Account.objects.get(af_id=1).last_name, "Vaneau")
+
+    def test_afsync_truncated_download(self):
+        file_path = TEST_CSV_PATHS["users"]
+        (self.remote_dir / file_path.name).write_bytes(file_path.read_bytes())
+        self.server.fake_sizes[file_path.name] = file_path.stat().st_size + 10
+
+        with self.assertRaisesMessage(CommandError, "Size mismatch"):
+            call_command("afsync", stdout=StringIO())
+        self.assertEqual(list(self.local_dir.iterdir()), [])
+        self.assertFalse(ImportLog.objects.exists())
@@ -1,14 +1,78 @@
+import datetime
+import gzip
+import http.server
 import json
+import threading
 from io import StringIO
+from unittest import mock, skipIf
 
 from django.core.management import call_command
-from django.test import TestCase
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
-from xorgdata.alumnforce.models import Account
+from xorgdata.alumnforce.management.commands.exportforauth import EXPORTED_FIELDS, zstandard
+from xorgdata.alumnforce.models import Account, DuplicatedXorgId, ExportLog
 
 from .test_importcsv import TEST_CSV_PATHS
 
 
+class FakeXorgAuthServer(http.server.ThreadingHTTPServer):
+    """Stand-in for xorgauth's synchronisation API, listening on a local port"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeXorgAuthHandler)
+        self.lock = threading.Lock()
+        # Status codes returned by the next requests, before succeeding
+        self.failures = []
+        self.received_pages = []
+        self.received_encodings = []
+        self.num_connections = 0
+        self.num_requests = 0
+
+    @property
+    def host(self):
+        return "127.0.0.1:{}".format(self.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeXorgAuthHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.num_connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        encoding = self.headers.get("Content-Encoding")
+        if encoding == "gzip":
+            body = gzip.decompress(body)
+        elif encoding == "zstd":
+            body = zstandard.ZstdDecompressor().decompress(body)
+        body = json.loads(body)
+        with self.server.lock:
+            self.server.received_encodings.append(encoding)
+            self.server.num_requests += 1
+            status = self.server.failures.pop(0) if self.server.failures else 200
+            if status == 200:
+                self.server.received_pages.append(body)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
 class ExportForAuthTests(TestCase):
     def test_exportforauth(self):
         # Start by populating the database
@@ -51,3 +115,185 @@ class ExportForAuthTests(TestCase):
         self.assertEqual(exported_data[0]["af_id"], 1)
         self.assertEqual(exported_data[0]["ax_contributor"], True)
         self.assertEqual(exported_data[0]["axjr_subscribed"], True)
+
+    def test_exportforauth_jsonl(self):
+        for file_path in TEST_CSV_PATHS.values():
+            call_command("importcsv", file_path, verbosity=0)
+
+        out = StringIO()
+        call_command("exportforauth", "--jsonl", stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])["xorg_id"], "louis.vaneau.1829")
+
+    def test_exportforauth_empty(self):
+        out = StringIO()
+        call_command("exportforauth", stdout=out)
+        self.assertEqual(json.loads(out.getvalue()), [])
+
+
+@override_settings(XORGAUTH_PASSWORD="secret", XORGAUTH_USE_HTTPS=False, XORGAUTH_PUSH_WORKERS=2)
+@mock.patch("xorgdata.alumnforce.management.commands.exportforauth.PUSH_RETRY_DELAY", 0)
+@mock.patch("xorgdata.alumnforce.management.commands.exportforauth.PAGE_SIZE", 3)
+class ExportForAuthPushTests(TestCase):
+    def setUp(self):
+        for af_id in range(1, 11):
+            Account.objects.create(
+                af_id=af_id,
+                xorg_id="prenom.nom.{}".format(af_id),
+                user_kind=1,
+                email_1="prenom.nom.{}@example.org".format(af_id),
+                last_update=datetime.date(2001, 2, 3),
+            )
+
+    def test_push(self):
+        with FakeXorgAuthServer() as server, self.settings(XORGAUTH_HOST=server.host):
+            server.failures = [503, 429]
+            call_command("exportforauth", "--push", verbosity=0)
+
+        self.assertEqual(server.num_requests, 6)
+        self.assertEqual(len(server.received_pages), 4)
+        self.assertTrue(all(page["secret"] == "secret" for page in server.received_pages))
+        pushed_ids = sorted(account["af_id"] for page in server.received_pages for account in page["data"])
+        self.assertEqual(pushed_ids, list(range(1, 11)))
+        # Connections are kept alive between pages
+        self.assertLessEqual(server.num_connections, 2)
+
+        export_log = ExportLog.objects.get()
+        self.assertEqual(export_log.num_items, 10)
+        self.assertRegex(
+            export_log.message, r"^Sent 10 accounts to 127\.0\.0\.1:[0-9]+ in 4 pages \([0-9.]+s(, [0-9.]+s){3}\)$"
+        )
+
+    def test_push_rejected(self):
+        with FakeXorgAuthServer() as server, self.settings(XORGAUTH_HOST=server.host):
+            server.failures = [403]
+            with self.assertRaisesMessage(CommandError, "HTTP error 403 (Forbidden) when trying to push data"):
+                call_command("exportforauth", "--push", verbosity=0)
+        self.assertFalse(ExportLog.objects.exists())
+
+    def test_push_too_many_failures(self):
+        with FakeXorgAuthServer() as server, self.settings(XORGAUTH_HOST=server.host, XORGAUTH_PUSH_WORKERS=1):
+            server.failures = [500] * 5
+            with self.assertRaisesMessage(CommandError, "HTTP error 500 (Internal Server Error)"):
+                call_command("exportforauth", "--push", verbosity=0)
+        # The first page was attempted 5 times, the next one may have started before the export stopped
+        self.assertGreaterEqual(server.num_requests, 5)
+        self.assertFalse(ExportLog.objects.exists())
+
+    def test_push_changed_accounts(self):
+        today = datetime.date.today()
+        with FakeXorgAuthServer() as server, self.settings(XORGAUTH_HOST=server.host):
+            # The first push sends all the accounts
+            call_command("exportforauth", "--push", verbosity=0)
+            self.assertFalse(ExportLog.objects.get().is_incremental)
+
+            now = timezone.now()
+            Account.objects.filter(af_id=2).update(last_update=today, imported_at=now)
+            Account.objects.filter(af_id=3).update(deleted_since=today, imported_at=now)
+            Account.objects.filter(af_id=4).update(xorg_id="prenom.nom.5", last_update=today, imported_at=now)
+            Account.objects.filter(af_id=6).update(xorg_id=None, last_update=today, imported_at=now)
+            pushed_accounts = self.push_changed_accounts(server)
+            # Account 6 has no X.org login, so it is not sent, as in full pushes
+            self.assertEqual(sorted(pushed_accounts), [2, 3, 4, 5])
+            self.assertNotIn("deleted", pushed_accounts[2])
+            self.assertEqual(pushed_accounts[3], {"xorg_id": "prenom.nom.3", "af_id": 3, "deleted": True})
+            self.assertEqual(pushed_accounts[4], {"xorg_id": "prenom.nom.5", "af_id": 4, "deleted": True})
+            self.assertEqual(pushed_accounts[5], {"xorg_id": "prenom.nom.5", "af_id": 5, "deleted": True})
+            export_log = ExportLog.objects.latest("pk")
+            self.assertTrue(export_log.is_incremental)
+            self.assertEqual(export_log.num_items, 4)
+            self.assertEqual(list(DuplicatedXorgId.objects.values_list("xorg_id", flat=True)), ["prenom.nom.5"])
+
+            # A full push only sends the accounts which can be used
+            server.received_pages = []
+            call_command("exportforauth", "--push", "--full", verbosity=0)
+            pushed_ids = sorted(account["af_id"] for page in server.received_pages for account in page["data"])
+            self.assertEqual(pushed_ids, [1, 2, 7, 8, 9, 10])
+            self.assertFalse(ExportLog.objects.latest("pk").is_incremental)
+
+    def push_changed_accounts(self, server):
+        """Push the changed accounts and return the received data, by AF ID"""
+        server.received_pages = []
+        call_command("exportforauth", "--push", verbosity=0)
+        self.assertTrue(ExportLog.objects.latest("pk").is_incremental)
+        return {account["af_id"]: account for page in server.received_pages for account in page["data"]}
+
+    def test_push_resolved_duplicate(self):
+        with FakeXorgAuthServer() as server, self.settings(XORGAUTH_HOST=server.host):
+            call_command("exportforauth", "--push", verbosity=0)
+            Account.objects.filter(af_id__in=(4, 5)).update(xorg_id="dup", imported_at=timezone.now())
+            pushed_accounts = self.push_changed_accounts(server)
+            self.assertEqual(pushed_accounts[4], {"xorg_id": "dup", "af_id": 4, "deleted": True})
+            self.assertEqual(pushed_accounts[5], {"xorg_id": "dup", "af_id": 5, "deleted": True})
+
+            # Account 5 is sent again once account 4 no longer uses its login, even though it did not change
+            Account.objects.filter(af_id=4).update(xorg_id="other", imported_at=timezone.now())
+            pushed_accounts = self.push_changed_accounts(server)
+            self.assertEqual(sorted(pushed_accounts), [4, 5])
+            self.assertNotIn("deleted", pushed_accounts[4])
+            self.assertEqual(pushed_accounts[5]["xorg_id"], "dup")
+            self.assertNotIn("deleted", pushed_accounts[5])
+            self.assertFalse(DuplicatedXorgId.objects.exists())
+
+            # Then nothing needs to be sent
+            self.assertEqual(self.push_changed_accounts(server), {})
+
+    def test_push_late_file(self):
+        """Accounts imported from a file dated before the previous push are sent"""
+        with FakeXorgAuthServer() as server, self.settings(XORGAUTH_HOST=server.host):
+            call_command("exportforauth", "--push", verbosity=0)
+            call_command("importcsv", TEST_CSV_PATHS["users"], verbosity=0)
+            self.assertEqual(Account.objects.get(af_id=1).last_update, datetime.date(2001, 2, 3))
+            pushed_accounts = self.push_changed_accounts(server)
+            self.assertEqual(sorted(pushed_accounts), [1])
+            self.assertEqual(pushed_accounts[1]["xorg_id"], "louis.vaneau.1829")
+
+    def test_push_periodic_full_export(self):
+        ExportLog.objects.create(
+            date=datetime.date.today() - datetime.timedelta(days=8),
+            export_kind=ExportLog.KIND_AUTH,
+            error=ExportLog.SUCCESS,
+        )
+        with FakeXorgAuthServer() as server, self.settings(XORGAUTH_HOST=server.host, XORGAUTH_FULL_PUSH_INTERVAL=7):
+            call_command("exportforauth", "--push", verbosity=0)
+        self.assertEqual(sum(len(page["data"]) for page in server.received_pages), 10)
+        self.assertFalse(ExportLog.objects.latest("pk").is_incremental)
+
+    def push_rows(self, server):
+        """Push all the accounts and return the received values of EXPORTED_FIELDS, in "arrays" format"""
+        server.received_pages = []
+        call_command("exportforauth", "--push", "--full", verbosity=0)
+        rows = []
+        for page in server.received_pages:
+            if "fields" in page:
+                self.assertEqual(page["fields"], list(EXPORTED_FIELDS))
+                rows += page["data"]
+            else:
+                rows += [[account.get(field) for field in EXPORTED_FIELDS] for account in page["data"]]
+        return sorted(rows, key=lambda row: row[1])
+
+    def test_push_compressed_arrays(self):
+        with FakeXorgAuthServer() as server, self.settings(XORGAUTH_HOST=server.host):
+            expected_rows = self.push_rows(server)
+            self.assertEqual(len(expected_rows), 10)
+            self.assertEqual(set(server.received_encodings), {None})
+
+            server.received_encodings = []
+            with self.settings(XORGAUTH_PUSH_FORMAT="arrays", XORGAUTH_PUSH_COMPRESSION="gzip"):
+                self.assertEqual(self.push_rows(server), expected_rows)
+            self.assertEqual(set(server.received_encodings), {"gzip"})
+
+    @skipIf(zstandard is None, "zstandard is not installed")
+    def test_push_zstd(self):
+        with FakeXorgAuthServer() as server, self.settings(XORGAUTH_HOST=server.host):
+            expected_rows = self.push_rows(server)
+            server.received_encodings = []
+            with self.settings(XORGAUTH_PUSH_COMPRESSION="zstd"):
+                self.assertEqual(self.push_rows(server), expected_rows)
+            self.assertEqual(set(server.received_encodings), {"zstd"})
+
+    def test_push_unknown_compression(self):
+        with self.settings(XORGAUTH_PUSH_COMPRESSION="brotli"):
+            with self.assertRaisesMessage(CommandError, "Unknown push compression 'brotli'"):
+                call_command("exportforauth", "--push", verbosity=0)
@@ -1,11 +1,14 @@
 import datetime
+import json
 import re
+import tempfile
 from io import StringIO
 from pathlib import Path
 
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 
+from xorgdata.alumnforce.full_export.lib.converters import AlumnForceDataC2J
 from xorgdata.alumnforce.models import Account
 
 
@@ -144,3 +147,97 @@ class ImportAllUsersTests(TestCase):
         account.refresh_from_db()
         self.assertEqual(account.deleted_since, datetime.date(2001, 2, 3))
         self.assertEqual(Account.objects.filter(deleted_since=datetime.date(2001, 2, 3)).count(), 1)
+
+    def test_batch_size(self):
+        Account.objects.create(af_id=123456, user_kind=1, last_update=datetime.date(2001, 2, 3))
+        out = StringIO()
+        call_command("importallusers", "--batch-size=1", self.csv_file, stdout=out)
+        self.assertIn("Loaded 2 values from full export", out.getvalue())
+        self.assertEqual(Account.objects.filter(deleted_since=None).count(), 2)
+        self.assertEqual(Account.objects.get(af_id=123456).deleted_since, datetime.date(2001, 2, 3))
+        # The searched names are filled even though the accounts are not saved one by one
+        self.assertEqual(Account.objects.get(af_id=1).search_name, "admin.alumnforce admin alumnforce")
+
+    def test_failed_import(self):
+        account = Account.objects.create(af_id=123456, user_kind=1, last_update=datetime.date(2001, 2, 3))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Break the last row of the file, after a valid one
+            csv_file = Path(tmpdir) / self.csv_file.name
+            csv_content = self.csv_file.read_text(encoding="iso-8859-15").rstrip("\n")
+            csv_file.write_text(csv_content + ",extra column\n", encoding="iso-8859-15")
+            with self.assertRaises(ValueError):
+                call_command("importallusers", "--batch-size=1", csv_file, stdout=StringIO())
+
+        # Nothing was modified
+        self.assertEqual(list(Account.objects.values_list("af_id", flat=True)), [123456])
+        account.refresh_from_db()
+        self.assertEqual(account.deleted_since, None)
+
+
+class AlumnForceDataC2JTests(SimpleTestCase):
+    """Test the conversion of full exports to JSON"""
+
+    def setUp(self):
+        self.csv_file = Path(__file__).parent / "files" / "export-users-20010203-040506.csv"
+
+    def test_iter_csv_file(self):
+        data = AlumnForceDataC2J.import_csv_file(self.csv_file, keep_empty=True)
+        rows = list(AlumnForceDataC2J.iter_csv_file(self.csv_file, keep_empty=True))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows, data.content)
+
+    def test_iter_csv_file_invalid_header(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_file = Path(tmpdir) / "export-users-20010203-040506.csv"
+            csv_file.write_text("Identifiant (AlumnForce),Unknown field\n1,2\n", encoding="iso-8859-15")
+            rows = AlumnForceDataC2J.iter_csv_file(csv_file)
+            with self.assertRaisesMessage(ValueError, "Unknown CSV field 'Unknown field'"):
+                next(rows)
+
+    def test_decode_csv_row(self):
+        data = AlumnForceDataC2J()
+        data.set_fields_from_csv(
+            [
+                "Identifiant (AlumnForce)",
+                "Adresse personnelle - Ligne 1",
+                "Membre décédé (Oui [1] / Non [0])",
+                "Adresse personnelle - Ville",
+                "Ex-binets",
+            ]
+        )
+        row = data.decode_csv_row(["1", "", "0", "Paris", "Binet A,Binet B"], keep_empty=False)
+        self.assertEqual(
+            json.dumps(row),
+            json.dumps(
+                {
+                    "id_af": "1",
+                    "is_dead": False,
+                    "personal": {"address": {"city": "Paris"}},
+                    "school": {"binets": ["Binet A", "Binet B"]},
+                }
+            ),
+        )
+        row = data.decode_csv_row(["1", "", "0", "Paris", ""], keep_empty=True)
+        self.assertEqual(
+            json.dumps(row),
+            json.dumps(
+                {
+                    "id_af": "1",
+                    "personal": {"address": {"line_1": "", "city": "Paris"}},
+                    "is_dead": False,
+                    "school": {"binets": None},
+                }
+            ),
+        )
+        with self.assertRaisesMessage(ValueError, "Incompatible value for field 'is_dead'"):
+            data.decode_csv_row(["1", "", "2", "Paris", ""], keep_empty=True)
+
+    def test_json_dump_rows(self):
+        data = AlumnForceDataC2J.import_csv_file(self.csv_file)
+        for rows in ([], data.content[:1], data.content):
+            for kwargs in ({}, {"indent": 2}, {"indent": 2, "ensure_ascii": False}):
+                expected = StringIO()
+                json.dump(rows, expected, **kwargs)
+                output = StringIO()
+                AlumnForceDataC2J.json_dump_rows(iter(rows), output, **kwargs)
+                self.assertEqual(output.getvalue(), expected.getvalue())
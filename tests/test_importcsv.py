@@ -1,13 +1,22 @@
 import collections
 import datetime
+import hashlib
 import re
+import tempfile
 from io import StringIO
 from pathlib import Path
 
-from django.core.management import call_command
-from django.test import TestCase
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
 
-from xorgdata.alumnforce.models import Account, Group, ImportLog
+from xorgdata.alumnforce.management.commands.importcsv import (
+    ALUMNFORCE_USERJOB_FIELDS,
+    KeptParseReports,
+    ParseReport,
+    RowDecoder,
+)
+from xorgdata.alumnforce.models import Account, Group, GroupMembership, ImportLog, ParseProblem
 
 TEST_CSV_FILES = (
     ("users", "exportusers-afbo-Polytechnique-X-20010203.csv"),
@@ -32,7 +41,7 @@ class ImportCsvTests(TestCase):
             for out_line in out.getvalue().splitlines():
                 # Remove color escape sequences
                 line = out_line.replace("\x1b[32;1m", "").replace("\x1b[0m", "")
-                if re.match(r"^Loaded [0-9]+ values from " + kind + r" '.*'\.$", line):
+                if re.match(r"^Loaded [0-9]+ values from " + kind + r" '.*'(, [0-9]+ actually changed)?\.$", line):
                     continue
                 else:  # pragma: no cover
                     # Display the errors
@@ -70,6 +79,33 @@ class ImportCsvTests(TestCase):
             self.assertGreater(import_log.num_modified, 0)
             self.assertNotEqual(import_log.message, "")
 
+    def test_importcsv_several_files(self):
+        # Files are imported in the order of the kinds, whatever the order of the arguments
+        call_command("importcsv", *reversed(TEST_CSV_PATHS.values()), verbosity=0)
+        self.assertEqual(
+            list(ImportLog.objects.order_by("pk").values_list("export_kind", flat=True)),
+            ["users", "groups", "groupmembers", "userdegrees", "userjobs"],
+        )
+        self.assertFalse(ImportLog.objects.exclude(error=ImportLog.SUCCESS).exists())
+        self.assertEqual(GroupMembership.objects.count(), 2)
+
+    def test_importcsv_several_files_failure(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Create a groups file with duplicated columns
+            groups_path = Path(tmpdir) / TEST_CSV_PATHS["groups"].name
+            content = TEST_CSV_PATHS["groups"].read_text(encoding="utf-8")
+            groups_path.write_text(content.replace("Matricule AX", "Identifiant AF", 1), encoding="utf-8")
+            with self.assertRaises(CommandError):
+                call_command("importcsv", groups_path, TEST_CSV_PATHS["users"], verbosity=0)
+
+        # The users file has been committed before the failure, which is logged
+        self.assertEqual(
+            list(ImportLog.objects.order_by("pk").values_list("export_kind", "error")),
+            [("users", ImportLog.SUCCESS), ("groups", ImportLog.XORG_ERROR)],
+        )
+        self.assertTrue(Account.objects.filter(af_id=1).exists())
+        self.assertFalse(Group.objects.exists())
+
     def test_import_csv_user(self):
         # Ensure that the test user did not exist beforehand, in the test database
         self.assertEqual(Account.objects.filter(xorg_id="louis.vaneau.1829").count(), 0)
@@ -196,6 +232,63 @@ class ImportCsvTests(TestCase):
         self.assertEqual(user_job.buyer_of_company, False)
         self.assertEqual(user_job.last_update, datetime.date(2001, 2, 3))
 
+    def test_import_csv_user_update(self):
+        # Create an outdated version of the test user, and another user which is not in the file
+        Account.objects.create(
+            af_id=1, first_name="Louis", last_name="Old", user_kind=1, last_update=datetime.date(2000, 1, 1)
+        )
+        Account.objects.create(af_id=2, first_name="Other", user_kind=1, last_update=datetime.date(2000, 1, 1))
+
+        call_command("importcsv", "--batch-size=1", TEST_CSV_PATHS["users"], verbosity=0)
+        user = Account.objects.get(af_id=1)
+        self.assertEqual(user.last_name, "Vaneau")
+        self.assertEqual(user.xorg_id, "louis.vaneau.1829")
+        self.assertEqual(user.last_update, datetime.date(2001, 2, 3))
+        other_user = Account.objects.get(af_id=2)
+        self.assertEqual(other_user.first_name, "Other")
+        self.assertEqual(other_user.last_update, datetime.date(2000, 1, 1))
+
+    def test_import_csv_user_unchanged(self):
+        call_command("importcsv", TEST_CSV_PATHS["users"], verbosity=0)
+        self.assertEqual(ImportLog.objects.get().num_modified, 1)
+
+        # Importing the same values again does not modify the account
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_path = Path(tmpdir) / "exportusers-afbo-Polytechnique-X-20010204.csv"
+            file_path.write_bytes(TEST_CSV_PATHS["users"].read_bytes())
+            call_command("importcsv", file_path, verbosity=0)
+            import_log = ImportLog.objects.get(date=datetime.date(2001, 2, 4))
+            self.assertEqual(import_log.num_modified, 0)
+            self.assertIn("Loaded 1 values from users", import_log.message)
+            self.assertIn("0 actually changed", import_log.message)
+            self.assertEqual(Account.objects.get(af_id=1).last_update, datetime.date(2001, 2, 3))
+
+            # ... unless it has been deleted in the meantime
+            Account.objects.filter(af_id=1).update(deleted_since=datetime.date(2001, 2, 4))
+            call_command("importcsv", file_path, verbosity=0)
+            account = Account.objects.get(af_id=1)
+            self.assertEqual(account.deleted_since, None)
+            self.assertEqual(account.last_update, datetime.date(2001, 2, 4))
+
+    def test_import_csv_user_details_replaced(self):
+        # Importing details of an unknown user logs a warning
+        call_command("importcsv", TEST_CSV_PATHS["userjobs"], verbosity=0)
+        self.assertEqual(
+            list(ImportLog.objects.filter(error=ImportLog.XORG_ERROR).values_list("message", flat=True)),
+            ["Unable to find user with AF ID 1 (AX ID '18290001')"] * 2,
+        )
+
+        # Importing the same details twice replaces the previous ones
+        call_command("importcsv", TEST_CSV_PATHS["users"], verbosity=0)
+        for _ in range(2):
+            call_command("importcsv", "--batch-size=1", TEST_CSV_PATHS["userdegrees"], verbosity=0)
+            call_command("importcsv", "--batch-size=1", TEST_CSV_PATHS["userjobs"], verbosity=0)
+        user = Account.objects.get(af_id=1)
+        self.assertEqual(user.degrees.count(), 1)
+        self.assertEqual(
+            list(user.jobs.order_by("pk").values_list("title", flat=True)), ["Emploi numéro 1", "Emploi numéro 2"]
+        )
+
     def test_import_csv_group(self):
         # Ensure that the test user and group did not exist beforehand, in the test database
         self.assertEqual(Account.objects.filter(xorg_id="louis.vaneau.1829").count(), 0)
@@ -226,3 +319,244 @@ class ImportCsvTests(TestCase):
         self.assertEqual(membership.group, group)
         self.assertEqual(membership.role, "member")
         self.assertEqual(membership.last_update, datetime.date(2001, 2, 3))
+
+    def test_import_csv_group_update(self):
+        call_command("importcsv", TEST_CSV_PATHS["users"], verbosity=0)
+        call_command("importcsv", TEST_CSV_PATHS["groups"], verbosity=0)
+        call_command("importcsv", TEST_CSV_PATHS["groupmembers"], verbosity=0)
+        GroupMembership.objects.update(role="banned", last_update=datetime.date(2000, 1, 1))
+
+        # Importing memberships again updates the existing ones, and warns about unknown groups
+        Group.objects.filter(af_id=2).delete()
+        call_command("importcsv", "--batch-size=1", TEST_CSV_PATHS["groupmembers"], verbosity=0)
+        membership = GroupMembership.objects.get()
+        self.assertEqual(membership.account_id, 1)
+        self.assertEqual(membership.group_id, 1)
+        self.assertEqual(membership.role, "member")
+        self.assertEqual(membership.last_update, datetime.date(2001, 2, 3))
+        self.assertEqual(
+            list(ImportLog.objects.filter(error=ImportLog.XORG_ERROR).values_list("message", flat=True)),
+            ["Unable to find group with AF ID 2"],
+        )
+
+
+class ImportCsvProblemsTests(TestCase):
+    """Test the tracking of malformed lines"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.persistent_dir = Path(self.tmpdir.name)
+        settings_override = override_settings(
+            PERSISTENT_DIRECTORY=self.tmpdir.name, REPORT_RECIPIENTS=["reports@example.org"]
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.good_content = TEST_CSV_PATHS["users"].read_text(encoding="utf-8")
+        # Break the birth date of the user
+        self.bad_content = self.good_content.replace("\t27/03/1811\t", "\t27/03/181\t")
+        self.assertNotEqual(self.good_content, self.bad_content)
+
+    def write_users_file(self, date, content):
+        file_path = self.persistent_dir / "exportusers-afbo-Polytechnique-X-{}.csv".format(date)
+        file_path.write_text(content, encoding="utf-8")
+        return file_path
+
+    def test_problem_then_resolution(self):
+        call_command("importcsv", self.write_users_file("20010203", self.bad_content), verbosity=0)
+        self.assertFalse(Account.objects.filter(af_id=1).exists())
+        problem = ParseProblem.objects.get()
+        self.assertEqual(problem.kind, "users")
+        self.assertEqual(problem.af_id, 1)
+        self.assertEqual(problem.state, ParseProblem.STATE_OPEN)
+        self.assertIn("27/03/181<TAB>", problem.line_tabs)
+        import_log = ImportLog.objects.get(export_kind="users")
+        self.assertIn("nouveau souci pour pas de compte pour af_id=1", import_log.message)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("nouveau(x) pour 1 camarade(s), bilan 1", mail.outbox[0].subject)
+        self.assertIn("souci sur les données users pour l'af_id 1", mail.outbox[0].body)
+
+        # The problem is still there
+        call_command("importcsv", self.write_users_file("20010204", self.bad_content), verbosity=0)
+        self.assertEqual(ParseProblem.objects.filter(state=ParseProblem.STATE_OPEN).count(), 2)
+        self.assertIn("répété(s) pour 1 camarade(s), bilan 1", mail.outbox[1].subject)
+
+        call_command("importcsv", self.write_users_file("20010205", self.good_content), verbosity=0)
+        self.assertTrue(Account.objects.filter(af_id=1).exists())
+        self.assertFalse(ParseProblem.objects.filter(state=ParseProblem.STATE_OPEN).exists())
+        self.assertEqual(ParseProblem.objects.filter(state=ParseProblem.STATE_RESOLVED).count(), 2)
+        fix = ParseProblem.objects.get(state=ParseProblem.STATE_FIX)
+        self.assertEqual(fix.af_id, 1)
+        self.assertIn("27/03/1811<TAB>", fix.line_tabs)
+        import_log = ImportLog.objects.get(export_kind="users", date=datetime.date(2001, 2, 5))
+        self.assertIn("souci résolu pour 'louis.vaneau.1829'", import_log.message)
+        self.assertIn("résolu(s) pour 1 camarade(s), bilan 0", mail.outbox[2].subject)
+        self.assertIn("27/03/1811<TAB>", mail.outbox[2].body)
+
+        # Nothing to report anymore
+        call_command("importcsv", self.write_users_file("20010206", self.good_content), verbosity=0)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(ParseProblem.objects.count(), 3)
+
+    def test_problem_on_some_lines(self):
+        call_command("importcsv", self.write_users_file("20010203", self.good_content), verbosity=0)
+        good_jobs_content = TEST_CSV_PATHS["userjobs"].read_text(encoding="utf-8")
+        bad_jobs_content = good_jobs_content.replace("\tFonction 2\t", "\tFonction\t2\t")
+        self.assertNotEqual(good_jobs_content, bad_jobs_content)
+
+        jobs_path = self.persistent_dir / "exportuserjobs-afbo-Polytechnique-X-20010204.csv"
+        jobs_path.write_text(bad_jobs_content, encoding="utf-8")
+        call_command("importcsv", jobs_path, verbosity=0)
+        problem = ParseProblem.objects.get()
+        self.assertEqual((problem.kind, problem.af_id, problem.line_num), ("userjobs", 1, 2))
+        self.assertEqual(problem.account_label, "'louis.vaneau.1829'")
+
+        jobs_path = self.persistent_dir / "exportuserjobs-afbo-Polytechnique-X-20010205.csv"
+        jobs_path.write_text(good_jobs_content, encoding="utf-8")
+        call_command("importcsv", jobs_path, verbosity=0)
+        # Both lines of the account are recorded as the fix
+        fixes = ParseProblem.objects.filter(state=ParseProblem.STATE_FIX).order_by("line_num")
+        self.assertEqual([fix.line_num for fix in fixes], [1, 2])
+        self.assertIn("\tFonction 2\t", fixes[1].line)
+        import_log = ImportLog.objects.get(export_kind="userjobs", date=datetime.date(2001, 2, 5))
+        self.assertIn("souci résolu pour 'louis.vaneau.1829'", import_log.message)
+
+    def test_problem_then_failure(self):
+        users_path = self.write_users_file("20010203", self.bad_content)
+        groups_path = self.persistent_dir / "exportgroups-afbo-Polytechnique-X-20010203.csv"
+        content = TEST_CSV_PATHS["groups"].read_text(encoding="utf-8")
+        groups_path.write_text(content.replace("Matricule AX", "Identifiant AF", 1), encoding="utf-8")
+        with self.assertRaises(CommandError):
+            call_command("importcsv", users_path, groups_path, verbosity=0)
+
+        # The problem found in the committed users file is still reported
+        self.assertEqual(ParseProblem.objects.get().state, ParseProblem.STATE_OPEN)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("Échec d'importation, Souci(s)", mail.outbox[0].subject)
+        self.assertIn("souci sur les données users pour l'af_id 1", mail.outbox[0].body)
+        self.assertIn("Importé {}".format(users_path.name), mail.outbox[0].body)
+        self.assertIn("Échec : Unable to import groups", mail.outbox[0].body)
+
+    def test_import_problem_files(self):
+        # Write a .rej file like the previous versions of importcsv
+        header, bad_line = self.bad_content.splitlines(keepends=True)[:2]
+        report_items = (
+            ("problems", "[ValueError('day is out of range for month')]"),
+            ("af_id", "1"),
+            ("path", "exportusers-afbo-Polytechnique-X-20010203.csv"),
+            ("header", repr(header.rstrip("\n").split("\t"))),
+            ("line_num", "1"),
+            ("line_hash", hashlib.sha256(bad_line.encode("utf-8")).hexdigest()),
+            ("line", bad_line),
+            ("line_tabs", bad_line.replace("\t", "<TAB>")),
+        )
+        rej_path = self.persistent_dir / "current_problems_by_id" / "users" / "1.rej"
+        rej_path.parent.mkdir(parents=True)
+        rej_path.write_text(
+            "### Soucis de type users concernant le compte pas de compte pour af_id=1\n\n"
+            + "-" * 72
+            + "\n"
+            + "\n".join("{:<10}: {}".format(k, v) for k, v in report_items)
+            + "-" * 72
+            + "\n",
+            encoding="utf-8",
+        )
+
+        call_command("importproblemfiles", verbosity=0)
+        # Running the command again does not record the problems twice
+        call_command("importproblemfiles", verbosity=0)
+        problem = ParseProblem.objects.get()
+        self.assertEqual((problem.kind, problem.af_id, problem.state), ("users", 1, ParseProblem.STATE_OPEN))
+        self.assertEqual(problem.date, datetime.date(2001, 2, 3))
+        self.assertEqual(problem.account_label, "pas de compte pour af_id=1")
+        self.assertEqual(problem.header, header.rstrip("\n"))
+        self.assertEqual(problem.line, bad_line)
+        self.assertEqual(problem.problems, "[ValueError('day is out of range for month')]")
+
+        # The problem is resolved by the next import
+        call_command("importcsv", self.write_users_file("20010204", self.good_content), verbosity=0)
+        self.assertEqual(ParseProblem.objects.get(pk=problem.pk).state, ParseProblem.STATE_RESOLVED)
+        self.assertEqual(ParseProblem.objects.get(state=ParseProblem.STATE_FIX).af_id, 1)
+        self.assertIn("résolu(s) pour 1 camarade(s), bilan 0", mail.outbox[0].subject)
+
+    @override_settings(PARSE_PROBLEMS_FILES_MIRROR=True)
+    def test_problems_files_mirror(self):
+        rej_path = self.persistent_dir / "current_problems_by_id" / "users" / "1.rej"
+
+        call_command("importcsv", self.write_users_file("20010203", self.bad_content), verbosity=0)
+        self.assertTrue(rej_path.exists())
+        self.assertIn("27/03/181<TAB>", rej_path.read_text())
+        new_archives = list((self.persistent_dir / "problem_archive" / "users").glob("1__*__problem_new__*.txt"))
+        self.assertEqual(len(new_archives), 1)
+
+        call_command("importcsv", self.write_users_file("20010204", self.good_content), verbosity=0)
+        self.assertFalse(rej_path.exists())
+        resolved_archives = list((self.persistent_dir / "problem_archive" / "users").glob("1__*__resolved__*.txt"))
+        self.assertEqual(len(resolved_archives), 1)
+        self.assertIn("27/03/1811<TAB>", resolved_archives[0].read_text())
+
+
+class KeptParseReportsTests(SimpleTestCase):
+    """Test which parse reports are kept while parsing a file"""
+
+    def test_append(self):
+        kept_reports = KeptParseReports({2})
+        reports = []
+        for line_num, af_id in enumerate((1, 2, 3, None), 1):
+            report = ParseReport("file.csv", [], line_num)
+            report.af_id = af_id
+            reports.append(report)
+        reports[2].add_problem("bad line")
+        reports[3].add_problem("cannot extract AF_ID")
+        for report in reports:
+            kept_reports.append(report)
+        # The clean line of an account without open problems is dropped
+        self.assertEqual(kept_reports.reports, reports[1:])
+
+
+class RowDecoderTests(SimpleTestCase):
+    """Test the conversion of the cells of CSV rows"""
+
+    def setUp(self):
+        header = (
+            "Identifiant AF",
+            "Titre du poste",
+            "Indicateur téléphone fixe professionnel",
+            "Date de début de l'expérience",
+            "Poste actuel ?",
+        )
+        self.decoder = RowDecoder(header, ALUMNFORCE_USERJOB_FIELDS)
+
+    def test_decode(self):
+        self.assertEqual(
+            self.decoder.decode(["42", "Title", "+33", "01/02/2003", "1"]),
+            {
+                "af_id": 42,
+                "title": "Title",
+                "phone_indicator": 33,
+                "start_date": datetime.date(2003, 2, 1),
+                "current": True,
+            },
+        )
+        # Cached dates are still right
+        self.assertEqual(
+            self.decoder.decode(["1", "", "", "01/02/2003", "0"])["start_date"], datetime.date(2003, 2, 1)
+        )
+        self.assertEqual(self.decoder.decode(["1", "", "", "2/1/2003", "0"])["start_date"], datetime.date(2003, 1, 2))
+
+    def test_decode_empty(self):
+        self.assertEqual(
+            self.decoder.decode(["1", "", "", "", ""]),
+            {"af_id": 1, "title": "", "phone_indicator": None, "start_date": None, "current": None},
+        )
+
+    def test_decode_invalid(self):
+        for row in (
+            ["", "", "", "", ""],
+            ["1", "", "33a", "", ""],
+            ["1", "", "", "01/02/203", ""],
+            ["1", "", "", "31/02/2003", ""],
+            ["1", "", "", "", "2"],
+        ):
+            with self.assertRaises(ValueError):
+                self.decoder.decode(row)
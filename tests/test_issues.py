@@ -0,0 +1,94 @@
+import datetime
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+
+from xorgdata.alumnforce.issues import refresh_account_issues
+from xorgdata.alumnforce.models import Account, AccountIssue
+
+from .test_importcsv import TEST_CSV_PATHS
+from .utils import create_account
+
+
+class AccountIssuesTests(TestCase):
+    def get_issues(self):
+        return sorted(AccountIssue.objects.values_list("account_id", "kind"))
+
+    def test_import_refreshes_issues(self):
+        create_account(1, xorg_id="Louis.Vaneau")
+        refresh_account_issues([1])
+        self.assertEqual(self.get_issues(), [(1, AccountIssue.KIND_XORG_ID)])
+
+        # Importing the account fixes its X.org ID
+        call_command("importcsv", TEST_CSV_PATHS["users"], verbosity=0)
+        self.assertEqual(self.get_issues(), [])
+
+    def test_duplicated_ids(self):
+        create_account(1, xorg_id="louis.vaneau")
+        create_account(2, school_id="42")
+        create_account(3, school_id="42")
+        refresh_account_issues([1, 2, 3])
+        self.assertEqual(
+            self.get_issues(),
+            [(2, AccountIssue.KIND_DUPLICATED_SCHOOL_ID), (3, AccountIssue.KIND_DUPLICATED_SCHOOL_ID)],
+        )
+
+        # Sharing the X.org ID of another account adds issues to both of them
+        Account.objects.filter(af_id=2).update(xorg_id="louis.vaneau")
+        refresh_account_issues([2])
+        self.assertEqual(
+            self.get_issues(),
+            [
+                (1, AccountIssue.KIND_DUPLICATED_XORG_ID),
+                (2, AccountIssue.KIND_DUPLICATED_SCHOOL_ID),
+                (2, AccountIssue.KIND_DUPLICATED_XORG_ID),
+                (3, AccountIssue.KIND_DUPLICATED_SCHOOL_ID),
+            ],
+        )
+        self.assertEqual(
+            AccountIssue.objects.get(account_id=1).message,
+            "Duplicated X.org ID 'louis.vaneau', shared with 2 accounts",
+        )
+
+        # Changing the IDs removes the issues of the other accounts too
+        Account.objects.filter(af_id=2).update(xorg_id="prenom.nom.2", school_id="")
+        refresh_account_issues([2])
+        self.assertEqual(self.get_issues(), [])
+
+        # Deleted accounts do not count
+        Account.objects.filter(af_id=3).update(xorg_id="louis.vaneau")
+        refresh_account_issues([3])
+        self.assertEqual(
+            self.get_issues(), [(1, AccountIssue.KIND_DUPLICATED_XORG_ID), (3, AccountIssue.KIND_DUPLICATED_XORG_ID)]
+        )
+        Account.objects.filter(af_id=3).update(deleted_since=datetime.date(2001, 2, 3))
+        refresh_account_issues([3])
+        self.assertEqual(self.get_issues(), [])
+
+
+class AccountIssuesMigrationTests(TransactionTestCase):
+    """Test that the migration which creates the issues table finds the issues of existing accounts"""
+
+    def migrate(self, migration_name):
+        executor = MigrationExecutor(connection)
+        target = [("alumnforce", migration_name)]
+        executor.migrate(target)
+        return executor.loader.project_state(target).apps
+
+    def test_migration(self):
+        self.addCleanup(call_command, "migrate", verbosity=0)
+        apps = self.migrate("0017_add_exportlog_is_incremental")
+        apps.get_model("alumnforce", "Account").objects.create(
+            af_id=1,
+            xorg_id="Louis.Vaneau",
+            user_kind=Account.KIND_GRADUATED,
+            last_update=datetime.date(2001, 2, 3),
+        )
+
+        apps = self.migrate("0018_add_accountissue_table")
+        self.assertEqual(
+            list(apps.get_model("alumnforce", "AccountIssue").objects.values_list("account_id", "kind")),
+            [(1, AccountIssue.KIND_XORG_ID)],
+        )
@@ -1,11 +1,24 @@
+import datetime
+from unittest import mock
+
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import Client, TestCase
 from django.urls import reverse
+from django.utils.http import http_date
 
+from xorgdata.alumnforce.models import Account, ExportLog, ImportLog, get_latest_logs_by_kind
 from xorgdata.urls import urlpatterns as xorgdata_urlpatterns
 
+from .utils import create_account
+
 
 class ViewTests(TestCase):
+    def setUp(self):
+        # Rolling back the logs of previous tests does not invalidate the cache of the latest logs
+        cache.clear()
+
     # Views which are publicy accessible
     PUBLIC_VIEW_IDS = (
         "index",
@@ -72,3 +85,162 @@ class ViewTests(TestCase):
                 self.assertEqual(400, resp.status_code, "unexpected HTTP response code for URL %s" % url_id)
             else:
                 self.assertEqual(200, resp.status_code, "unexpected HTTP response code for URL %s" % url_id)
+
+
+class IssuesViewTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser(
+            username="superuser",
+            email="superuser@localhost.localdomain",
+            password="A random insecure password",
+        )
+        self.client.login(username="superuser", password="A random insecure password")
+
+    def get_issues(self, **params):
+        call_command("refreshissues", verbosity=0)
+        resp = self.client.get(reverse("issues"), params)
+        self.assertEqual(200, resp.status_code)
+        return {
+            account_and_issues["account"].af_id: account_and_issues["issues"]
+            for account_and_issues in resp.context["issues"]
+        }
+
+    def test_issues(self):
+        create_account(1, additional_roles="4,5")
+        create_account(2, civility="Dr")
+        create_account(3, user_kind=42)
+        create_account(4, additional_roles="4,99")
+        create_account(5, xorg_id="Prenom.Nom")
+        create_account(6, xorg_id=None, user_kind=Account.KIND_STUDENT)
+        create_account(7, email_2="not an address")
+        create_account(8, ax_id="X42")
+        create_account(9, ax_id="X42")
+        create_account(10, xorg_id=None, user_kind=Account.KIND_VISITOR, deleted_since=datetime.date(2001, 2, 3))
+        create_account(11, additional_roles="05")
+        self.assertEqual(
+            self.get_issues(),
+            {
+                2: ["Unknown civility 'Dr'"],
+                3: ["Unknown account kind 42"],
+                4: ["Unknown account role 99"],
+                5: ["Invalid X.org ID: 'Prenom.Nom'"],
+                6: ["Missing X.org ID for student"],
+                7: ["Invalid email address 2 'not an address'"],
+                8: ["Duplicated AX ID 'X42', shared with 2 accounts"],
+                9: ["Duplicated AX ID 'X42', shared with 2 accounts"],
+            },
+        )
+
+    def test_issues_kind(self):
+        create_account(1, civility="Dr", email_1="not an address")
+        create_account(2, email_1="not an address")
+        create_account(3, civility="Dr")
+        self.assertEqual(
+            self.get_issues(kind="email"),
+            {
+                1: ["Invalid email address 1 'not an address'"],
+                2: ["Invalid email address 1 'not an address'"],
+            },
+        )
+        self.assertEqual(sorted(self.get_issues(kind="unknown")), [1, 2, 3])
+
+    @mock.patch("xorgdata.alumnforce.views.ISSUES_PAGE_SIZE", 2)
+    def test_issues_pagination(self):
+        for af_id in range(1, 6):
+            create_account(af_id, civility="Dr")
+        self.assertEqual(sorted(self.get_issues()), [1, 2])
+        self.assertEqual(sorted(self.get_issues(page=3)), [5])
+        resp = self.client.get(reverse("issues"), {"page": 2})
+        self.assertContains(resp, "Accounts (5)")
+        self.assertContains(resp, "Page 2 of 3")
+
+
+class LatestLogsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def create_import_log(self, kind, date, is_incremental=True):
+        return ImportLog.objects.create(
+            date=date,
+            export_kind=kind,
+            is_incremental=is_incremental,
+            error=ImportLog.SUCCESS,
+        )
+
+    def test_latest_logs(self):
+        self.create_import_log("users", datetime.date(2001, 2, 3))
+        users_log = self.create_import_log("users", datetime.date(2001, 2, 4))
+        self.create_import_log("users", datetime.date(2001, 2, 4), is_incremental=False)
+        groups_log = self.create_import_log("groups", datetime.date(2001, 2, 3))
+        self.create_import_log("groups", datetime.date(2001, 2, 3))
+        groups_log_2 = ImportLog.objects.latest("pk")
+
+        with self.assertNumQueries(1):
+            latest_logs = get_latest_logs_by_kind(ImportLog)
+        self.assertEqual(latest_logs, {"users": users_log, "groups": groups_log_2})
+        self.assertNotEqual(groups_log, groups_log_2)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_latest_logs_by_kind(ImportLog), latest_logs)
+        self.assertEqual(get_latest_logs_by_kind(ExportLog), {})
+
+        # Writing a log invalidates the cache, once the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            new_users_log = self.create_import_log("users", datetime.date(2001, 2, 5))
+            self.assertEqual(get_latest_logs_by_kind(ImportLog)["users"], users_log)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(get_latest_logs_by_kind(ImportLog)["users"], new_users_log)
+        with self.captureOnCommitCallbacks(execute=True):
+            new_users_log.delete()
+        self.assertEqual(get_latest_logs_by_kind(ImportLog)["users"], users_log)
+
+        # Nothing is invalidated when the transaction is rolled back
+        with self.captureOnCommitCallbacks(execute=False):
+            self.create_import_log("users", datetime.date(2001, 2, 6))
+        self.assertEqual(get_latest_logs_by_kind(ImportLog)["users"], users_log)
+
+    def test_summary_view(self):
+        self.create_import_log("users", datetime.date(2001, 2, 3))
+        self.create_import_log("groups", datetime.date(2001, 2, 4))
+        ExportLog.objects.create(date=datetime.date(2001, 2, 5), export_kind=ExportLog.KIND_AUTH, error=0)
+        with self.assertNumQueries(2):
+            resp = self.client.get(reverse("index"))
+        self.assertEqual(
+            [log.export_kind for log in resp.context["last_imp_logs_by_kind"]],
+            ["users", "groups"],
+        )
+        self.assertEqual(len(resp.context["last_exp_logs_by_kind"]), 1)
+        # The rendered page is cached too
+        with self.assertNumQueries(0):
+            resp_cached = self.client.get(reverse("index"))
+        self.assertEqual(resp_cached.content, resp.content)
+
+    def test_summary_view_conditional_get(self):
+        self.create_import_log("users", datetime.date(2001, 2, 3))
+        resp = self.client.get(reverse("index"))
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("Last-Modified", resp)
+
+        # Probes which already got the page do not touch the database
+        with self.assertNumQueries(0):
+            resp_not_modified = self.client.get(reverse("index"), HTTP_IF_NONE_MATCH=resp["ETag"])
+        self.assertEqual(resp_not_modified.status_code, 304)
+
+        # A new log changes the page
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_import_log("groups", datetime.date(2001, 2, 3))
+        resp_modified = self.client.get(reverse("index"), HTTP_IF_NONE_MATCH=resp["ETag"])
+        self.assertEqual(resp_modified.status_code, 200)
+        self.assertNotEqual(resp_modified["ETag"], resp["ETag"])
+        self.assertContains(resp_modified, "groups")
+
+    def test_summary_view_if_modified_since(self):
+        """Dates of logs cannot tell whether the summary changed since a given time"""
+        self.create_import_log("users", datetime.date(2001, 2, 3))
+        self.client.get(reverse("index"))
+        if_modified_since = http_date()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ExportLog.objects.create(date=datetime.date.today(), export_kind=ExportLog.KIND_AUTH, error=0)
+        resp = self.client.get(reverse("index"), HTTP_IF_MODIFIED_SINCE=if_modified_since)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.context["last_exp_logs_by_kind"]), 1)
@@ -0,0 +1,16 @@
+import datetime
+
+from xorgdata.alumnforce.models import Account
+
+
+def create_account(af_id, **kwargs):
+    """Create a valid account, whose fields can be overridden"""
+    values = {
+        "af_id": af_id,
+        "xorg_id": "prenom.nom.{}".format(af_id),
+        "user_kind": Account.KIND_GRADUATED,
+        "email_1": "prenom.nom.{}@example.org".format(af_id),
+        "last_update": datetime.date(2001, 2, 3),
+    }
+    values.update(kwargs)
+    return Account.objects.create(**values)
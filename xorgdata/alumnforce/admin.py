@@ -2,12 +2,17 @@
 # Copyright (c) Polytechnique.org
 # This code is distributed under the Affero General Public License version 3
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
 from django.db.models import Count, Q
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
 from . import models
+from .issues import refresh_account_issues
 
 
 class AcademicInformationInline(admin.StackedInline):
@@ -26,6 +31,10 @@ class GroupMembershipInline(admin.TabularInline):
     readonly_fields = ("link_account", "link_group")
     fields = ("link_account", "link_group", "role")
 
+    def get_queryset(self, request):
+        # Fetch the account and the group of each membership along with it, for the links
+        return super().get_queryset(request).select_related("account", "group")
+
     def link_account(self, obj):
         obj_url = reverse(
             "admin:%s_%s_change" % (obj.account._meta.app_label, obj.account._meta.model_name),
@@ -44,12 +53,38 @@ class GroupMembershipInline(admin.TabularInline):
     link_group.short_description = _("group")
 
 
+class EstimatedCountPaginator(Paginator):
+    """Paginator which estimates the number of objects of a whole table on PostgreSQL
+
+    Counting all the rows of a large table is slow on PostgreSQL, so use the
+    estimate maintained by its statistics when the queryset is not filtered.
+    """
+
+    # Tables which are estimated to have fewer rows than this are counted exactly
+    MIN_ESTIMATED_COUNT = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if connection.vendor == "postgresql" and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= self.MIN_ESTIMATED_COUNT:
+                return int(row[0])
+        return super().count
+
+
 @admin.register(models.Account)
 class AccountAdmin(admin.ModelAdmin):
-    search_fields = ("ax_id", "xorg_id", "first_name", "last_name", "common_name")
+    # The search uses search_name, which contains these fields
+    search_fields = models.Account.SEARCHED_FIELDS
+    search_help_text = _("Search IDs and names, ignoring accents")
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     list_display = ("af_id", "ax_id", "xorg_id", "first_name", "last_name", "deleted_since")
     list_display_links = ("af_id", "ax_id", "xorg_id", "first_name", "last_name")
-    readonly_fields = ("kind_desc", "roles_desc", "alumnforce_profile_url")
+    readonly_fields = ("kind_desc", "roles_desc", "alumnforce_profile_url", "import_digest")
     ordering = ("-ax_id", "xorg_id", "af_id")
 
     inlines = [
@@ -58,6 +93,20 @@ class AccountAdmin(admin.ModelAdmin):
         GroupMembershipInline,
     ]
 
+    def save_model(self, request, obj, form, change):
+        # Make the next import of the account overwrite manual changes
+        obj.import_digest = ""
+        # Make the next incremental export push the changes
+        obj.imported_at = timezone.now()
+        super().save_model(request, obj, form, change)
+        refresh_account_issues([obj.af_id])
+
+    def get_search_results(self, request, queryset, search_term):
+        """Find the accounts whose IDs or names contain every word of the search"""
+        for word in models.normalize_search_text(search_term).split():
+            queryset = queryset.filter(search_name__contains=word)
+        return queryset, False
+
     def kind_desc(self, obj):
         """Get the description of account kind"""
         return "{} [{}]".format(models.Account.KINDS.get(obj.user_kind, "?"), obj.user_kind)
@@ -113,5 +162,12 @@ class ImportLogAdmin(admin.ModelAdmin):
 
 @admin.register(models.ExportLog)
 class ExportLogAdmin(admin.ModelAdmin):
-    list_display = ("date", "export_kind", "error", "num_items", "message")
+    list_display = ("date", "export_kind", "is_incremental", "error", "num_items", "message")
     ordering = ("-date", "export_kind")
+
+
+@admin.register(models.ParseProblem)
+class ParseProblemAdmin(admin.ModelAdmin):
+    list_display = ("date", "kind", "af_id", "state", "account_label", "file_name", "line_num", "problems")
+    list_filter = ("kind", "state")
+    ordering = ("-date", "kind", "af_id")
@@ -25,6 +25,7 @@ Examples:
 """
 
 import argparse
+import io
 import sys
 
 from lib.converters import AlumnForceDataC2J
@@ -44,15 +45,17 @@ def main():
     args = parser.parse_args()
 
     if args.file:
-        data = AlumnForceDataC2J.import_csv_file(args.file, args.keep_empty)
+        rows = AlumnForceDataC2J.iter_csv_file(args.file, args.keep_empty)
     else:
-        data = AlumnForceDataC2J.import_csv_stream(sys.stdin.buffer, args.keep_empty)
+        csv_stream = io.TextIOWrapper(sys.stdin.buffer, encoding="iso-8859-15")
+        rows = AlumnForceDataC2J().iter_csv_rows(csv_stream, args.keep_empty)
 
+    # Write the rows while they are read, without keeping the whole file in memory
     if args.output and args.output != "-":
         with open(args.output, "w") as fjson:
-            data.json_dump(fjson, indent=2, ensure_ascii=not args.utf8)
+            AlumnForceDataC2J.json_dump_rows(rows, fjson, indent=2, ensure_ascii=not args.utf8)
     else:
-        data.json_dump(sys.stdout, indent=2, ensure_ascii=not args.utf8)
+        AlumnForceDataC2J.json_dump_rows(rows, sys.stdout, indent=2, ensure_ascii=not args.utf8)
 
 
 if __name__ == "__main__":
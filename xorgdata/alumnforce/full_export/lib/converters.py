@@ -1,5 +1,4 @@
 # -*- coding:UTF-8 -*-
-import collections
 import csv
 import json
 
@@ -17,6 +16,8 @@ class AlumnForceDataC2J(object):
 
     def __init__(self):
         self.fields = None
+        self.directory_plan = None
+        self.decode_plan = None
         self.content = []
 
     @classmethod
@@ -29,17 +30,30 @@ class AlumnForceDataC2J(object):
     def import_csv_stream(cls, csv_file, keep_empty=False):
         """Create AlumnForce data from a CSV stream"""
         data = cls()
+        data.content = list(data.iter_csv_rows(csv_file, keep_empty))
+        return data
+
+    @classmethod
+    def iter_csv_file(cls, csv_file_path, keep_empty=False):
+        """Decode the rows of a CSV file one at a time, without keeping them in memory
+
+        The header of the file is validated before the first row is decoded.
+        """
+        with open(csv_file_path, "r", encoding="iso-8859-15") as csv_stream:
+            yield from cls().iter_csv_rows(csv_stream, keep_empty)
+
+    def iter_csv_rows(self, csv_file, keep_empty=False):
+        """Define the data fields from the header of a CSV stream, then decode its rows one at a time"""
         reader = csv.reader(csv_file, delimiter=",", quotechar='"', escapechar="\\", strict=True)
         for row in reader:
             if reader.line_num == 1:
-                data.set_fields_from_csv(row)
+                self.set_fields_from_csv(row)
                 continue
-            data.content.append(data.decode_csv_row(row, keep_empty))
-        return data
+            yield self.decode_csv_row(row, keep_empty)
 
     def set_fields_from_csv(self, csv_header):
-        """Define the data fields from the given CSV header"""
-        self.fields = collections.OrderedDict()
+        """Define the data fields from the given CSV header, and compile the plan to decode the rows"""
+        self.fields = {}
         for csv_field_name in csv_header:
             if csv_field_name not in CSV_TO_JSON_FIELDS:
                 raise ValueError("Unknown CSV field %r" % csv_field_name)
@@ -48,6 +62,20 @@ class AlumnForceDataC2J(object):
                 raise ValueError("Duplicate field %r (for %r)" % (field_name, csv_field_name))
             self.fields[field_name] = field_type
 
+        # Split the name parts once: the decoded rows contain nested directories, whose
+        # (parent index, name) are listed in directory_plan, the root directory having index 0.
+        # decode_plan holds (field name, field type, directory index, key) for every column.
+        directory_indexes = {(): 0}
+        self.directory_plan = [None]
+        self.decode_plan = []
+        for field_name, field_type in self.fields.items():
+            *path, key = field_name.split(".")
+            for depth in range(1, len(path) + 1):
+                if tuple(path[:depth]) not in directory_indexes:
+                    directory_indexes[tuple(path[:depth])] = len(self.directory_plan)
+                    self.directory_plan.append((directory_indexes[tuple(path[: depth - 1])], path[depth - 1]))
+            self.decode_plan.append((field_name, field_type, directory_indexes[tuple(path)], key))
+
     def decode_csv_row(self, csv_row, keep_empty):
         """Decode a row of the CSV file"""
         if len(csv_row) != len(self.fields):
@@ -55,34 +83,63 @@ class AlumnForceDataC2J(object):
                 "CSV row of length %d not the length of fields (%d): %r" % (len(csv_row), len(self.fields), csv_row)
             )
 
-        data_row = collections.OrderedDict()
-        for field_name_type, value in zip(self.fields.items(), csv_row):
-            field_name, field_type = field_name_type
+        data_row = {}
+        # Directories are created when their first value is set, like when building the data by hand
+        directories = [data_row] + [None] * (len(self.directory_plan) - 1)
+        for (field_name, field_type, directory_index, key), value in zip(self.decode_plan, csv_row):
             if not keep_empty and value == "":
                 continue
 
             # Convert the value to the field type
-            if field_type is None:
-                pass
-            else:
+            if field_type is not None:
                 try:
                     value = field_type.decode(value)
                 except ValueError:
                     raise ValueError("Incompatible value for field %r (%r): %r" % (field_name, field_type, value))
 
-            # Decode name parts
-            data_directory = data_row
-            while "." in field_name:
-                dir_name, field_name = field_name.split(".", 1)
-                if dir_name not in data_directory:
-                    data_directory[dir_name] = collections.OrderedDict()
-                data_directory = data_directory[dir_name]
-            data_directory[field_name] = value
+            data_directory = directories[directory_index]
+            if data_directory is None:
+                data_directory = self.create_directory(directories, directory_index)
+            data_directory[key] = value
         return data_row
 
+    def create_directory(self, directories, directory_index):
+        """Create a directory of a decoded row, and its parents if needed"""
+        parent_index, name = self.directory_plan[directory_index]
+        parent_directory = directories[parent_index]
+        if parent_directory is None:
+            parent_directory = self.create_directory(directories, parent_index)
+        data_directory = directories[directory_index] = {}
+        parent_directory[name] = data_directory
+        return data_directory
+
     def json_dump(self, fp, **kwargs):
         """Dump all the JSON data"""
-        json.dump(self.content, fp, **kwargs)
+        self.json_dump_rows(self.content, fp, **kwargs)
+
+    @staticmethod
+    def json_dump_rows(rows, fp, indent=None, **kwargs):
+        """Dump rows as a JSON list, writing them one at a time
+
+        The output is the same as json.dump(list(rows), fp, indent=indent, **kwargs).
+        """
+        if indent is None:
+            separator = ", "
+            row_prefix = ""
+            list_end = "]"
+        else:
+            row_prefix = "\n" + (" " * indent if isinstance(indent, int) else indent)
+            separator = ","
+            list_end = "\n]"
+        fp.write("[")
+        is_empty = True
+        for row in rows:
+            if not is_empty:
+                fp.write(separator)
+            is_empty = False
+            # JSON strings escape new lines, so every new line of the dumped row is indented
+            fp.write(row_prefix + json.dumps(row, indent=indent, **kwargs).replace("\n", row_prefix))
+        fp.write("]" if is_empty else list_end)
 
 
 class AlumnForceDataJ2C(object):
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Find the data-quality issues of accounts and keep the AccountIssue table up to date"""
+
+import re
+
+from django.db.models import Count, Q
+
+from xorgdata.alumnforce import models
+
+# Simple regular expression used to verify email addresses
+EMAIL_REGEXP = r"^[a-zA-Z0-9._+-]+@[a-zA-Z0-9.-]+$"
+EMAIL_RE = re.compile(EMAIL_REGEXP)
+
+# Regular expression matching a character which is not allowed in X.org IDs
+INVALID_XORG_ID_REGEXP = r"[^a-z0-9.-]"
+INVALID_XORG_ID_RE = re.compile(INVALID_XORG_ID_REGEXP)
+
+# Regular expression matching a comma-separated list of known account roles
+KNOWN_ROLES_REGEXP = r"^(({0})(,({0}))*)?$".format("|".join(str(role) for role in sorted(models.Account.ROLES)))
+
+# IDs which must not be shared by several accounts: (field, empty value, issue kind, description)
+UNIQUE_ID_FIELDS = (
+    ("ax_id", None, models.AccountIssue.KIND_DUPLICATED_AX_ID, "AX ID"),
+    ("xorg_id", None, models.AccountIssue.KIND_DUPLICATED_XORG_ID, "X.org ID"),
+    ("school_id", "", models.AccountIssue.KIND_DUPLICATED_SCHOOL_ID, "school ID"),
+)
+
+# Fields of the accounts which are used to find their issues
+CHECKED_FIELDS = ("af_id", "civility", "user_kind", "additional_roles", "xorg_id", "email_1", "email_2")
+
+# Number of accounts whose issues are refreshed at once
+REFRESH_BATCH_SIZE = 1000
+
+
+def find_account_issues(account):
+    """Find issues in an account, excluding duplicated IDs, as a list of (kind, message)"""
+    account_issues = []
+
+    if account.civility not in ("", "Mme", "M"):
+        account_issues.append(
+            (models.AccountIssue.KIND_CIVILITY, "Unknown civility {}".format(repr(account.civility)))
+        )
+
+    if account.user_kind not in models.Account.KINDS:
+        account_issues.append(
+            (models.AccountIssue.KIND_USER_KIND, "Unknown account kind {}".format(account.user_kind))
+        )
+
+    try:
+        account_roles = models.Account.parse_additional_roles(account.additional_roles)
+    except ValueError:
+        account_issues.append(
+            (
+                models.AccountIssue.KIND_ROLES,
+                "Invalid additional roles value {}".format(repr(account.additional_roles)),
+            )
+        )
+    else:
+        for role in account_roles:
+            if role not in models.Account.ROLES:
+                account_issues.append((models.AccountIssue.KIND_ROLES, "Unknown account role {}".format(role)))
+
+    if account.xorg_id:
+        # Verify the format of X.org ID
+        if INVALID_XORG_ID_RE.search(account.xorg_id):
+            account_issues.append(
+                (models.AccountIssue.KIND_XORG_ID, "Invalid X.org ID: {}".format(repr(account.xorg_id)))
+            )
+    else:
+        # Check whether the user should have a X.org ID
+        if account.user_kind == models.Account.KIND_GRADUATED:
+            account_issues.append((models.AccountIssue.KIND_MISSING_XORG_ID, "Missing X.org ID for graduated"))
+        elif account.user_kind == models.Account.KIND_STUDENT:
+            account_issues.append((models.AccountIssue.KIND_MISSING_XORG_ID, "Missing X.org ID for student"))
+
+    # Verify email addresses against a simple regular expression
+    if account.email_1 and not EMAIL_RE.match(account.email_1):
+        account_issues.append(
+            (models.AccountIssue.KIND_EMAIL, "Invalid email address 1 {}".format(repr(account.email_1)))
+        )
+    if account.email_2 and not EMAIL_RE.match(account.email_2):
+        account_issues.append(
+            (models.AccountIssue.KIND_EMAIL, "Invalid email address 2 {}".format(repr(account.email_2)))
+        )
+    return account_issues
+
+
+def may_have_issues_filter():
+    """Build a filter of the accounts for which find_account_issues() may find something
+
+    This is a superset of the checks of find_account_issues(), which lets the
+    database skip most of the accounts.
+    """
+    kinds_with_xorg_id = (models.Account.KIND_GRADUATED, models.Account.KIND_STUDENT)
+    return (
+        ~Q(civility__in=("", "Mme", "M"))
+        | ~Q(user_kind__in=models.Account.KINDS)
+        | ~Q(additional_roles__regex=KNOWN_ROLES_REGEXP)
+        | Q(xorg_id__regex=INVALID_XORG_ID_REGEXP)
+        | Q(xorg_id=None, user_kind__in=kinds_with_xorg_id)
+        | (~Q(email_1="") & ~Q(email_1__regex=EMAIL_REGEXP))
+        | (~Q(email_2="") & ~Q(email_2__regex=EMAIL_REGEXP))
+    )
+
+
+def get_duplicated_values(field, empty_value, account_model=models.Account):
+    """Get a queryset of the values of a field which are shared by several accounts, with their count"""
+    return (
+        account_model.objects.filter(deleted_since=None)
+        .exclude(**{field: empty_value})
+        .values(field)
+        .annotate(count=Count("af_id"))
+        .filter(count__gt=1)
+    )
+
+
+def refresh_account_issues(af_ids, account_model=models.Account, issue_model=models.AccountIssue):
+    """Update the issues of the given accounts, and of the accounts which share (or shared) an ID with them
+
+    The models can be replaced by the historical models of a migration.
+    """
+    af_ids = list(af_ids)
+    for offset in range(0, len(af_ids), REFRESH_BATCH_SIZE):
+        _refresh_account_issues_batch(af_ids[offset : offset + REFRESH_BATCH_SIZE], account_model, issue_model)
+
+
+def rebuild_account_issues(account_model=models.Account, issue_model=models.AccountIssue):
+    """Compute again the issues of all the accounts"""
+    issue_model.objects.all().delete()
+    refresh_account_issues(
+        account_model.objects.filter(deleted_since=None).order_by("af_id").values_list("af_id", flat=True),
+        account_model,
+        issue_model,
+    )
+
+
+def _refresh_account_issues_batch(af_ids, account_model, issue_model):
+    active_accounts_qs = account_model.objects.filter(af_id__in=af_ids, deleted_since=None)
+    new_issues = []
+    for account in active_accounts_qs.filter(may_have_issues_filter()).only(*CHECKED_FIELDS):
+        for kind, message in find_account_issues(account):
+            new_issues.append(issue_model(account_id=account.af_id, kind=kind, message=message))
+
+    # The duplicated IDs which need to be checked again are the current IDs of
+    # the accounts and the previous ones, which were recorded in their issues
+    checked_ids_by_kind = {}
+    for field, empty_value, kind, _description in UNIQUE_ID_FIELDS:
+        checked_ids = set(
+            issue_model.objects.filter(account_id__in=af_ids, kind=kind).values_list("duplicated_value", flat=True)
+        )
+        checked_ids.update(active_accounts_qs.exclude(**{field: empty_value}).values_list(field, flat=True))
+        checked_ids_by_kind[kind] = checked_ids
+
+    issue_model.objects.filter(account_id__in=af_ids).delete()
+    for field, empty_value, kind, description in UNIQUE_ID_FIELDS:
+        checked_ids = checked_ids_by_kind[kind]
+        if not checked_ids:
+            continue
+        issue_model.objects.filter(kind=kind, duplicated_value__in=checked_ids).delete()
+        duplicates_count = dict(
+            get_duplicated_values(field, empty_value, account_model)
+            .filter(**{field + "__in": checked_ids})
+            .values_list(field, "count")
+        )
+        if not duplicates_count:
+            continue
+        duplicated_accounts_qs = account_model.objects.filter(
+            deleted_since=None, **{field + "__in": duplicates_count.keys()}
+        )
+        for af_id, value in duplicated_accounts_qs.values_list("af_id", field):
+            new_issues.append(
+                issue_model(
+                    account_id=af_id,
+                    kind=kind,
+                    message="Duplicated {} {}, shared with {} accounts".format(
+                        description, repr(value), duplicates_count[value]
+                    ),
+                    duplicated_value=value,
+                )
+            )
+    issue_model.objects.bulk_create(new_issues)
@@ -2,7 +2,12 @@
 import collections
 import datetime
 import ftplib
+import hashlib
+import json
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from django.conf import settings
@@ -16,32 +21,60 @@ def get_last_update_by_kind():
     """Retrieve from the database the last date the data has been updated and
     whether it was incremental
     """
+    latest_logs = models.get_latest_logs_by_kind(models.ImportLog)
     last_update_dates = collections.OrderedDict()
     for kind, _kind_name in models.ImportLog.KNOWN_EXPORT_KINDS:
-        qs = models.ImportLog.objects.filter(export_kind=kind).order_by("-date", "-is_incremental")
-        try:
-            last_obj = qs[:1].get()
-        except models.ImportLog.DoesNotExist:
+        last_obj = latest_logs.get(kind)
+        if last_obj is None:
             last_update_dates[kind] = None
         else:
             last_update_dates[kind] = (last_obj.date, last_obj.is_incremental)
     return last_update_dates
 
 
+# Number of times the transfer of a file is attempted, resuming it after an interruption
+MAX_DOWNLOAD_ATTEMPTS = 5
+
+
+class DownloadError(Exception):
+    """A file could not be downloaded completely"""
+
+
+def compute_sha256(file_path):
+    """Compute the SHA-256 digest of a file, without loading it in memory"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 class FtpConnection:
-    """FTP connection to AlumnForce's FTP server"""
+    """FTP connection to AlumnForce's FTP server, which writes its warnings to stdout"""
 
-    def __init__(self):
-        # Connect to the FTPS server
+    def __init__(self, stdout, list_files=True):
+        self.stdout = stdout
+        self.connect()
+
+        # List the available files by kind->date->(is_ok, filename)
+        self.ftp_files = {kind: {} for kind, _kind_name in models.ImportLog.KNOWN_EXPORT_KINDS}
+        if list_files:
+            self.ftps.dir(self._dir_callback)
+
+    def connect(self):
+        """Connect to the FTPS server"""
         self.ftps = ftplib.FTP_TLS(settings.ALUMNFORCE_FTP_HOST)
         self.ftps.login(settings.ALUMNFORCE_FTP_USER, settings.ALUMNFORCE_FTP_PASSWORD)
         self.ftps.prot_p()
         if settings.ALUMNFORCE_FTP_REMOTE_DIRECTORY:
             self.ftps.cwd(settings.ALUMNFORCE_FTP_REMOTE_DIRECTORY)
 
-        # List the available files by kind->date->(is_ok, filename)
-        self.ftp_files = {kind: {} for kind, _kind_name in models.ImportLog.KNOWN_EXPORT_KINDS}
-        self.ftps.dir(self._dir_callback)
+    def close(self):
+        """Close the connection, ignoring errors as nothing remains to be done with it"""
+        try:
+            self.ftps.quit()
+        except (OSError, EOFError, ftplib.Error):
+            self.ftps.close()
 
     def _dir_callback(self, line):
         """Callback for a dir command of a FTP client"""
@@ -53,7 +86,7 @@ class FtpConnection:
             return
         filename, kind, date, error = matches.groups()
         if kind not in self.ftp_files:
-            print("Warning: unknown kind {} for file {}".format(repr(kind), repr(filename)))
+            self.stdout.write("Warning: unknown kind {} for file {}".format(repr(kind), repr(filename)))
             return
         if date in self.ftp_files[kind]:
             # If there is a .error file, overwrite the entry. Otherwise, skip it
@@ -62,10 +95,133 @@ class FtpConnection:
 
         self.ftp_files[kind][date] = (filename, not error)
 
+    def get_remote_size(self, filename):
+        """Get the size of a file on the server, or None if the server does not tell it"""
+        self.ftps.voidcmd("TYPE I")
+        try:
+            return self.ftps.size(filename)
+        except ftplib.error_perm:
+            pass
+        # Fall back to a machine-readable listing if SIZE is not supported
+        try:
+            for name, facts in self.ftps.mlsd(facts=["size"]):
+                if name == filename and "size" in facts:
+                    return int(facts["size"])
+        except ftplib.error_perm:
+            pass
+        return None
+
     def download_file(self, filename, out_path):
-        """Download a file to the given output path"""
-        with open(out_path, "wb") as fout:
-            self.ftps.retrbinary("RETR " + filename, fout.write)
+        """Download a file to the given output path, and return its size and its SHA-256 digest
+
+        The data is written to a temporary .part file, and an interrupted transfer is
+        resumed from where it stopped. The file is only renamed to out_path once its size
+        matches the size announced by the server, so out_path never holds a partial file.
+        """
+        out_path = Path(out_path)
+        part_path = out_path.with_name(out_path.name + ".part")
+        remote_size = self.get_remote_size(filename)
+        for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+            offset = part_path.stat().st_size if part_path.exists() else 0
+            if remote_size is not None and offset > remote_size:
+                # The file changed on the server, start again
+                offset = 0
+            try:
+                with open(part_path, "ab" if offset else "wb") as fout:
+                    if remote_size is None or offset < remote_size:
+                        self.ftps.retrbinary("RETR " + filename, fout.write, rest=offset or None)
+            except (OSError, EOFError, ftplib.error_temp) as exc:
+                if attempt == MAX_DOWNLOAD_ATTEMPTS:
+                    raise DownloadError("Unable to download {}: {}".format(repr(filename), exc))
+                self.stdout.write("Warning: transfer of {} interrupted ({}), resuming".format(repr(filename), exc))
+                self.close()
+                self.connect()
+                continue
+            break
+
+        size = part_path.stat().st_size
+        if remote_size is not None and size != remote_size:
+            part_path.unlink()
+            raise DownloadError(
+                "Size mismatch for {}: {} bytes were downloaded, the server announced {}".format(
+                    repr(filename), size, remote_size
+                )
+            )
+        digest = compute_sha256(part_path)
+        os.replace(part_path, out_path)
+        return size, digest
+
+
+class DownloadManifest:
+    """Record of the size and digest of the files which have been downloaded"""
+
+    FILE_NAME = "manifest.json"
+
+    def __init__(self, directory):
+        self.path = Path(directory) / self.FILE_NAME
+        try:
+            with open(self.path, "r") as fin:
+                self.files = json.load(fin)
+        except FileNotFoundError:
+            self.files = {}
+
+    def is_complete(self, file_path):
+        """Tell whether a local file matches the download which was recorded for it"""
+        entry = self.files.get(file_path.name)
+        if entry is None or file_path.stat().st_size != entry["size"]:
+            return False
+        return compute_sha256(file_path) == entry["sha256"]
+
+    def record(self, filename, size, sha256):
+        self.files[filename] = {
+            "size": size,
+            "sha256": sha256,
+            "downloaded": datetime.datetime.now(datetime.UTC).isoformat(),
+        }
+        # Write the manifest atomically
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as fout:
+            json.dump(self.files, fout, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class DownloadPool:
+    """Download files in background threads, each one using its own FTPS connection
+
+    Files are downloaded in the order they are submitted, so that the first files to be
+    imported are the first ones to be available.
+    """
+
+    def __init__(self, num_workers, stdout):
+        self.stdout = stdout
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="afsync-download")
+        self.thread_data = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _download(self, filename, out_path):
+        conn = getattr(self.thread_data, "conn", None)
+        if conn is None:
+            conn = self.thread_data.conn = FtpConnection(self.stdout, list_files=False)
+            with self.connections_lock:
+                self.connections.append(conn)
+        return conn.download_file(filename, out_path)
+
+    def submit(self, filename, out_path):
+        """Start downloading a file and return a future of its size and digest"""
+        return self.executor.submit(self._download, filename, out_path)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
 
 
 class Command(BaseCommand):
@@ -96,14 +252,15 @@ class Command(BaseCommand):
             raise CommandError("XORGDATA_ALUMNFORCE_FTP_PASSWORD is not defined")
 
         # Connect to the FTPS server
-        conn = FtpConnection()
+        conn = FtpConnection(self.stdout)
         if options["verbose"]:
             self.stdout.write(self.style.SUCCESS("Connected to ftps://{}".format(settings.ALUMNFORCE_FTP_HOST)))
 
         download_dir_path = Path(settings.ALUMNFORCE_FTP_LOCAL_DIRECTORY)
         download_dir_path.mkdir(parents=True, exist_ok=True)
 
-        # Check for updates, for each kind
+        # Find the files to apply, for each kind, sorting them by date
+        pending_files = []
         for kind, lastup_data in last_update_dates.items():
             if lastup_data is None:
                 last_update_date = None
@@ -112,7 +269,6 @@ class Command(BaseCommand):
                 last_update_date = lastup_data[0].strftime("%Y%m%d")
                 last_was_incremental = lastup_data[1]
 
-            # Apply all possible files, sorting them by date
             for date_str, filename_expok in sorted(conn.ftp_files[kind].items()):
                 filename, is_export_ok = filename_expok
                 if last_update_date is not None:
@@ -123,30 +279,49 @@ class Command(BaseCommand):
                     # incremental update twice.
                     if date_str == last_update_date and last_was_incremental:
                         continue
+                pending_files.append((kind, date_str, filename, is_export_ok))
+        conn.close()
 
-                file_date = datetime.date(year=int(date_str[:4]), month=int(date_str[4:6]), day=int(date_str[6:]))
-
-                if options["verbose"]:
-                    self.stdout.write(self.style.SUCCESS("Downloading {}".format(filename)))
-
+        manifest = DownloadManifest(download_dir_path)
+        with DownloadPool(settings.ALUMNFORCE_FTP_DOWNLOAD_WORKERS, self.stdout) as download_pool:
+            # Start all downloads, which run ahead of the imports
+            downloads = []
+            for kind, date_str, filename, is_export_ok in pending_files:
                 dl_filepath = download_dir_path / filename
-
-                if dl_filepath.exists():
+                if dl_filepath.exists() and manifest.is_complete(dl_filepath):
+                    if options["verbose"]:
+                        self.stdout.write(self.style.SUCCESS("Already downloaded {}".format(filename)))
+                    download = None
+                elif dl_filepath.exists() and filename not in manifest.files:
+                    # Files downloaded before the manifest existed
                     self.stdout.write(self.style.WARNING("NOT downloading (file exists locally) {}".format(filename)))
+                    download = None
                 else:
-                    conn.download_file(filename, dl_filepath)
+                    if options["verbose"]:
+                        self.stdout.write(self.style.SUCCESS("Downloading {}".format(filename)))
+                    download = download_pool.submit(filename, dl_filepath)
+                downloads.append(download)
+
+            # Check the files in order, as soon as they are downloaded
+            files_to_import = []
+            error_files = []
+            for pending_file, download in zip(pending_files, downloads):
+                kind, date_str, filename, is_export_ok = pending_file
+                if download is not None:
+                    try:
+                        size, sha256 = download.result()
+                    except DownloadError as exc:
+                        raise CommandError(str(exc))
+                    manifest.record(filename, size, sha256)
+
+                file_date = datetime.date(year=int(date_str[:4]), month=int(date_str[4:6]), day=int(date_str[6:]))
+                dl_filepath = download_dir_path / filename
 
-                # If there was an error, log it and continue
+                # If there was an error, log it once the files are imported, and continue
                 if not is_export_ok:
                     self.stdout.write(self.style.WARNING("AlumnForce export error found: {}".format(repr(filename))))
                     if not is_dryrun:
-                        models.ImportLog.objects.create(
-                            date=file_date,
-                            export_kind=kind,
-                            is_incremental=True,
-                            error=models.ImportLog.ALUMNFORCE_ERROR,
-                            message="error file found: {}".format(repr(filename)),
-                        )
+                        error_files.append((kind, file_date, filename))
                     continue
 
                 if is_dryrun:
@@ -158,11 +333,28 @@ class Command(BaseCommand):
 
                 if options["verbose"]:
                     self.stdout.write(self.style.SUCCESS("Applying {}".format(dl_filepath)))
-                    call_command("importcsv", dl_filepath, kind=kind)
-                else:
-                    call_command("importcsv", dl_filepath, kind=kind, verbosity=0)
-
+                files_to_import.append(dl_filepath)
                 # dl_filepath.unlink() # we keep an archive of all files downloaded
 
+        if files_to_import:
+            # Import all files at once, in order to get a single report. importcsv sorts
+            # them by kind and date, and imports each one in its own transaction.
+            if options["verbose"]:
+                call_command("importcsv", *files_to_import)
+            else:
+                call_command("importcsv", *files_to_import, verbosity=0)
+
+        # The error logs move the last update of their kind forward, so they are only written
+        # when importcsv succeeded. Otherwise, a file which failed to import would be skipped
+        # by the next synchronisation, if an error file of the same kind has a later date.
+        for kind, file_date, filename in error_files:
+            models.ImportLog.objects.create(
+                date=file_date,
+                export_kind=kind,
+                is_incremental=True,
+                error=models.ImportLog.ALUMNFORCE_ERROR,
+                message="error file found: {}".format(repr(filename)),
+            )
+
         if options["push_export"]:
             call_command("exportforauth", push=True)
@@ -1,13 +1,170 @@
+import collections
 import datetime
+import gzip
+import http.client
 import json
-import urllib.request
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.db.models import Count
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
 
 from xorgdata.alumnforce import models
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Number of accounts which are sent in each request to xorgauth
+PAGE_SIZE = 2000
+
+# Number of times the push of a page is attempted, when the failures look transient
+MAX_PUSH_ATTEMPTS = 5
+
+# Delay before retrying to push a page, in seconds, doubled after each failed attempt
+PUSH_RETRY_DELAY = 1.0
+
+# Timeout of the connections to xorgauth, in seconds
+PUSH_TIMEOUT = 60
+
+# Fields of the exported accounts, in the order used by the "arrays" payload format
+EXPORTED_FIELDS = ("xorg_id", "af_id", "ax_contributor", "axjr_subscribed", "last_updated", "deleted")
+
+# Supported payload formats and compressions of the pushed pages
+PUSH_FORMATS = ("objects", "arrays")
+PUSH_COMPRESSIONS = ("", "gzip", "zstd")
+
+
+def export_account(xorg_id, af_id, additional_roles, last_update):
+    """Build the exported data of an account, from the values of its exported fields"""
+    roles = models.Account.parse_additional_roles(additional_roles)
+    return {
+        "xorg_id": xorg_id,
+        "af_id": af_id,
+        "ax_contributor": models.Account.ROLE_CONTRIBUTOR in roles,
+        "axjr_subscribed": models.Account.ROLE_SUBSCRIBED in roles,
+        "last_updated": last_update.strftime("%Y-%m-%d"),
+    }
+
+
+def export_tombstone(xorg_id, af_id):
+    """Build the exported data of an account which must no longer be used for authentication"""
+    return {
+        "xorg_id": xorg_id,
+        "af_id": af_id,
+        "deleted": True,
+    }
+
+
+class PushError(Exception):
+    """A page of exported accounts could not be pushed to xorgauth"""
+
+
+class XorgAuthClient:
+    """Client which pushes pages of exported accounts to xorgauth
+
+    Each worker thread keeps its own persistent connection to xorgauth, and at
+    most two pages per worker are waiting to be sent at any time.
+    """
+
+    def __init__(self, num_workers):
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.max_pending = 2 * num_workers
+        self.pending = collections.deque()
+        # Time spent pushing each page, in seconds
+        self.page_durations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_connection(self):
+        """Get the connection of the current thread, which gets reopened after being closed"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if settings.XORGAUTH_USE_HTTPS:
+                connection = http.client.HTTPSConnection(settings.XORGAUTH_HOST, timeout=PUSH_TIMEOUT)
+            else:
+                connection = http.client.HTTPConnection(settings.XORGAUTH_HOST, timeout=PUSH_TIMEOUT)
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def encode_page(self, page):
+        """Build the body and the headers of the request which pushes a page of exported accounts
+
+        With the "arrays" format, each account is sent as a list of the values
+        of EXPORTED_FIELDS, with null for the fields which do not apply.
+        """
+        payload = {"secret": settings.XORGAUTH_PASSWORD}
+        if settings.XORGAUTH_PUSH_FORMAT == "arrays":
+            payload["fields"] = EXPORTED_FIELDS
+            payload["data"] = [[account.get(field) for field in EXPORTED_FIELDS] for account in page]
+        else:
+            payload["data"] = page
+        body = json.dumps(payload, separators=(",", ":")).encode("ascii")
+        headers = {"Content-type": "application/json"}
+        if settings.XORGAUTH_PUSH_COMPRESSION == "gzip":
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        elif settings.XORGAUTH_PUSH_COMPRESSION == "zstd":
+            body = zstandard.ZstdCompressor().compress(body)
+            headers["Content-Encoding"] = "zstd"
+        return body, headers
+
+    def push_page(self, page):
+        """Send a page of exported accounts, retrying on transient failures, and return the time it took"""
+        body, headers = self.encode_page(page)
+        start_time = time.monotonic()
+        for attempt in range(MAX_PUSH_ATTEMPTS):
+            if attempt:
+                time.sleep(PUSH_RETRY_DELAY * 2 ** (attempt - 1))
+            connection = self.get_connection()
+            try:
+                connection.request("POST", "/sync/axdata", body=body, headers=headers)
+                response = connection.getresponse()
+                # Read the whole response in order to be able to reuse the connection
+                response.read()
+            except (OSError, http.client.HTTPException) as exc:
+                connection.close()
+                error = "connection error {!r}".format(exc)
+                continue
+            if 200 <= response.status < 300:
+                return time.monotonic() - start_time
+            error = "HTTP error {} ({})".format(response.status, response.reason)
+            if response.status < 500 and response.status != 429:
+                # The request was rejected, sending it again would not help
+                break
+        raise PushError("{} when trying to push data".format(error))
+
+    def submit(self, page):
+        """Queue a page of exported accounts, waiting for previous pages if too many are pending"""
+        while len(self.pending) >= self.max_pending:
+            self.page_durations.append(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(self.push_page, page))
+
+    def wait(self):
+        """Wait for all the queued pages to be sent"""
+        while self.pending:
+            self.page_durations.append(self.pending.popleft().result())
+
+    def close(self):
+        """Stop the workers, without sending the pages which are still queued, and close the connections"""
+        self.executor.shutdown(cancel_futures=True)
+        for connection in self.connections:
+            connection.close()
+
 
 class Command(BaseCommand):
     help = "Export data which is used by X.org authentication project"
@@ -16,10 +173,18 @@ class Command(BaseCommand):
         parser.add_argument(
             "--push", action="store_true", help="push the exported data to {}".format(settings.XORGAUTH_HOST)
         )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="push all the accounts, instead of only the ones which changed since the previous export",
+        )
+        parser.add_argument(
+            "--jsonl", action="store_true", help="show the exported data as newline-delimited JSON objects"
+        )
 
-    def handle(self, *args, **options):
-        # Avoid duplicated X.org login in the exported data
-        duplicated_xorg_id = (
+    def get_duplicated_xorg_ids(self):
+        """Get a queryset of the X.org logins which are used by several accounts"""
+        return (
             models.Account.objects.filter(deleted_since=None)
             .exclude(xorg_id=None)
             .values("xorg_id")
@@ -28,57 +193,147 @@ class Command(BaseCommand):
             .filter(count__gt=1)
         )
 
-        # Export all accounts that have not been deleted and that have a X.org login
-        accounts_qs = models.Account.objects.filter(deleted_since=None).exclude(
-            xorg_id=None, xorg_id__in=duplicated_xorg_id
+    def iter_exported_accounts(self):
+        """Generate the exported data of every account, without loading all of them in memory"""
+        # Export all accounts that have not been deleted and that have a X.org login,
+        # avoiding duplicated X.org login in the exported data
+        accounts_qs = (
+            models.Account.objects.filter(deleted_since=None)
+            .exclude(xorg_id=None)
+            .exclude(xorg_id__in=self.get_duplicated_xorg_ids())
+            .order_by("af_id")
+            .values_list("xorg_id", "af_id", "additional_roles", "last_update")
+        )
+        for account_values in accounts_qs.iterator(chunk_size=PAGE_SIZE):
+            yield export_account(*account_values)
+
+    def iter_changed_accounts(self, since, previous_duplicated_xorg_ids=()):
+        """Generate the exported data of the accounts which were imported since the given time
+
+        Accounts which were deleted or share their X.org login with another
+        account are exported as tombstones. Accounts without X.org login are
+        not exported, as in full exports. When an account changed,
+        the other accounts using the same X.org login are exported too, as
+        they may have become ambiguous or stopped being so. The accounts using
+        the logins which were previously shared are exported again too, as
+        the accounts which shared them may have changed their login.
+        """
+        changed = Q(imported_at__gte=since)
+        affected_xorg_ids = Q(
+            xorg_id__in=models.Account.objects.filter(changed).exclude(xorg_id=None).values("xorg_id")
+        ) | Q(xorg_id__in=previous_duplicated_xorg_ids)
+        duplicated_xorg_ids = set(
+            self.get_duplicated_xorg_ids().filter(affected_xorg_ids).values_list("xorg_id", flat=True)
+        )
+        accounts_qs = (
+            models.Account.objects.filter(changed | (Q(deleted_since=None) & affected_xorg_ids))
+            .exclude(xorg_id=None, deleted_since=None)
+            .order_by("af_id")
+            .values_list("xorg_id", "af_id", "additional_roles", "last_update", "deleted_since")
+        )
+        for xorg_id, af_id, additional_roles, last_update, deleted_since in accounts_qs.iterator(chunk_size=PAGE_SIZE):
+            if deleted_since is not None or xorg_id in duplicated_xorg_ids:
+                yield export_tombstone(xorg_id, af_id)
+            else:
+                yield export_account(xorg_id, af_id, additional_roles, last_update)
+
+    def get_incremental_start(self):
+        """Get the time from which changed accounts need to be pushed, or None for a full export
+
+        A full export is done when the last one is older than XORGDATA_XORGAUTH_FULL_PUSH_INTERVAL days.
+        """
+        successful_logs = models.ExportLog.objects.filter(
+            export_kind=models.ExportLog.KIND_AUTH, error=models.ExportLog.SUCCESS
+        ).order_by("-date", "-pk")
+        last_full_log = successful_logs.filter(is_incremental=False).first()
+        if last_full_log is None:
+            return None
+        if last_full_log.date < datetime.date.today() - datetime.timedelta(days=settings.XORGAUTH_FULL_PUSH_INTERVAL):
+            return None
+        # Exports logged before their start was recorded cannot tell which accounts were imported since then
+        return successful_logs.first().started_at
+
+    def record_duplicated_xorg_ids(self, xorg_ids):
+        """Remember the X.org logins which were shared by several accounts when they were exported"""
+        models.DuplicatedXorgId.objects.exclude(xorg_id__in=xorg_ids).delete()
+        known_xorg_ids = set(models.DuplicatedXorgId.objects.values_list("xorg_id", flat=True))
+        models.DuplicatedXorgId.objects.bulk_create(
+            models.DuplicatedXorgId(xorg_id=xorg_id) for xorg_id in sorted(xorg_ids) if xorg_id not in known_xorg_ids
         )
 
-        def export_account(account):
-            roles = account.get_additional_roles()
-            return {
-                "xorg_id": account.xorg_id,
-                "af_id": account.af_id,
-                "ax_contributor": models.Account.ROLE_CONTRIBUTOR in roles,
-                "axjr_subscribed": models.Account.ROLE_SUBSCRIBED in roles,
-                "last_updated": account.last_update.strftime("%Y-%m-%d"),
-            }
+    def write_to_stdout(self, exported_accounts, jsonl):
+        """Show the exported data, writing each account as soon as it is exported"""
+        if jsonl:
+            for exported_account in exported_accounts:
+                self.stdout.write(json.dumps(exported_account))
+            return
 
-        exported_data = [export_account(account) for account in accounts_qs]
+        # Produce the same output as json.dumps() of the list of accounts
+        separator = "["
+        for exported_account in exported_accounts:
+            self.stdout.write(separator + json.dumps(exported_account), ending="")
+            separator = ", "
+        self.stdout.write("[]" if separator == "[" else "]")
 
+    def handle(self, *args, **options):
         if not options["push"]:
             # Show the exported data, without exporting it
-            self.stdout.write(json.dumps(exported_data))
+            self.write_to_stdout(self.iter_exported_accounts(), options["jsonl"])
             return
 
         if not settings.XORGAUTH_PASSWORD:
             raise CommandError("Unable to push: XORGDATA_XORGAUTH_PASSWORD is not defined")
+        if settings.XORGAUTH_PUSH_FORMAT not in PUSH_FORMATS:
+            raise CommandError("Unknown push format {}".format(repr(settings.XORGAUTH_PUSH_FORMAT)))
+        if settings.XORGAUTH_PUSH_COMPRESSION not in PUSH_COMPRESSIONS:
+            raise CommandError("Unknown push compression {}".format(repr(settings.XORGAUTH_PUSH_COMPRESSION)))
+        if settings.XORGAUTH_PUSH_COMPRESSION == "zstd" and zstandard is None:
+            raise CommandError("Unable to push with zstd compression: the zstandard module is not installed")
 
-        # Paginate the data by defining a number of account to send for each batch
-        page_size = 2000
-        for page_offset in range(0, len(exported_data), page_size):
-            req = urllib.request.Request(
-                "https://{}/sync/axdata".format(settings.XORGAUTH_HOST),
-                data=json.dumps(
-                    {
-                        "secret": settings.XORGAUTH_PASSWORD,
-                        "data": exported_data[page_offset : page_offset + page_size],
-                    }
-                ).encode("ascii"),
-                headers={
-                    "Content-type": "application/json",
-                },
+        started_at = timezone.now()
+        since = None if options["full"] else self.get_incremental_start()
+        # Logins which are shared now, whose accounts are not usable in the exported data
+        duplicated_xorg_ids = set(self.get_duplicated_xorg_ids().values_list("xorg_id", flat=True))
+        if since is None:
+            exported_accounts = self.iter_exported_accounts()
+        else:
+            exported_accounts = self.iter_changed_accounts(
+                since, list(models.DuplicatedXorgId.objects.values_list("xorg_id", flat=True))
             )
-            opener = urllib.request.build_opener()
-            try:
-                opener.open(req)
-            except urllib.error.HTTPError as exc:
-                raise CommandError("HTTP error %d when trying to push data: %r" % (exc.code, exc))
+
+        # Paginate the data by sending each page as soon as it is full
+        num_exported = 0
+        page = []
+        try:
+            with XorgAuthClient(settings.XORGAUTH_PUSH_WORKERS) as client:
+                for exported_account in exported_accounts:
+                    page.append(exported_account)
+                    if len(page) >= PAGE_SIZE:
+                        client.submit(page)
+                        num_exported += len(page)
+                        page = []
+                if page:
+                    client.submit(page)
+                    num_exported += len(page)
+                client.wait()
+        except PushError as exc:
+            raise CommandError(str(exc))
 
         # Log that the export cas successful
-        models.ExportLog.objects.create(
-            date=datetime.datetime.now(),
-            export_kind=models.ExportLog.KIND_AUTH,
-            error=models.ImportLog.SUCCESS,
-            num_items=len(exported_data),
-            message="Sent {} accounts to {}".format(len(exported_data), settings.XORGAUTH_HOST),
-        )
+        with transaction.atomic():
+            self.record_duplicated_xorg_ids(duplicated_xorg_ids)
+            models.ExportLog.objects.create(
+                date=datetime.datetime.now(),
+                started_at=started_at,
+                export_kind=models.ExportLog.KIND_AUTH,
+                is_incremental=since is not None,
+                error=models.ExportLog.SUCCESS,
+                num_items=num_exported,
+                message="Sent {} {}accounts to {} in {} pages ({})".format(
+                    num_exported,
+                    "" if since is None else "changed ",
+                    settings.XORGAUTH_HOST,
+                    len(client.page_durations),
+                    ", ".join("{:.2f}s".format(duration) for duration in client.page_durations),
+                ),
+            )
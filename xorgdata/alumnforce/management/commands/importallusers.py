@@ -6,11 +6,14 @@ import os.path
 import re
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
 
 from xorgdata.alumnforce import models
 from xorgdata.alumnforce.full_export.lib.converters import AlumnForceDataC2J
+from xorgdata.alumnforce.issues import rebuild_account_issues
 
-from .importcsv import parse_french_date
+from .importcsv import DEFAULT_BATCH_SIZE, bulk_upsert, parse_french_date
 
 
 def get_export_date_from_filename(file_path):
@@ -32,6 +35,81 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("csvfile", type=str, help="path to CSV file to load")
         parser.add_argument("--date", type=str, help="date associate with the export (by default: use the file name)")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="number of rows written to the database at once (default: %(default)d)",
+        )
+
+    @staticmethod
+    def build_account_fields(user_data, file_date):
+        """Prepare a dict for insertion into the Django database, from a row of the export"""
+        fields = {
+            "af_id": int(user_data["id_af"]),
+            "ax_id": user_data["id_ax"] or None,
+            "first_name": user_data["first_name"],
+            "last_name": user_data["last_name"],
+            "common_name": user_data["usage_name"],
+            "civility": user_data["civility"],
+            "birthdate": parse_french_date(user_data["birth_date"]),
+            "address_1": user_data["personal"]["address"]["line_1"],
+            "address_2": user_data["personal"]["address"]["line_2"],
+            "address_3": user_data["personal"]["address"]["line_3"],
+            "address_4": user_data["personal"]["address"]["line_4"],
+            "address_postcode": user_data["personal"]["address"]["code"],
+            "address_city": user_data["personal"]["address"]["city"],
+            "address_state": user_data["personal"]["address"]["state"],
+            "address_country": user_data["personal"]["address"]["country"],
+            "address_npai": user_data["personal"]["address"]["bounced"],
+            "phone_personnal": user_data["personal"]["fix_phone"],
+            "phone_mobile": user_data["personal"]["cell_phone"],
+            "email_1": user_data["email"]["personal_1"],
+            "email_2": user_data["email"]["personal_2"],
+            "nationality": user_data["nationality"],
+            "nationality_2": user_data["nationality_2"],
+            "nationality_3": user_data["nationality_3"],
+            "dead": user_data["is_dead"],
+            "deathdate": parse_french_date(user_data["death_date"]),
+            "dead_for_france": user_data["dead_for_france"],
+            "user_kind": user_data["user_kind"],
+            "additional_roles": "",
+            "xorg_id": user_data["xorg"]["login"] or None,
+            "school_id": user_data["school"]["id"],
+            "admission_path": user_data["school"]["input"],
+            "cursus_domain": user_data["school"]["domain"],
+            "cursus_name": user_data["school"]["name"],
+            "corps_current": user_data["corps"]["current"],
+            "corps_origin": user_data["corps"]["original"],
+            "corps_grade": user_data["corps"]["grade"],
+            "nickname": user_data["nickname"],
+            "sport_section": user_data["school"]["sport"],
+            "binets": ",".join(user_data["school"]["binets"] or []),
+            "mail_reception": user_data["has_postal_mail"],
+            "newsletter_inscriptions": ",".join(user_data["newsletters"] or []),
+            "last_update": file_date,
+            "deleted_since": None,
+            # Force the next incremental export of this account to be written
+            "import_digest": "",
+        }
+        if fields["civility"] == "M.":
+            # Normalize civility, in order to share the same format as incremental exports
+            fields["civility"] = "M"
+        if fields["school_id"] == "0":
+            # Normalize school ID
+            fields["school_id"] = ""
+
+        for key in ("nationality", "nationality_2", "nationality_3"):
+            # Make an unfilled field blank
+            if fields[key] == "Non renseigné":
+                fields[key] = ""
+
+        if user_data["roles"]:
+            # Format the additional roles as a list of integers
+            fields["additional_roles"] = ",".join(user_data["roles"])
+        # The accounts are written without calling their save() method
+        fields["search_name"] = models.Account.build_search_name(fields)
+        return fields
 
     def handle(self, *args, **options):
         file_path = options["csvfile"]
@@ -50,92 +128,57 @@ class Command(BaseCommand):
             if not file_date:
                 raise CommandError("Unable to find a date in file path %r" % file_path)
 
-        # Track users in order to find out those which have been deleted
-        deleted_account_ids = set(account.af_id for account in models.Account.objects.filter(deleted_since=None))
-
-        # Import the file as a JSON structure
-        json_obj = AlumnForceDataC2J.import_csv_file(file_path, keep_empty=True)
-        for user_data in json_obj.content:
-            # Prepare a dict for insertion into the Django database
-            af_id = int(user_data["id_af"])
-            fields = {
-                "ax_id": user_data["id_ax"] or None,
-                "first_name": user_data["first_name"],
-                "last_name": user_data["last_name"],
-                "common_name": user_data["usage_name"],
-                "civility": user_data["civility"],
-                "birthdate": parse_french_date(user_data["birth_date"]),
-                "address_1": user_data["personal"]["address"]["line_1"],
-                "address_2": user_data["personal"]["address"]["line_2"],
-                "address_3": user_data["personal"]["address"]["line_3"],
-                "address_4": user_data["personal"]["address"]["line_4"],
-                "address_postcode": user_data["personal"]["address"]["code"],
-                "address_city": user_data["personal"]["address"]["city"],
-                "address_state": user_data["personal"]["address"]["state"],
-                "address_country": user_data["personal"]["address"]["country"],
-                "address_npai": user_data["personal"]["address"]["bounced"],
-                "phone_personnal": user_data["personal"]["fix_phone"],
-                "phone_mobile": user_data["personal"]["cell_phone"],
-                "email_1": user_data["email"]["personal_1"],
-                "email_2": user_data["email"]["personal_2"],
-                "nationality": user_data["nationality"],
-                "nationality_2": user_data["nationality_2"],
-                "nationality_3": user_data["nationality_3"],
-                "dead": user_data["is_dead"],
-                "deathdate": parse_french_date(user_data["death_date"]),
-                "dead_for_france": user_data["dead_for_france"],
-                "user_kind": user_data["user_kind"],
-                "additional_roles": "",
-                "xorg_id": user_data["xorg"]["login"] or None,
-                "school_id": user_data["school"]["id"],
-                "admission_path": user_data["school"]["input"],
-                "cursus_domain": user_data["school"]["domain"],
-                "cursus_name": user_data["school"]["name"],
-                "corps_current": user_data["corps"]["current"],
-                "corps_origin": user_data["corps"]["original"],
-                "corps_grade": user_data["corps"]["grade"],
-                "nickname": user_data["nickname"],
-                "sport_section": user_data["school"]["sport"],
-                "binets": ",".join(user_data["school"]["binets"] or []),
-                "mail_reception": user_data["has_postal_mail"],
-                "newsletter_inscriptions": ",".join(user_data["newsletters"] or []),
-                "last_update": file_date,
-                "deleted_since": None,
-            }
-            if fields["civility"] == "M.":
-                # Normalize civility, in order to share the same format as incremental exports
-                fields["civility"] = "M"
-            if fields["school_id"] == "0":
-                # Normalize school ID
-                fields["school_id"] = ""
-
-            for key in ("nationality", "nationality_2", "nationality_3"):
-                # Make an unfilled field blank
-                if fields[key] == "Non renseigné":
-                    fields[key] = ""
-
-            if user_data["roles"]:
-                # Format the additional roles as a list of integers
-                fields["additional_roles"] = ",".join(user_data["roles"])
-            models.Account.objects.update_or_create(af_id=af_id, defaults=fields)
-            if af_id in deleted_account_ids:
-                deleted_account_ids.remove(af_id)
-
-        num_users = len(json_obj.content)
-        message = "Loaded {} values from full export {}".format(num_users, repr(file_path))
-
-        if deleted_account_ids:
-            message += " ({} deleted users)".format(len(deleted_account_ids))
-            for account in models.Account.objects.filter(af_id__in=deleted_account_ids):
-                account.deleted_since = file_date
-                account.save()
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("Invalid batch size %d" % batch_size)
+
+        # Nothing is modified if the import fails
+        with transaction.atomic():
+            # Track users in order to find out those which have been deleted
+            deleted_account_ids = set(
+                models.Account.objects.filter(deleted_since=None).values_list("af_id", flat=True)
+            )
+
+            # Import the rows of the file one at a time, as JSON structures, and write them in batches
+            num_users = 0
+            pending_fields = {}
+
+            def flush_pending_fields():
+                imported_at = timezone.now()
+                for fields in pending_fields.values():
+                    fields["imported_at"] = imported_at
+                bulk_upsert(models.Account, list(pending_fields.values()), ["af_id"], batch_size)
+                pending_fields.clear()
+
+            for user_data in AlumnForceDataC2J.iter_csv_file(file_path, keep_empty=True):
+                fields = self.build_account_fields(user_data, file_date)
+                # The same user may appear several times in the export, in which case the last row is used
+                pending_fields[fields["af_id"]] = fields
+                deleted_account_ids.discard(fields["af_id"])
+                num_users += 1
+                if len(pending_fields) >= batch_size:
+                    flush_pending_fields()
+            flush_pending_fields()
+
+            message = "Loaded {} values from full export {}".format(num_users, repr(file_path))
+
+            if deleted_account_ids:
+                message += " ({} deleted users)".format(len(deleted_account_ids))
+                deleted_account_ids = sorted(deleted_account_ids)
+                for offset in range(0, len(deleted_account_ids), batch_size):
+                    models.Account.objects.filter(af_id__in=deleted_account_ids[offset : offset + batch_size]).update(
+                        deleted_since=file_date, imported_at=timezone.now()
+                    )
 
+            # Every account may have changed
+            rebuild_account_issues()
+
+            models.ImportLog.objects.create(
+                date=file_date,
+                export_kind="users",
+                is_incremental=False,
+                error=models.ImportLog.SUCCESS,
+                num_modified=num_users,
+                message=message,
+            )
         self.stdout.write(self.style.SUCCESS(message))
-        models.ImportLog.objects.create(
-            date=file_date,
-            export_kind="users",
-            is_incremental=False,
-            error=models.ImportLog.SUCCESS,
-            num_modified=num_users,
-            message=message,
-        )
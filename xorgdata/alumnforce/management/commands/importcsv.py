@@ -4,21 +4,29 @@
 import csv
 import datetime
 import hashlib
+import itertools
 import os.path
 import re
 
 from django.conf import settings
 from django.core.mail import send_mail
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
 
 from xorgdata.alumnforce import models
+from xorgdata.alumnforce.issues import refresh_account_issues
+
+INTEGER_RE = re.compile(r"^[0-9]+$")
+PHONE_INDICATOR_RE = re.compile(r"^\+?[0-9]+$")
+FRENCH_DATE_RE = re.compile(r"(?P<day>\d{1,2})/(?P<month>\d{1,2})/(?P<year>\d{4})$")
 
 
 def bool_or_none(txt):
     if txt == "":
         return None
     elif txt in ("0", "1"):
-        return bool(int(txt))
+        return txt == "1"
     else:
         raise ValueError("invalid bool value {}".format(repr(txt)))
 
@@ -26,7 +34,7 @@ def bool_or_none(txt):
 def int_or_none(txt):
     if txt == "":
         return None
-    elif re.match(r"^[0-9]+$", txt):
+    elif INTEGER_RE.match(txt):
         return int(txt)
     else:
         raise ValueError("invalid integer value: {}".format(repr(txt)))
@@ -39,23 +47,20 @@ def phone_indicator(txt):
     """
     if txt == "":
         return None
-    elif re.match(r"^\+?[0-9]+$", txt):
+    elif PHONE_INDICATOR_RE.match(txt):
         return int(txt)
     else:
         raise ValueError("invalid phone indicator value: {}".format(repr(txt)))
 
 
-FRENCH_DATE_RE = re.compile(r"(?P<day>\d{1,2})/(?P<month>\d{1,2})/(?P<year>\d{4})$")
-
-
 def parse_french_date(value):
     # Copy from django.utils.dateparse which supports dates in French format
     if not value:
         return None
     match = FRENCH_DATE_RE.match(value)
     if match:
-        kw = {k: int(v) for k, v in match.groupdict().items()}
-        return datetime.date(**kw)
+        day, month, year = match.groups()
+        return datetime.date(int(year), int(month), int(day))
     raise ValueError("Unknown date format (%r)" % value)
 
 
@@ -163,8 +168,13 @@ ALUMNFORCE_GROUPMEMBER_ROLES = {
 }
 
 
-# Kind of export file
-KNOWN_EXPORT_KINDS = frozenset(x[0] for x in models.ImportLog.KNOWN_EXPORT_KINDS)
+# Number of rows which are written to the database in a single query
+DEFAULT_BATCH_SIZE = 1000
+
+
+# Kind of export file, in the order in which they need to be imported
+KNOWN_EXPORT_KINDS_ORDER = tuple(x[0] for x in models.ImportLog.KNOWN_EXPORT_KINDS)
+KNOWN_EXPORT_KINDS = frozenset(KNOWN_EXPORT_KINDS_ORDER)
 
 
 def get_export_kind_from_filename(file_path):
@@ -195,6 +205,45 @@ def get_export_date_from_filename(file_path):
     return None
 
 
+def build_parse_problem(report, kind, date, state, account_label):
+    """Build the record of a line of a CSV file, from its parse report"""
+    return models.ParseProblem(
+        kind=kind,
+        af_id=report.af_id,
+        state=state,
+        date=date,
+        account_label=account_label,
+        file_name=report.path,
+        header="\t".join(report.header),
+        line_num=report.line_num,
+        line_hash=report.line_hash,
+        line=report.line,
+        problems="\n".join(str(problem) for problem in report.problems),
+    )
+
+
+def format_parse_problem(problem):
+    """Format the record of a line of a CSV file, in order to display it in a report"""
+    return (
+        "------------------------------------------------------------------------\n"
+        + "\n".join("{:<10}: {}".format(k, v) for k, v in problem.items())
+        + "\n------------------------------------------------------------------------\n"
+    )
+
+
+def resolve_parse_problems(kind, af_ids, batch_size=DEFAULT_BATCH_SIZE):
+    """Resolve the open problems of the given accounts"""
+    open_problems = models.ParseProblem.objects.filter(kind=kind, state=models.ParseProblem.STATE_OPEN)
+    if None in af_ids:
+        # Lines whose AF ID could not be read
+        open_problems.filter(af_id=None).update(state=models.ParseProblem.STATE_RESOLVED)
+        af_ids = [af_id for af_id in af_ids if af_id is not None]
+    for offset in range(0, len(af_ids), batch_size):
+        open_problems.filter(af_id__in=af_ids[offset : offset + batch_size]).update(
+            state=models.ParseProblem.STATE_RESOLVED
+        )
+
+
 def compute_current_problem_file_path(kind, id):
     id_str = str(id)
     directory = os.path.join(settings.PERSISTENT_DIRECTORY, "current_problems_by_id", kind)
@@ -211,6 +260,124 @@ def compute_problem_archive_file_path(kind, id, csv_file_path, state, account_st
     )
 
 
+def write_parse_problems_files(kind, af_id, case_number, account_label_for_filename, account_label, parse_problems):
+    """Mirror the changes of the problems of an account to files, when PARSE_PROBLEMS_FILES_MIRROR is enabled"""
+    current_problem_file_path = compute_current_problem_file_path(kind, af_id)
+    if case_number & 1:
+        with open(current_problem_file_path, "a") as rej_file:
+            rej_file.write(f"### Soucis de type {kind} concernant le compte {account_label}\n\n")
+            for problem in parse_problems:
+                rej_file.write(format_parse_problem(problem))
+    else:
+        try:
+            os.remove(current_problem_file_path)
+        except OSError:
+            pass
+
+    problem_archive_file_marker = [None, "problem_new", "resolved", "problem_still"][case_number]
+    for problem in parse_problems:
+        problem_archive_file_path = compute_problem_archive_file_path(
+            kind, af_id, problem.file_name, problem_archive_file_marker, account_label_for_filename, problem.line_hash
+        )
+        with open(problem_archive_file_path, "w") as archive_file:
+            archive_file.write("\n" + format_parse_problem(problem))
+
+
+def bulk_upsert(model, values, unique_fields, batch_size=DEFAULT_BATCH_SIZE):
+    """Insert or update several objects of a model at once
+
+    values is a list of dicts which all define the same fields. The rows which
+    already exist, according to unique_fields, are updated with the other fields.
+    """
+    if not values:
+        return
+    unique_attnames = set(model._meta.get_field(name).attname for name in unique_fields)
+    update_fields = [key for key in values[0] if key not in unique_attnames]
+    if not connection.features.supports_update_conflicts_with_target:
+        # MySQL does not support specifying the columns of the conflict
+        unique_fields = None
+    model.objects.bulk_create(
+        [model(**value) for value in values],
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=update_fields,
+    )
+
+
+# Conversions which turn an empty cell into None
+NULLABLE_CONVERSIONS = frozenset((bool_or_none, int_or_none, phone_indicator, parse_french_date))
+# Conversions whose results are worth caching, as the same values occur on many lines
+CACHED_CONVERSIONS = frozenset((parse_french_date,))
+
+
+def compute_account_digest(value):
+    """Compute a digest of the values of an account, in order to detect whether they changed"""
+    return hashlib.sha256(repr(sorted(value.items())).encode("utf-8")).hexdigest()
+
+
+class RowDecoder:
+    """Convert the cells of the rows of a CSV file, according to its header
+
+    The conversions are resolved once for all the rows: the columns which hold plain
+    strings are not touched, empty cells of nullable columns become None without calling
+    any function, and the results of the conversions of dates are cached by raw value.
+    """
+
+    def __init__(self, header, fields):
+        self.columns = []
+        # Tuples (column index, conversion function, whether an empty cell is None, cache)
+        self.conversions = []
+        for index, col_name in enumerate(header):
+            # Use the `fields` translation if it is known, otherwise the column name
+            self.columns.append(fields.get(col_name, col_name)[0])
+            conversion = fields.get(col_name, col_name)[1]
+            if conversion is str:
+                continue
+            cache = {} if conversion in CACHED_CONVERSIONS else None
+            self.conversions.append((index, conversion, conversion in NULLABLE_CONVERSIONS, cache))
+
+    def decode(self, row):
+        """Convert the cells of a row in place, and return them as a dict
+
+        Raise ValueError if a cell is invalid.
+        """
+        for index, conversion, is_nullable, cache in self.conversions:
+            cell = row[index]
+            if is_nullable and cell == "":
+                row[index] = None
+            elif cache is None:
+                row[index] = conversion(cell)
+            else:
+                try:
+                    row[index] = cache[cell]
+                except KeyError:
+                    row[index] = cache[cell] = conversion(cell)
+        return dict(zip(self.columns, row))
+
+
+class ExistingPrimaryKeys:
+    """Set of the primary keys of a model which exist in the database, looked up in bulk"""
+
+    def __init__(self, model):
+        self.model = model
+        self.existing = set()
+        self.missing = set()
+
+    def load(self, keys):
+        """Look up the keys which have not been seen yet, and return the ones which exist"""
+        new_keys = set(keys) - self.existing - self.missing
+        if not new_keys:
+            return set()
+        found = set(self.model.objects.filter(pk__in=new_keys).values_list("pk", flat=True))
+        self.existing.update(found)
+        self.missing.update(new_keys - found)
+        return found
+
+    def __contains__(self, key):
+        return key in self.existing
+
+
 # The CSV (actually tab-separated) files we receive from Alumnforce sometimes contain malformed
 # lines.
 
@@ -244,20 +411,125 @@ def compute_problem_archive_file_path(kind, id, csv_file_path, state, account_st
 # For this reason, load_csv returns a tuple: a parse_report and the value.
 
 
-def load_csv(kind, csv_file_path, fields):
+class LineTracker:
+    """Iterate over the lines of a stream, remembering the last line which was read
+
+    This enables a CSV reader to consume a file lazily while giving access to the raw
+    content of the record it has just parsed.
+    """
+
+    def __init__(self, line_stream):
+        self.line_stream = line_stream
+        self.last_line = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.last_line = next(self.line_stream)
+        return self.last_line
+
+
+def read_raw_lines(csv_file_path, line_nums):
+    """Read again some lines of a file, identified by their zero-based numbers"""
+    line_nums = set(line_nums)
+    raw_lines = {}
+    if not line_nums:
+        return raw_lines
+    last_line_num = max(line_nums)
     with open(csv_file_path, "r", encoding="utf-8") as line_stream:
-        all_lines = line_stream.readlines()
+        for line_num, line in enumerate(line_stream):
+            if line_num in line_nums:
+                raw_lines[line_num] = line
+            if line_num >= last_line_num:
+                break
+    return raw_lines
+
+
+class ParseReport:
+    """Report about the parsing of a line of a CSV file
+
+    A report of a clean line only holds its AF ID and its line number (the file path and
+    the header are shared by all the reports of a file). The raw content of the line is
+    only kept when there is a problem, and its hash is computed on demand. load_raw_lines()
+    can read the content of clean lines again, when they need to be archived.
+    """
+
+    __slots__ = ("af_id", "line_num", "problems", "line", "file_path", "header")
+
+    def __init__(self, file_path, header, line_num):
+        self.af_id = None
+        self.line_num = line_num
+        # Clean lines share the same empty tuple
+        self.problems = ()
+        self.line = None
+        self.file_path = file_path
+        self.header = header
+
+    def add_problem(self, problem):
+        if not self.problems:
+            self.problems = []
+        self.problems.append(problem)
+
+    @property
+    def path(self):
+        return os.path.basename(self.file_path)
+
+    @property
+    def line_hash(self):
+        return hashlib.sha256(self.line.encode("utf-8")).hexdigest()
 
-        reader = csv.reader(all_lines, delimiter="\t", quoting=csv.QUOTE_NONE, escapechar="\\", strict=True)
+    @property
+    def line_tabs(self):
+        return self.line.replace("\t", "<TAB>")
+
+    def items(self):
+        """Enumerate the content of the report, in order to display it"""
+        for key in ("problems", "af_id", "path", "header", "line_num", "line_hash", "line", "line_tabs"):
+            yield key, getattr(self, key)
+
+
+class KeptParseReports:
+    """Parse reports of a file which are needed to update the records of its problems
+
+    The reports of the lines with a problem are kept, and the reports of clean lines
+    only for the accounts which have open problems, as their problems may be resolved.
+    The other reports are dropped while the file is parsed.
+    """
+
+    def __init__(self, open_af_ids):
+        self.open_af_ids = open_af_ids
+        self.reports = []
+
+    def append(self, parse_report):
+        if parse_report.problems or parse_report.af_id in self.open_af_ids:
+            self.reports.append(parse_report)
+
+
+def load_raw_lines(csv_file_path, parse_reports):
+    """Load the raw line of parse reports which were built without it, for a clean line"""
+    missing_reports = [report for report in parse_reports if report.line is None]
+    raw_lines = read_raw_lines(csv_file_path, (report.line_num for report in missing_reports))
+    for report in missing_reports:
+        report.line = raw_lines[report.line_num]
+
+
+def load_csv(kind, csv_file_path, fields):
+    """Parse a CSV file, yielding a parse report and the converted values of each line
+
+    The file is read lazily. The raw content of a line is only kept in its parse report
+    when there is a problem with it, load_raw_lines() can read it again later if needed.
+    """
+    with open(csv_file_path, "r", encoding="utf-8") as line_stream:
+        lines = LineTracker(line_stream)
+        reader = csv.reader(lines, delimiter="\t", quoting=csv.QUOTE_NONE, escapechar="\\", strict=True)
         header_row = []
-        conversions = []
+        decoder = None
         for row in reader:
             if reader.line_num == 1:
                 # Parse the header line
-                for col_name in row:
-                    # Use the `fields` translation if it is known, otherwise the column name
-                    header_row.append(fields.get(col_name, col_name)[0])
-                    conversions.append(fields.get(col_name, col_name)[1])
+                decoder = RowDecoder(row, fields)
+                header_row = decoder.columns
 
                 # Sanity check
                 assert len(set(header_row)) == len(header_row), "There are columns which are not unique in {}".format(
@@ -268,35 +540,25 @@ def load_csv(kind, csv_file_path, fields):
             # Reader.line_num is indeed what we need, not a record count,
             # cf. https://docs.python.org/3/library/csv.html#csv.csvreader.line_num .
             # Also reader provides 1-based line number, other need zero-based, so subtract one.
+            # The tracker holds the last physical line of the record that has just been parsed.
             csv_raw_line_num = reader.line_num - 1
-            csv_raw_line = all_lines[csv_raw_line_num]
-            line_hash = hashlib.sha256(csv_raw_line.encode("utf-8")).hexdigest()
-
-            problems = []
-            af_id = (None,)
-            parse_report = {
-                "problems": problems,
-                "af_id": af_id,
-                "path": os.path.basename(csv_file_path),
-                "header": header_row,
-                "line_num": csv_raw_line_num,
-                "line_hash": line_hash,
-                "line": csv_raw_line,
-                "line_tabs": csv_raw_line.replace("\t", "<TAB>"),
-            }
+            csv_raw_line = lines.last_line
+
+            parse_report = ParseReport(csv_file_path, header_row, csv_raw_line_num)
+            af_id = None
             value = None
             try:
                 assert len(row) == len(header_row), (
                     f"Line has {len(row)} items but the header has {len(header_row)} items."
                 )
                 # convert the values as appropriate
-                row = [conv(val) for (val, conv) in zip(row, conversions)]
-                value = dict(zip(header_row, row))
+                value = decoder.decode(row)
                 # first item in row is in all cases the AF_ID of an involved user, check this in ALUMNFORCE_*_FIELDS
-                af_id = row[0]
+                af_id = int(row[0])
 
             except (AssertionError, ValueError, KeyError) as exc:
-                problems.append(exc)
+                parse_report.add_problem(exc)
+                parse_report.line = csv_raw_line
 
                 # There was a problem handling this line.
                 # Time to extract what we can from the line.
@@ -315,10 +577,10 @@ def load_csv(kind, csv_file_path, fields):
                     af_id = int(af_id_str)
 
                 except Exception as exc2:
-                    problems.append(failure)
-                    problems.append(exc2)
+                    parse_report.add_problem(failure)
+                    parse_report.add_problem(exc2)
 
-            parse_report["af_id"] = af_id
+            parse_report.af_id = af_id
             yield (parse_report, value)
 
 
@@ -328,10 +590,26 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("-k", "--kind", type=str, choices=KNOWN_EXPORT_KINDS, help="Kind of csv filed to load")
         parser.add_argument("csvfile", nargs="+", type=str, help="path to CSV file to load")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="number of rows written to the database at once (default: %(default)d)",
+        )
 
-    def log_success(self, file_date, file_kind, num_values, file_path, facts):
-        """Log a successful import"""
-        message = "Loaded {} values from {} {}.".format(num_values, file_kind, repr(file_path))
+    def log_success(self, file_date, file_kind, num_values, file_path, facts, num_changed=None):
+        """Log a successful import
+
+        When num_changed is given, it is the number of values which actually modified
+        the database, and it is recorded as the number of modified values.
+        """
+        if num_changed is None:
+            message = "Loaded {} values from {} {}.".format(num_values, file_kind, repr(file_path))
+            num_changed = num_values
+        else:
+            message = "Loaded {} values from {} {}, {} actually changed.".format(
+                num_values, file_kind, repr(file_path), num_changed
+            )
         for fact in facts:
             message += f" {fact}."
         if self.verbosity:
@@ -341,7 +619,7 @@ class Command(BaseCommand):
             export_kind=file_kind,
             is_incremental=True,
             error=models.ImportLog.SUCCESS,
-            num_modified=num_values,
+            num_modified=num_changed,
             message=message,
         )
 
@@ -357,18 +635,348 @@ class Command(BaseCommand):
             message=message,
         )
 
+    def import_accounts(self, file_date, file_kind, file_path, parse_reports, batch_size):
+        """Import accounts, skipping the ones which did not change since their last import
+
+        Return the number of imported values and the number of accounts which changed.
+        """
+        num_values = 0
+        num_changed = 0
+        # Accounts waiting to be written, indexed by AF ID so that the last line of an account wins
+        pending_accounts = {}
+
+        def flush_pending_accounts():
+            nonlocal num_changed
+            known_digests = dict(
+                models.Account.objects.filter(af_id__in=pending_accounts.keys(), deleted_since=None).values_list(
+                    "af_id", "import_digest"
+                )
+            )
+            changed_accounts = [
+                value
+                for af_id, value in pending_accounts.items()
+                if known_digests.get(af_id) != value["import_digest"]
+            ]
+            imported_at = timezone.now()
+            for value in changed_accounts:
+                value["imported_at"] = imported_at
+            bulk_upsert(models.Account, changed_accounts, ["af_id"], batch_size)
+            refresh_account_issues(value["af_id"] for value in changed_accounts)
+            num_changed += len(changed_accounts)
+            pending_accounts.clear()
+
+        for parse_report, value in load_csv(file_kind, file_path, ALUMNFORCE_USER_FIELDS):
+            parse_reports.append(parse_report)
+            if not value:
+                continue
+            for key in ("nationality", "nationality_2", "nationality_3"):
+                # Make an unfilled field blank
+                if value[key] == "Non renseigné":
+                    value[key] = ""
+            if value["school_id"] == "0":
+                value["school_id"] = ""
+            if value["xorg_id"] == "":
+                value["xorg_id"] = None
+            if value["profile_picture_url"].startswith("/"):
+                value["profile_picture_url"] = "https://ax.polytechnique.org" + value["profile_picture_url"]
+            value["import_digest"] = compute_account_digest(value)
+            value["search_name"] = models.Account.build_search_name(value)
+            value["last_update"] = file_date
+            value["deleted_since"] = None
+            pending_accounts[value["af_id"]] = value
+            num_values += 1
+            if len(pending_accounts) >= batch_size:
+                flush_pending_accounts()
+        flush_pending_accounts()
+        return num_values, num_changed
+
+    def replace_account_details(self, file_date, file_kind, file_path, fields, model, parse_reports, batch_size):
+        """Import degrees or jobs, replacing the previous ones of the accounts which appear in the file
+
+        Return the number of imported values.
+        """
+        num_values = 0
+        accounts = ExistingPrimaryKeys(models.Account)
+        pending_values = []
+
+        def flush_pending_values():
+            nonlocal num_values
+            new_af_ids = accounts.load(value["af_id"] for value in pending_values)
+            if new_af_ids:
+                # Remove previous details of the accounts which are seen for the first time
+                model.objects.filter(account_id__in=new_af_ids).delete()
+
+            new_objects = []
+            for value in pending_values:
+                if value["af_id"] not in accounts:
+                    self.log_warning(
+                        file_date,
+                        file_kind,
+                        "Unable to find user with AF ID {} (AX ID {})".format(value["af_id"], repr(value["ax_id"])),
+                    )
+                    continue
+                account_id = value.pop("af_id")
+                del value["ax_id"]
+                value["last_update"] = file_date
+                new_objects.append(model(account_id=account_id, **value))
+            model.objects.bulk_create(new_objects, batch_size=batch_size)
+            num_values += len(new_objects)
+            pending_values.clear()
+
+        for parse_report, value in load_csv(file_kind, file_path, fields):
+            parse_reports.append(parse_report)
+            if not value:
+                continue
+            pending_values.append(value)
+            if len(pending_values) >= batch_size:
+                flush_pending_values()
+        flush_pending_values()
+        return num_values
+
+    def import_group_memberships(self, file_date, file_kind, file_path, parse_reports, batch_size):
+        """Import group memberships, looking up the accounts and groups in bulk
+
+        Return the number of imported values.
+        """
+        num_values = 0
+        accounts = ExistingPrimaryKeys(models.Account)
+        groups = ExistingPrimaryKeys(models.Group)
+        pending_values = []
+
+        def flush_pending_values():
+            nonlocal num_values
+            accounts.load(value["user_id"] for value in pending_values)
+            groups.load(value["group_id"] for value in pending_values)
+
+            # Index the memberships by the unique key of the table, so that the last line wins
+            memberships = {}
+            for value in pending_values:
+                if value["user_id"] not in accounts:
+                    self.log_warning(
+                        file_date,
+                        file_kind,
+                        "Unable to find user with AF ID {} (AX ID {})".format(
+                            value["user_id"], repr(value["user_ax_id"])
+                        ),
+                    )
+                    continue
+                if value["group_id"] not in groups:
+                    self.log_warning(
+                        file_date, file_kind, "Unable to find group with AF ID {}".format(value["group_id"])
+                    )
+                    continue
+                try:
+                    role = ALUMNFORCE_GROUPMEMBER_ROLES[value["role"]]
+                except KeyError:
+                    self.log_warning(file_date, file_kind, "Unable to find group role {}".format(repr(value["role"])))
+                    continue
+                memberships[(value["group_id"], value["user_id"])] = {
+                    "group_id": value["group_id"],
+                    "account_id": value["user_id"],
+                    "role": role,
+                    "last_update": file_date,
+                }
+                num_values += 1
+            bulk_upsert(models.GroupMembership, list(memberships.values()), ["group", "account"], batch_size)
+            pending_values.clear()
+
+        for parse_report, value in load_csv(file_kind, file_path, ALUMNFORCE_GROUPMEMBER_FIELDS):
+            parse_reports.append(parse_report)
+            if not value:
+                continue
+            pending_values.append(value)
+            if len(pending_values) >= batch_size:
+                flush_pending_values()
+        flush_pending_values()
+        return num_values
+
+    def import_file(
+        self,
+        file_path,
+        file_date,
+        file_kind,
+        batch_size,
+        report_by_file_then_user,
+        problem_changes_all_files,
+        resolved_to_be_also_in_report,
+    ):
+        """Import a file and update the records of the problems it contains"""
+        open_af_ids = set(
+            models.ParseProblem.objects.filter(kind=file_kind, state=models.ParseProblem.STATE_OPEN)
+            .values_list("af_id", flat=True)
+            .distinct()
+        )
+        parse_reports_this_kind = KeptParseReports(open_af_ids)
+
+        # Number of values which really modified the database, when it is known
+        num_changed = None
+        if file_kind == "users":
+            num_values, num_changed = self.import_accounts(
+                file_date, file_kind, file_path, parse_reports_this_kind, batch_size
+            )
+        elif file_kind == "userdegrees":
+            num_values = self.replace_account_details(
+                file_date,
+                file_kind,
+                file_path,
+                ALUMNFORCE_USERDEGREE_FIELDS,
+                models.AcademicInformation,
+                parse_reports_this_kind,
+                batch_size,
+            )
+        elif file_kind == "userjobs":
+            num_values = self.replace_account_details(
+                file_date,
+                file_kind,
+                file_path,
+                ALUMNFORCE_USERJOB_FIELDS,
+                models.ProfessionnalInformation,
+                parse_reports_this_kind,
+                batch_size,
+            )
+        elif file_kind == "groups":
+            num_values = 0
+            for parse_report, value in load_csv(file_kind, file_path, ALUMNFORCE_GROUP_FIELDS):
+                parse_reports_this_kind.append(parse_report)
+                if not value:
+                    continue
+                value["last_update"] = file_date
+                models.Group.objects.update_or_create(af_id=value["af_id"], defaults=value)
+                num_values += 1
+        elif file_kind == "groupmembers":
+            num_values = self.import_group_memberships(
+                file_date, file_kind, file_path, parse_reports_this_kind, batch_size
+            )
+        else:
+            raise CommandError("Unknown kind %r" % file_kind)
+
+        # Here we have finished loaded all lines of one csv file.
+        # Time to update the records of the problems.
+
+        # Gather the parse reports of the af_id that have problems now, or had problems before.
+        # Users who were clean and still are have nothing to report, their reports were not kept.
+
+        reports_by_afid = {}
+        for parse_report in parse_reports_this_kind.reports:
+            reports_by_afid.setdefault(parse_report.af_id, []).append(parse_report)
+
+        # The content of good lines was not kept while parsing the file, so read again the
+        # lines of the users who may have had their problems resolved, all at once.
+        load_raw_lines(
+            file_path,
+            [report for af_id in open_af_ids.intersection(reports_by_afid) for report in reports_by_afid[af_id]],
+        )
+
+        # Fetch the X.org IDs of the users, to label them
+        affected_af_ids = [af_id for af_id in reports_by_afid if af_id is not None]
+        xorg_id_by_afid = {}
+        for offset in range(0, len(affected_af_ids), batch_size):
+            xorg_id_by_afid.update(
+                models.Account.objects.filter(af_id__in=affected_af_ids[offset : offset + batch_size]).values_list(
+                    "af_id", "xorg_id"
+                )
+            )
+
+        # Update records
+
+        new_parse_problems = []
+        resolved_af_ids = []
+        problem_changes_this_file = {}
+
+        # These are only users referred to by imported data, who have or had problems.
+        for af_id, reports in reports_by_afid.items():
+            if af_id in xorg_id_by_afid:
+                account_label_for_filename = xorg_id_by_afid[af_id]
+                account_label_for_content = repr(xorg_id_by_afid[af_id])
+            else:
+                account_label_for_filename = "unknown"
+                account_label_for_content = f"pas de compte pour af_id={af_id}"
+
+            user_was_affected = af_id in open_af_ids
+
+            user_reports_with_problem = [r for r in reports if r.problems]
+
+            user_is_affected = len(user_reports_with_problem) > 0
+
+            case_number = (user_was_affected << 1) | user_is_affected
+
+            # will allow to summarize affected users and changes
+            problem_changes_this_file.setdefault(case_number, []).append(account_label_for_content)
+            problem_changes_all_files.setdefault(case_number, []).append(account_label_for_content)
+
+            if user_is_affected:
+                parse_problems = [
+                    build_parse_problem(
+                        report, file_kind, file_date, models.ParseProblem.STATE_OPEN, account_label_for_content
+                    )
+                    for report in user_reports_with_problem
+                ]
+            elif user_was_affected:
+                # When an issue arises, we know which line(s) is/are bad.
+                # When the issue is solved, by definition we only have good lines (at least 1,
+                # on kind "user", there is only one line, but on "jobs" there are typically several).
+                # All those lines are recorded as the fix of the problem.
+                parse_problems = [
+                    build_parse_problem(
+                        report, file_kind, file_date, models.ParseProblem.STATE_FIX, account_label_for_content
+                    )
+                    for report in reports
+                ]
+                resolved_af_ids.append(af_id)
+                resolved_to_be_also_in_report.append((account_label_for_filename, parse_problems))
+            new_parse_problems += parse_problems
+
+            if settings.PARSE_PROBLEMS_FILES_MIRROR:
+                write_parse_problems_files(
+                    file_kind,
+                    af_id,
+                    case_number,
+                    account_label_for_filename,
+                    account_label_for_content,
+                    parse_problems,
+                )
+
+        resolve_parse_problems(file_kind, resolved_af_ids, batch_size)
+        models.ParseProblem.objects.bulk_create(new_parse_problems, batch_size=batch_size)
+
+        # Here finished importing and processing one file, now reporting
+
+        facts_for_django_logs = []
+
+        for case_number in range(4):
+            users_in_this_case = problem_changes_this_file.get(case_number)
+            # print (f"For case {case_number} users: {users_in_this_case}")
+            if users_in_this_case:
+                case = ["ras", "nouveau souci", "souci résolu", "souci répété"][case_number]
+                if case_number == 0:
+                    pass
+                    # report_by_file_then_user.append(f"  {case} pour {len(users_in_this_case)} utilisateur(s):")
+                else:
+                    for user in users_in_this_case:
+                        facts_for_django_logs.append(f"{case} pour {user}")
+                        report_by_file_then_user.append(f"{os.path.basename(file_path)} : {case} pour {user}")
+
+        self.log_success(
+            file_date, file_kind, num_values, os.path.basename(file_path), facts_for_django_logs, num_changed
+        )
+        # Here finished importing, processing and reporting one file
+
     def handle(self, *args, **options):
         self.verbosity = options["verbosity"]
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("Invalid batch size %d" % batch_size)
 
         timestamp_start = datetime.datetime.now(datetime.UTC)
 
         kinds_involved_in_imported_files = set()
-        parse_reports_by_kind = {}
 
         report_by_file_then_user = []
         problem_changes_all_files = {}
         resolved_to_be_also_in_report = []
 
+        # Find out the kind and date of every file before importing anything
+        import_files = []
         for file_path in options["csvfile"]:
             file_date = get_export_date_from_filename(file_path)
             if not file_date:
@@ -388,255 +996,55 @@ class Command(BaseCommand):
                 file_kind = options["kind"]
             elif options["kind"] and file_kind != options["kind"]:
                 raise CommandError("Incompatible kind for file %r: %r != %r" % (file_path, file_kind, options["kind"]))
-
-            kinds_involved_in_imported_files.add(file_kind)
-            parse_reports_this_kind = []
-            parse_reports_by_kind[file_kind] = parse_reports_this_kind
-
-            if file_kind == "users":
-                num_values = 0
-                for parse_report, value in load_csv(file_kind, file_path, ALUMNFORCE_USER_FIELDS):
-                    parse_reports_this_kind.append(parse_report)
-                    if not value:
-                        continue
-                    value["last_update"] = file_date
-                    value["deleted_since"] = None
-                    for key in ("nationality", "nationality_2", "nationality_3"):
-                        # Make an unfilled field blank
-                        if value[key] == "Non renseigné":
-                            value[key] = ""
-                    if value["school_id"] == "0":
-                        value["school_id"] = ""
-                    if value["xorg_id"] == "":
-                        value["xorg_id"] = None
-                    if value["profile_picture_url"].startswith("/"):
-                        value["profile_picture_url"] = "https://ax.polytechnique.org" + value["profile_picture_url"]
-                    models.Account.objects.update_or_create(af_id=value["af_id"], defaults=value)
-                    num_values += 1
-            elif file_kind == "userdegrees":
-                num_values = 0
-                seen_accounts = {}
-                for parse_report, value in load_csv(file_kind, file_path, ALUMNFORCE_USERDEGREE_FIELDS):
-                    parse_reports_this_kind.append(parse_report)
-                    if not value:
-                        continue
-                    account = seen_accounts.get(value["af_id"])
-                    if account is None:
-                        try:
-                            account = models.Account.objects.get(af_id=value["af_id"])
-                        except models.Account.DoesNotExist:
-                            self.log_warning(
-                                file_date,
-                                file_kind,
-                                "Unable to find user with AF ID {} (AX ID {})".format(
-                                    value["af_id"], repr(value["ax_id"])
-                                ),
-                            )
-                            continue
-                        seen_accounts[value["af_id"]] = account
-                        # Remove previous degrees when an account is seen for the first time
-                        account.degrees.all().delete()
-                    # Insert a degree
-                    del value["af_id"]
-                    del value["ax_id"]
-                    value["last_update"] = file_date
-                    account.degrees.create(**value)
-                    num_values += 1
-            elif file_kind == "userjobs":
-                num_values = 0
-                seen_accounts = {}
-                for parse_report, value in load_csv(file_kind, file_path, ALUMNFORCE_USERJOB_FIELDS):
-                    parse_reports_this_kind.append(parse_report)
-                    if not value:
-                        continue
-                    account = seen_accounts.get(value["af_id"])
-                    if account is None:
-                        try:
-                            account = models.Account.objects.get(af_id=value["af_id"])
-                        except models.Account.DoesNotExist:
-                            self.log_warning(
-                                file_date,
-                                file_kind,
-                                "Unable to find user with AF ID {} (AX ID {})".format(
-                                    value["af_id"], repr(value["ax_id"])
-                                ),
-                            )
-                            continue
-                        seen_accounts[value["af_id"]] = account
-                        # Remove previous jobs when an account is seen for the first time
-                        account.jobs.all().delete()
-                    # Insert a job
-                    del value["af_id"]
-                    del value["ax_id"]
-                    value["last_update"] = file_date
-                    account.jobs.create(**value)
-                    num_values += 1
-            elif file_kind == "groups":
-                num_values = 0
-                for parse_report, value in load_csv(file_kind, file_path, ALUMNFORCE_GROUP_FIELDS):
-                    parse_reports_this_kind.append(parse_report)
-                    if not value:
-                        continue
-                    value["last_update"] = file_date
-                    models.Group.objects.update_or_create(af_id=value["af_id"], defaults=value)
-                    num_values += 1
-            elif file_kind == "groupmembers":
-                num_values = 0
-                for parse_report, value in load_csv(file_kind, file_path, ALUMNFORCE_GROUPMEMBER_FIELDS):
-                    parse_reports_this_kind.append(parse_report)
-                    if not value:
-                        continue
-
-                    try:
-                        account = models.Account.objects.get(af_id=value["user_id"])
-                    except models.Account.DoesNotExist:
-                        self.log_warning(
-                            file_date,
-                            file_kind,
-                            "Unable to find user with AF ID {} (AX ID {})".format(
-                                value["user_id"], repr(value["user_ax_id"])
-                            ),
-                        )
-                        continue
-                    try:
-                        group = models.Group.objects.get(af_id=value["group_id"])
-                    except models.Group.DoesNotExist:
-                        self.log_warning(
-                            file_date, file_kind, "Unable to find group with AF ID {}".format(value["group_id"])
-                        )
-                        continue
-                    try:
-                        role = ALUMNFORCE_GROUPMEMBER_ROLES[value["role"]]
-                    except KeyError:
-                        self.log_warning(
-                            file_date, file_kind, "Unable to find group role {}".format(repr(value["role"]))
-                        )
-                        continue
-                    models.GroupMembership.objects.update_or_create(
-                        account=account,
-                        group=group,
-                        defaults={"role": role, "last_update": file_date},
-                    )
-                    num_values += 1
-            else:
-                raise CommandError("Unknown kind %r" % file_kind)
-
-            # Here we have finished loaded all lines of one csv file.
-            # Time to update the filesystem-based report.
-
-            # Extract af_id that have problems and gather the matching parse reports
-
-            reports_by_afid = {}
-            for parse_report in parse_reports_this_kind:
-                reports_by_afid.setdefault(parse_report["af_id"], []).append(parse_report)
-
-            # Update records
-
-            problem_changes_this_file = {}
-
-            # These are not all users, only users referred to by imported data.
-            for af_id, reports in reports_by_afid.items():
-                try:
-                    account = models.Account.objects.get(af_id=af_id)
-                    account_label_for_filename = account.xorg_id
-                    account_label_for_content = repr(account.xorg_id)
-                except models.Account.DoesNotExist:
-                    account_label_for_filename = "unknown"
-                    account_label_for_content = f"pas de compte pour af_id={af_id}"
-
-                current_problem_file_path = compute_current_problem_file_path(file_kind, af_id)
-                user_was_affected = os.path.exists(current_problem_file_path)
-
-                user_reports_with_problem = [r for r in reports if r["problems"]]
-
-                user_is_affected = len(user_reports_with_problem) > 0
-                # any(report["problems"] for report in reports)
-
-                case_number = (user_was_affected << 1) | user_is_affected
-
-                # will allow to summarize affected users and changes
-                problem_changes_this_file.setdefault(case_number, []).append(account_label_for_content)
-                problem_changes_all_files.setdefault(case_number, []).append(account_label_for_content)
-
-                if user_is_affected:
-                    print(
-                        f"Recording current problem on user {account_label_for_content} with kind {file_kind}: "
-                        f"{current_problem_file_path}"
+            import_files.append((file_path, file_date, file_kind))
+
+        # Import the files in the order of the kinds, so that users are created before their
+        # details, then in the order of the dates
+        import_files.sort(key=lambda file_info: (KNOWN_EXPORT_KINDS_ORDER.index(file_info[2]), file_info[1]))
+
+        imported_files = []
+        import_failure = None
+        for file_path, file_date, file_kind in import_files:
+            # Each file is imported in its own transaction, so that a failure keeps the previous files.
+            # What the file adds to the report is only kept once it is committed.
+            file_report_by_user = []
+            file_problem_changes = {}
+            file_resolved_cases = []
+            try:
+                with transaction.atomic():
+                    self.import_file(
+                        file_path,
+                        file_date,
+                        file_kind,
+                        batch_size,
+                        file_report_by_user,
+                        file_problem_changes,
+                        file_resolved_cases,
                     )
-                    with open(current_problem_file_path, "a") as rej_file:
-                        rej_file.write(
-                            f"### Soucis de type {file_kind} concernant le compte {account_label_for_content}\n\n"
-                        )
-                        for report in user_reports_with_problem:
-                            rej_file.write(
-                                "------------------------------------------------------------------------\n"
-                                + "\n".join("{:<10}: {}".format(k, v) for k, v in report.items())
-                                + "------------------------------------------------------------------------\n"
-                            )
-                else:
-                    if user_was_affected:
-                        print(f"Deleting rejection file: {current_problem_file_path}")
-                        try:
-                            os.remove(current_problem_file_path)
-                        except OSError:
-                            pass
-
-                problem_archive_file_marker = [None, "problem_new", "resolved", "problem_still"][case_number]
-
-                if problem_archive_file_marker:
-                    lines_to_log = user_reports_with_problem
-                    if problem_archive_file_marker == "resolved":
-                        # When an issue arises, we know which line(s) is/are bad.
-                        # When the issue is solved, by definition we only have good lines (at least 1,
-                        # on kind "user", there is only one line, but on "jobs" there are typically several).
-                        # For archival we need all those lines. Each will land in a separate file, by line hash.
-                        lines_to_log = reports
-                    for report in lines_to_log:
-                        problem_archive_file_path = compute_problem_archive_file_path(
-                            file_kind,
-                            af_id,
-                            file_path,
-                            problem_archive_file_marker,
-                            account_label_for_filename,
-                            report["line_hash"],
-                        )
-                        print(f"Recording to problem archive: {problem_archive_file_path}")
-                        if problem_archive_file_marker == "resolved":
-                            resolved_to_be_also_in_report.append(
-                                (account_label_for_filename, problem_archive_file_path)
-                            )
-                        with open(problem_archive_file_path, "w") as rej_file:
-                            rej_file.write(
-                                "\n------------------------------------------------------------------------\n"
-                                + "\n".join("{:<10}: {}".format(k, v) for k, v in report.items())
-                                + "\n------------------------------------------------------------------------\n"
-                            )
-
-            # Here finished importing and processing one file, now reporting
-
-            facts_for_django_logs = []
-
-            for case_number in range(4):
-                users_in_this_case = problem_changes_this_file.get(case_number)
-                # print (f"For case {case_number} users: {users_in_this_case}")
-                if users_in_this_case:
-                    case = ["ras", "nouveau souci", "souci résolu", "souci répété"][case_number]
-                    if case_number == 0:
-                        pass
-                        # report_by_file_then_user.append(f"  {case} pour {len(users_in_this_case)} utilisateur(s):")
-                    else:
-                        for user in users_in_this_case:
-                            facts_for_django_logs.append(f"{case} pour {user}")
-                            report_by_file_then_user.append(f"{os.path.basename(file_path)} : {case} pour {user}")
-
-            self.log_success(file_date, file_kind, num_values, os.path.basename(file_path), facts_for_django_logs)
-            # Here finished importing, processing and reporting one file
+            except Exception as exc:
+                # The next files may depend on this one, so stop importing, but still report
+                # the files which were committed
+                import_failure = "Unable to import {} {}: {}".format(file_kind, repr(file_path), exc)
+                if self.verbosity:
+                    self.stderr.write(import_failure)
+                models.ImportLog.objects.create(
+                    date=file_date,
+                    export_kind=file_kind,
+                    is_incremental=True,
+                    error=models.ImportLog.XORG_ERROR,
+                    message=import_failure,
+                )
+                break
+            imported_files.append(file_path)
+            kinds_involved_in_imported_files.add(file_kind)
+            report_by_file_then_user += file_report_by_user
+            for case_number, users in file_problem_changes.items():
+                problem_changes_all_files.setdefault(case_number, []).extend(users)
+            resolved_to_be_also_in_report += file_resolved_cases
 
         # Here finished importing and processing all files.
         # We can now prepare a global report.
 
-        # TODO we should catch any exception here (else some case will cause no report again).
-
         import_report_lines = []
 
         import_report_lines += [
@@ -650,7 +1058,12 @@ class Command(BaseCommand):
         ]
 
         # import_report_lines += [f"Nombre de fichiers à importer : {len(options['csvfile'])}, liste ci-dessous:", ""]
-        import_report_lines += ["Importé " + os.path.basename(n) for n in options["csvfile"]]
+        import_report_lines += ["Importé " + os.path.basename(file_path) for file_path in imported_files]
+        if import_failure:
+            import_report_lines.append(f"Échec : {import_failure}")
+            import_report_lines += [
+                "Non importé " + os.path.basename(file_info[0]) for file_info in import_files[len(imported_files) :]
+            ]
         # import_report_lines += [f"Nombre de fichiers à importer : {len(options['csvfile'])}."]
 
         import_report_lines += report_by_file_then_user
@@ -667,32 +1080,27 @@ class Command(BaseCommand):
             "",
         ]
 
-        from pathlib import Path
-
-        rejects_directory = Path(settings.PERSISTENT_DIRECTORY) / "current_problems_by_id"
-
         active_rejections = []
-        for subdir_name in kinds_involved_in_imported_files:
-            subdir = rejects_directory / subdir_name
-            if not subdir.is_dir():
-                continue
-            for file in subdir.iterdir():
-                if file.is_file():
-                    active_rejections.append((subdir.name, file.name, file))
+        open_problems = models.ParseProblem.objects.filter(
+            kind__in=kinds_involved_in_imported_files, state=models.ParseProblem.STATE_OPEN
+        ).order_by("kind", "af_id", "pk")
+        for (kind, af_id), problems in itertools.groupby(open_problems, lambda problem: (problem.kind, problem.af_id)):
+            active_rejections.append((kind, af_id, list(problems)))
 
         if not active_rejections:
             import_report_lines.append("**** Aucun incident en cours ! ****")
         else:
             import_report_lines += [
-                f"* souci sur les données {kind} pour l'af_id {name.split('.')[0]}"
-                for (kind, name, fullpath) in active_rejections
+                f"* souci sur les données {kind} pour l'af_id {af_id}" for (kind, af_id, problems) in active_rejections
             ]
 
             import_report_lines.append("\n## Détails des utilisateurs affectés")
 
-            for kind, name, rejfile in active_rejections:
-                with rejfile.open() as f:
-                    import_report_lines.append("\n" + "".join(f.readlines()))
+            for kind, af_id, problems in active_rejections:
+                import_report_lines.append(
+                    f"\n### Soucis de type {kind} concernant le compte {problems[-1].account_label}\n\n"
+                    + "".join(format_parse_problem(problem) for problem in problems)
+                )
 
         if resolved_to_be_also_in_report:
             import_report_lines += [
@@ -705,11 +1113,9 @@ class Command(BaseCommand):
                 "",
             ]
 
-            for account_label_for_filename, resolved_file_path in resolved_to_be_also_in_report:
+            for account_label_for_filename, fixes in resolved_to_be_also_in_report:
                 import_report_lines.append(f"Camarade {account_label_for_filename}")
-                import_report_lines.append(f"Fichier {resolved_file_path}")
-                with open(resolved_file_path, "r", encoding="utf-8") as f:
-                    import_report_lines.append("".join(f.readlines()))
+                import_report_lines.append("".join(format_parse_problem(fix) for fix in fixes))
 
         # All report info is gathered. Assemble that into an e-mail body.
 
@@ -731,7 +1137,10 @@ class Command(BaseCommand):
             f"Souci(s) d'importation : {set_of_affected_user_changes_text}, bilan {len(active_rejections)}"
         )
 
-        worth_an_email = bool(set_of_affected_user_changes) or bool(active_rejections)
+        if import_failure:
+            one_line_subject = "Échec d'importation, " + one_line_subject
+
+        worth_an_email = bool(set_of_affected_user_changes) or bool(active_rejections) or bool(import_failure)
 
         report_as_text = "\n".join(
             [
@@ -767,3 +1176,6 @@ class Command(BaseCommand):
             send_mail(
                 settings.EMAIL_SUBJECT_PREFIX + one_line_subject, overall_report_text, None, settings.REPORT_RECIPIENTS
             )
+
+        if import_failure:
+            raise CommandError(import_failure)
@@ -0,0 +1,101 @@
+import ast
+import datetime
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from xorgdata.alumnforce import models
+from xorgdata.alumnforce.management.commands.importcsv import get_export_date_from_filename
+
+# Title of the problems of an account, in a .rej file
+REJ_TITLE_RE = re.compile(r"^### Soucis de type \S+ concernant le compte (.*)\n", re.MULTILINE)
+
+# Problem of a line, in a .rej file. The raw line usually ends with its newline character
+REJ_PROBLEM_RE = re.compile(
+    r"^problems  : (?P<problems>.*?)\n"
+    r"af_id     : [^\n]*\n"
+    r"path      : (?P<path>[^\n]*)\n"
+    r"header    : (?P<header>[^\n]*)\n"
+    r"line_num  : (?P<line_num>[0-9]+)\n"
+    r"line_hash : (?P<line_hash>[0-9a-f]*)\n"
+    r"line      : (?P<line>.*?)\n"
+    r"line_tabs : ",
+    re.MULTILINE | re.DOTALL,
+)
+
+
+def parse_rej_file(kind, rej_path):
+    """Parse a file of current_problems_by_id into open ParseProblem records
+
+    The files contain a title for each import which found problems for the account,
+    followed by the lines with problems.
+    """
+    try:
+        af_id = int(rej_path.stem)
+    except ValueError:
+        # Lines whose AF ID could not be read
+        af_id = None
+    mtime_date = datetime.date.fromtimestamp(rej_path.stat().st_mtime)
+    parse_problems = []
+    sections = REJ_TITLE_RE.split(rej_path.read_text(encoding="utf-8"))
+    for account_label, section in zip(sections[1::2], sections[2::2]):
+        for match in REJ_PROBLEM_RE.finditer(section):
+            header = match.group("header")
+            if header.startswith("["):
+                # Previous versions of importcsv wrote the list of the columns
+                header = "\t".join(ast.literal_eval(header))
+            parse_problems.append(
+                models.ParseProblem(
+                    kind=kind,
+                    af_id=af_id,
+                    state=models.ParseProblem.STATE_OPEN,
+                    date=get_export_date_from_filename(match.group("path")) or mtime_date,
+                    account_label=account_label,
+                    file_name=match.group("path"),
+                    header=header,
+                    line_num=int(match.group("line_num")),
+                    line_hash=match.group("line_hash"),
+                    line=match.group("line"),
+                    problems=match.group("problems"),
+                )
+            )
+    return parse_problems
+
+
+class Command(BaseCommand):
+    help = "Record the problems of the current_problems_by_id files, written by previous versions of importcsv"
+
+    def handle(self, *args, **options):
+        rejects_directory = Path(settings.PERSISTENT_DIRECTORY) / "current_problems_by_id"
+        num_accounts = 0
+        num_problems = 0
+        with transaction.atomic():
+            for kind, _kind_name in models.ImportLog.KNOWN_EXPORT_KINDS:
+                kind_directory = rejects_directory / kind
+                if not kind_directory.is_dir():
+                    continue
+                # Do not record twice the problems of an account
+                open_af_ids = set(
+                    models.ParseProblem.objects.filter(kind=kind, state=models.ParseProblem.STATE_OPEN)
+                    .values_list("af_id", flat=True)
+                    .distinct()
+                )
+                new_parse_problems = []
+                for rej_path in sorted(kind_directory.glob("*.rej")):
+                    parse_problems = parse_rej_file(kind, rej_path)
+                    if not parse_problems:
+                        self.stderr.write("No problem found in {}".format(rej_path))
+                        continue
+                    if parse_problems[0].af_id in open_af_ids:
+                        continue
+                    new_parse_problems += parse_problems
+                    num_accounts += 1
+                models.ParseProblem.objects.bulk_create(new_parse_problems)
+                num_problems += len(new_parse_problems)
+        if options["verbosity"]:
+            self.stdout.write(
+                self.style.SUCCESS("Recorded {} problems of {} accounts".format(num_problems, num_accounts))
+            )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from xorgdata.alumnforce import models
+from xorgdata.alumnforce.issues import rebuild_account_issues, refresh_account_issues
+
+
+class Command(BaseCommand):
+    help = "Compute again the data-quality issues of accounts, which are shown in the issues page"
+
+    def add_arguments(self, parser):
+        parser.add_argument("af_id", type=int, nargs="*", help="AF ID of an account to refresh (by default: all)")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options["af_id"]:
+                refresh_account_issues(options["af_id"])
+            else:
+                rebuild_account_issues()
+        if options["verbosity"]:
+            self.stdout.write(self.style.SUCCESS("Found {} issues".format(models.AccountIssue.objects.count())))
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alumnforce', '0015_alter_academicinformation_diplomed_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='import_digest',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
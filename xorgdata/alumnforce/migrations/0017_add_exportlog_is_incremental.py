@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alumnforce', '0016_add_account_import_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportlog',
+            name='is_incremental',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:15
+
+import django.db.models.deletion
+import xorgdata.utils.fields
+from django.db import migrations, models
+
+
+def fill_account_issues(apps, schema_editor):
+    """Find the issues of the existing accounts, so that the issues page is correct after migrating"""
+    from xorgdata.alumnforce.issues import rebuild_account_issues
+
+    rebuild_account_issues(apps.get_model("alumnforce", "Account"), apps.get_model("alumnforce", "AccountIssue"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alumnforce', '0017_add_exportlog_is_incremental'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountIssue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.SlugField(choices=[('civility', 'unknown civility'), ('user-kind', 'unknown account kind'), ('roles', 'invalid additional roles'), ('xorg-id', 'invalid X.org ID'), ('missing-xorg-id', 'missing X.org ID'), ('email', 'invalid email address'), ('duplicated-ax-id', 'duplicated AX ID'), ('duplicated-xorg-id', 'duplicated X.org ID'), ('duplicated-school-id', 'duplicated school ID')])),
+                ('message', xorgdata.utils.fields.UnboundedCharField()),
+                ('duplicated_value', xorgdata.utils.fields.UnboundedCharField(blank=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='issues', to='alumnforce.account')),
+            ],
+        ),
+        migrations.RunPython(fill_account_issues, migrations.RunPython.noop),
+    ]
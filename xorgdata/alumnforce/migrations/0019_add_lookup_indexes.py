@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alumnforce', '0018_add_accountissue_table'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(condition=models.Q(('deleted_since', None)), fields=['xorg_id'], name='account_active_xorg_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(condition=models.Q(('deleted_since', None)), fields=['ax_id'], name='account_active_ax_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(condition=models.Q(('deleted_since', None)), fields=['school_id'], name='account_active_school_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(fields=['last_update'], name='account_last_update_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(condition=models.Q(('deleted_since__isnull', False)), fields=['deleted_since'], name='account_deleted_since_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exportlog',
+            index=models.Index(fields=['export_kind', '-date'], name='exportlog_kind_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='importlog',
+            index=models.Index(fields=['export_kind', '-date', '-is_incremental'], name='importlog_kind_date_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alumnforce', '0019_add_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='exportlog',
+            options={'get_latest_by': ['date', 'pk']},
+        ),
+        migrations.AlterModelOptions(
+            name='importlog',
+            options={'get_latest_by': ['date', 'is_incremental', 'pk']},
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:25
+
+import unicodedata
+
+import xorgdata.utils.fields
+from django.db import migrations
+
+SEARCHED_FIELDS = ('ax_id', 'xorg_id', 'first_name', 'last_name', 'common_name')
+
+
+def fill_search_name(apps, schema_editor):
+    Account = apps.get_model('alumnforce', 'Account')
+    accounts = []
+    for account in Account.objects.only(*SEARCHED_FIELDS).iterator(chunk_size=1000):
+        text = ' '.join(getattr(account, field) for field in SEARCHED_FIELDS if getattr(account, field))
+        text = unicodedata.normalize('NFKD', text)
+        account.search_name = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+        accounts.append(account)
+        if len(accounts) >= 1000:
+            Account.objects.bulk_update(accounts, ['search_name'])
+            accounts = []
+    Account.objects.bulk_update(accounts, ['search_name'])
+
+
+def create_trigram_index(apps, schema_editor):
+    # Trigram indexes make LIKE '%...%' fast, but only exist on PostgreSQL
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX account_search_name_trgm_idx ON alumnforce_account USING gin (search_name gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS account_search_name_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alumnforce', '0020_set_logs_get_latest_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='search_name',
+            field=xorgdata.utils.fields.UnboundedCharField(blank=True, editable=False),
+        ),
+        migrations.RunPython(fill_search_name, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:27
+
+import xorgdata.utils.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alumnforce', '0021_add_account_search_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParseProblem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.SlugField(choices=[('users', 'users'), ('groups', 'groups'), ('groupmembers', 'groupmembers'), ('userdegrees', 'userdegrees'), ('userjobs', 'userjobs')])),
+                ('af_id', models.IntegerField(blank=True, null=True)),
+                ('state', models.SlugField(choices=[('open', 'open'), ('resolved', 'resolved'), ('fix', 'fix')])),
+                ('date', models.DateField()),
+                ('account_label', xorgdata.utils.fields.UnboundedCharField(blank=True)),
+                ('file_name', xorgdata.utils.fields.UnboundedCharField()),
+                ('header', xorgdata.utils.fields.UnboundedCharField(blank=True)),
+                ('line_num', models.IntegerField()),
+                ('line_hash', models.CharField(max_length=64)),
+                ('line', xorgdata.utils.fields.UnboundedCharField()),
+                ('problems', xorgdata.utils.fields.UnboundedCharField(blank=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'af_id', 'state'], name='parseproblem_kind_af_id_idx')],
+            },
+        ),
+    ]
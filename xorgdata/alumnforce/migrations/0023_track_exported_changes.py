@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:39
+
+import xorgdata.utils.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alumnforce', '0022_add_parseproblem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuplicatedXorgId',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('xorg_id', xorgdata.utils.fields.DottedSlugField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='account',
+            name='account_last_update_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='account',
+            name='account_deleted_since_idx',
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='imported_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportlog',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(fields=['imported_at'], name='account_imported_at_idx'),
+        ),
+    ]
@@ -1,10 +1,22 @@
+import unicodedata
+
+from django.core.cache import cache
 from django.core.validators import validate_comma_separated_integer_list
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q, Subquery
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 
 from xorgdata.utils.fields import DottedSlugField, UnboundedCharField
 
 
+def normalize_search_text(text):
+    """Lower-case a text and remove its accents, so that searches ignore them"""
+    decomposed_text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed_text if not unicodedata.combining(c)).lower()
+
+
 class Account(models.Model):
     # User kinds defined by the AX
     KIND_GRADUATED = 1
@@ -46,6 +58,8 @@ class Account(models.Model):
         ROLE_ACCOUNTING_ADMIN: "Administrateur comptable",
         ROLE_WIDOW: "Veuves/Veufs",
     }
+    # Fields which are copied into search_name
+    SEARCHED_FIELDS = ("ax_id", "xorg_id", "first_name", "last_name", "common_name")
 
     af_id = models.IntegerField(primary_key=True)
     ax_id = models.CharField(max_length=20, blank=True, null=True)
@@ -91,6 +105,24 @@ class Account(models.Model):
     profile_picture_url = UnboundedCharField(blank=True)
     last_update = models.DateField()
     deleted_since = models.DateField(blank=True, null=True)
+    # Digest of the values which were last imported from an incremental export, to skip unchanged lines
+    import_digest = models.CharField(max_length=64, blank=True)
+    # Normalized IDs and names, which the admin interface searches (with a trigram index on PostgreSQL)
+    search_name = UnboundedCharField(blank=True, editable=False)
+    # Time when an import last modified or deleted the account. Unlike last_update, which is the
+    # date of the imported file, it increases with every import, even of files published late.
+    imported_at = models.DateTimeField(blank=True, null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Look up active accounts by their IDs, for example to find duplicated IDs.
+            # These partial indexes are not created on databases which do not support them, like MySQL.
+            models.Index(fields=["xorg_id"], condition=Q(deleted_since=None), name="account_active_xorg_id_idx"),
+            models.Index(fields=["ax_id"], condition=Q(deleted_since=None), name="account_active_ax_id_idx"),
+            models.Index(fields=["school_id"], condition=Q(deleted_since=None), name="account_active_school_id_idx"),
+            # Find the accounts which changed since the previous export
+            models.Index(fields=["imported_at"], name="account_imported_at_idx"),
+        ]
 
     def __str__(self):
         """Get a string identifying an account"""
@@ -111,11 +143,28 @@ class Account(models.Model):
             result += " (AF ID {})".format(self.af_id)
         return result
 
+    def save(self, *args, **kwargs):
+        self.search_name = self.build_search_name({field: getattr(self, field) for field in self.SEARCHED_FIELDS})
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not set(self.SEARCHED_FIELDS).isdisjoint(update_fields):
+            kwargs["update_fields"] = {*update_fields, "search_name"}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def build_search_name(cls, values):
+        """Build the value of search_name from a dict of the values of the searched fields"""
+        return normalize_search_text(" ".join(values[field] for field in cls.SEARCHED_FIELDS if values[field]))
+
     def get_additional_roles(self):
         """Return the additional roles as a list of integers"""
-        if not self.additional_roles:
+        return self.parse_additional_roles(self.additional_roles)
+
+    @staticmethod
+    def parse_additional_roles(additional_roles):
+        """Parse a value of the additional_roles field into a list of integers"""
+        if not additional_roles:
             return []
-        return [int(r) for r in self.additional_roles.split(",")]
+        return [int(r) for r in additional_roles.split(",")]
 
     @property
     def alumnforce_profile_url(self):
@@ -161,6 +210,36 @@ class ProfessionnalInformation(models.Model):
     last_update = models.DateField()
 
 
+class AccountIssue(models.Model):
+    """Data-quality issue of an account, kept up to date when accounts are imported"""
+
+    KIND_CIVILITY = "civility"
+    KIND_USER_KIND = "user-kind"
+    KIND_ROLES = "roles"
+    KIND_XORG_ID = "xorg-id"
+    KIND_MISSING_XORG_ID = "missing-xorg-id"
+    KIND_EMAIL = "email"
+    KIND_DUPLICATED_AX_ID = "duplicated-ax-id"
+    KIND_DUPLICATED_XORG_ID = "duplicated-xorg-id"
+    KIND_DUPLICATED_SCHOOL_ID = "duplicated-school-id"
+    KINDS = (
+        (KIND_CIVILITY, _("unknown civility")),
+        (KIND_USER_KIND, _("unknown account kind")),
+        (KIND_ROLES, _("invalid additional roles")),
+        (KIND_XORG_ID, _("invalid X.org ID")),
+        (KIND_MISSING_XORG_ID, _("missing X.org ID")),
+        (KIND_EMAIL, _("invalid email address")),
+        (KIND_DUPLICATED_AX_ID, _("duplicated AX ID")),
+        (KIND_DUPLICATED_XORG_ID, _("duplicated X.org ID")),
+        (KIND_DUPLICATED_SCHOOL_ID, _("duplicated school ID")),
+    )
+    account = models.ForeignKey(Account, related_name="issues", on_delete=models.CASCADE)
+    kind = models.SlugField(choices=KINDS)
+    message = UnboundedCharField()
+    # For duplicated IDs, the value which is shared with other accounts
+    duplicated_value = UnboundedCharField(blank=True)
+
+
 class Group(models.Model):
     af_id = models.IntegerField(primary_key=True)
     ax_id = models.CharField(max_length=20, blank=True, null=True, unique=True)
@@ -222,6 +301,65 @@ class ImportLog(models.Model):
     num_modified = models.IntegerField(null=True, blank=True)
     message = UnboundedCharField(blank=True)
 
+    class Meta:
+        indexes = [
+            # Find the latest log of each kind
+            models.Index(fields=["export_kind", "-date", "-is_incremental"], name="importlog_kind_date_idx"),
+        ]
+        # On a given date, incremental imports are considered more recent than full ones
+        get_latest_by = ["date", "is_incremental", "pk"]
+
+
+class ParseProblem(models.Model):
+    """Line of an imported CSV file, for an account which had malformed lines
+
+    The malformed lines stay open until an import of the same kind only has valid
+    lines for the account. They are then resolved, and these valid lines are
+    recorded as the fix.
+    """
+
+    STATE_OPEN = "open"
+    STATE_RESOLVED = "resolved"
+    STATE_FIX = "fix"
+    STATES = (
+        (STATE_OPEN, _("open")),
+        (STATE_RESOLVED, _("resolved")),
+        (STATE_FIX, _("fix")),
+    )
+    kind = models.SlugField(choices=ImportLog.KNOWN_EXPORT_KINDS)
+    # AF ID of the account, unknown when it could not be read from the line
+    af_id = models.IntegerField(null=True, blank=True)
+    state = models.SlugField(choices=STATES)
+    date = models.DateField()
+    # Label of the account when the line was imported
+    account_label = UnboundedCharField(blank=True)
+    file_name = UnboundedCharField()
+    header = UnboundedCharField(blank=True)
+    line_num = models.IntegerField()
+    line_hash = models.CharField(max_length=64)
+    line = UnboundedCharField()
+    problems = UnboundedCharField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["kind", "af_id", "state"], name="parseproblem_kind_af_id_idx"),
+        ]
+
+    @property
+    def line_tabs(self):
+        return self.line.replace("\t", "<TAB>")
+
+    def items(self):
+        """Enumerate the content of the line, in order to display it"""
+        yield "problems", self.problems
+        yield "af_id", self.af_id
+        yield "path", self.file_name
+        yield "header", self.header
+        yield "line_num", self.line_num
+        yield "line_hash", self.line_hash
+        yield "line", self.line
+        yield "line_tabs", self.line_tabs
+
 
 class ExportLog(models.Model):
     KIND_AUTH = "auth"
@@ -230,6 +368,75 @@ class ExportLog(models.Model):
     ERROR_CODES = ((SUCCESS, _("success")),)
     date = models.DateField()
     export_kind = models.SlugField(choices=KNOWN_KINDS)
+    # Whether only the accounts which changed since the previous export were sent
+    is_incremental = models.BooleanField(default=False)
+    # Time when the export started reading the accounts, the next incremental export sends
+    # the accounts imported since then
+    started_at = models.DateTimeField(blank=True, null=True)
     error = models.IntegerField(choices=ERROR_CODES)
     num_items = models.IntegerField(null=True, blank=True)
     message = UnboundedCharField(blank=True)
+
+    class Meta:
+        indexes = [
+            # Find the latest log of each kind
+            models.Index(fields=["export_kind", "-date"], name="exportlog_kind_date_idx"),
+        ]
+        get_latest_by = ["date", "pk"]
+
+
+class DuplicatedXorgId(models.Model):
+    """X.org login shared by several accounts when the accounts were last exported to xorgauth
+
+    The accounts using such a login are not exported, or are exported as deleted,
+    so they are exported again when their login stops being shared.
+    """
+
+    xorg_id = DottedSlugField(max_length=255, unique=True)
+
+
+# Cache key of the latest logs of each kind, for a log model
+LATEST_LOGS_CACHE_KEY = "alumnforce:latest-logs:{}"
+
+# The cache is invalidated when logs are written, but with a per-process cache
+# other processes only see the change after this timeout, in seconds
+LATEST_LOGS_CACHE_TIMEOUT = 300
+
+
+def get_latest_logs_by_kind(log_model):
+    """Get the latest ImportLog or ExportLog of each kind, as a dict {kind: log}
+
+    The logs are fetched in a single query, and cached until a log of the same
+    model is written. Logs of unknown kinds are ignored, and so are the logs of
+    failed imports: these were rolled back, so their file still has to be imported.
+    """
+    cache_key = LATEST_LOGS_CACHE_KEY.format(log_model._meta.model_name)
+    latest_logs = cache.get(cache_key)
+    if latest_logs is None:
+        kind_logs = log_model.objects.all()
+        if log_model is ImportLog:
+            kind_logs = kind_logs.filter(error__in=(ImportLog.SUCCESS, ImportLog.ALUMNFORCE_ERROR))
+        # Select the latest log of each known kind with a subquery, which can use the index on kind and date
+        ordering = ["-" + field for field in log_model._meta.get_latest_by]
+        latest_log_filter = Q()
+        for kind, _kind_name in log_model._meta.get_field("export_kind").choices:
+            latest_pk = kind_logs.filter(export_kind=kind).order_by(*ordering).values("pk")[:1]
+            latest_log_filter |= Q(pk=Subquery(latest_pk))
+        logs_qs = log_model.objects.filter(latest_log_filter)
+        latest_logs = {log.export_kind: log for log in logs_qs}
+        cache.set(cache_key, latest_logs, LATEST_LOGS_CACHE_TIMEOUT)
+    return latest_logs
+
+
+@receiver(post_save, sender=ImportLog)
+@receiver(post_delete, sender=ImportLog)
+@receiver(post_save, sender=ExportLog)
+@receiver(post_delete, sender=ExportLog)
+def invalidate_latest_logs(sender, using, **kwargs):
+    """Forget the cached latest logs when a log is written
+
+    This is done when the transaction is committed, as other processes could otherwise
+    fill the cache again with the logs they see before the commit.
+    """
+    cache_key = LATEST_LOGS_CACHE_KEY.format(sender._meta.model_name)
+    transaction.on_commit(lambda: cache.delete(cache_key), using=using)
@@ -1,39 +1,67 @@
-import re
-
 from django.contrib.auth.mixins import UserPassesTestMixin
-from django.db.models import Count
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Prefetch
+from django.http import HttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.views.generic import TemplateView
 
 from xorgdata.alumnforce import models
 
+# Cache key of the rendered summary, for an ETag
+SUMMARY_CACHE_KEY = "alumnforce:summary:{}"
+
+# The key of the summary changes when logs are written, so this timeout, in
+# seconds, only keeps old summaries from filling the cache
+SUMMARY_CACHE_TIMEOUT = 24 * 3600
+
+
+def get_summary_etag(request):
+    """Compute the ETag of the summary from the IDs of the latest logs, which are usually cached
+
+    There is no Last-Modified header, as logs only record the date of their file, which may
+    be older than the previous log.
+    """
+    log_ids = []
+    for log_model in (models.ImportLog, models.ExportLog):
+        latest_logs = models.get_latest_logs_by_kind(log_model)
+        log_ids.append(",".join(str(latest_logs[kind].pk) for kind in sorted(latest_logs)))
+    return "summary-{}".format("-".join(log_ids))
+
 
 class SummaryView(TemplateView):
     template_name = "xorgdata/summary.html"
 
+    @method_decorator(condition(etag_func=get_summary_etag))
+    def get(self, request, *args, **kwargs):
+        cache_key = SUMMARY_CACHE_KEY.format(get_summary_etag(request))
+        content = cache.get(cache_key)
+        if content is None:
+            content = super().get(request, *args, **kwargs).render().content
+            cache.set(cache_key, content, SUMMARY_CACHE_TIMEOUT)
+        return HttpResponse(content)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         # Get the last import logs from the database, for each defined kind
-        last_logs = []
-        for kind, _kind_name in models.ImportLog.KNOWN_EXPORT_KINDS:
-            qs = models.ImportLog.objects.filter(export_kind=kind).order_by("-date", "-is_incremental")
-            try:
-                last_logs.append(qs[:1].get())
-            except models.ImportLog.DoesNotExist:
-                pass
-        context["last_imp_logs_by_kind"] = last_logs
+        latest_logs = models.get_latest_logs_by_kind(models.ImportLog)
+        context["last_imp_logs_by_kind"] = [
+            latest_logs[kind] for kind, _kind_name in models.ImportLog.KNOWN_EXPORT_KINDS if kind in latest_logs
+        ]
 
         # Get the last export logs from the database, for each defined kind
-        last_logs = []
-        for kind, _kind_name in models.ExportLog.KNOWN_KINDS:
-            qs = models.ExportLog.objects.filter(export_kind=kind).order_by("-date")
-            try:
-                last_logs.append(qs[:1].get())
-            except models.ExportLog.DoesNotExist:
-                pass
-        context["last_exp_logs_by_kind"] = last_logs
+        latest_logs = models.get_latest_logs_by_kind(models.ExportLog)
+        context["last_exp_logs_by_kind"] = [
+            latest_logs[kind] for kind, _kind_name in models.ExportLog.KNOWN_KINDS if kind in latest_logs
+        ]
         return context
 
 
+# Number of accounts shown on each page of the issues
+ISSUES_PAGE_SIZE = 100
+
+
 class IssuesView(UserPassesTestMixin, TemplateView):
     template_name = "xorgdata/issues.html"
 
@@ -41,100 +69,31 @@ class IssuesView(UserPassesTestMixin, TemplateView):
         """Restrict this view to the superuser"""
         return self.request.user.is_superuser
 
-    def find_issues(self, account):
-        """Find issues in an account"""
-        account_issues = []
-
-        if account.civility not in ("", "Mme", "M"):
-            account_issues.append("Unknown civility {}".format(repr(account.civility)))
-
-        if account.user_kind not in models.Account.KINDS:
-            account_issues.append("Unknown account kind {}".format(account.user_kind))
-
-        try:
-            account_roles = account.get_additional_roles()
-        except ValueError:
-            account_issues.append("Invalid additional roles value {}".format(repr(account.additional_roles)))
-        else:
-            for role in account_roles:
-                if role not in models.Account.ROLES:
-                    account_issues.append("Unknown account role {}".format(role))
-
-        if account.xorg_id:
-            # Verify the format of X.org ID
-            if re.search(r"[^a-z0-9.-]", account.xorg_id):
-                account_issues.append("Invalid X.org ID: {}".format(repr(account.xorg_id)))
-        else:
-            # Check whether the user should have a X.org ID
-            if account.user_kind == models.Account.KIND_GRADUATED:
-                account_issues.append("Missing X.org ID for graduated")
-            elif account.user_kind == models.Account.KIND_STUDENT:
-                account_issues.append("Missing X.org ID for student")
-
-        # Verify email addresses against a simple regular expression
-        email_regexp = re.compile(r"^[a-zA-Z0-9._+-]+@[a-zA-Z0-9.-]+$")
-        if account.email_1 and not email_regexp.match(account.email_1):
-            account_issues.append("Invalid email address 1 {}".format(repr(account.email_1)))
-        if account.email_2 and not email_regexp.match(account.email_2):
-            account_issues.append("Invalid email address 2 {}".format(repr(account.email_2)))
-        return account_issues
-
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-
-        # Find accounts with duplicate IDs
-        duplicated_ax_id = {
-            row["ax_id"]: row["count"]
-            for row in models.Account.objects.filter(deleted_since=None)
-            .exclude(ax_id=None)
-            .values("ax_id")
-            .annotate(count=Count("af_id"))
-            .filter(count__gt=1)
-        }
-        duplicated_xorg_id = {
-            row["xorg_id"]: row["count"]
-            for row in models.Account.objects.filter(deleted_since=None)
-            .exclude(xorg_id=None)
-            .values("xorg_id")
-            .annotate(count=Count("af_id"))
-            .filter(count__gt=1)
-        }
-        duplicated_school_id = {
-            row["school_id"]: row["count"]
-            for row in models.Account.objects.filter(deleted_since=None)
-            .exclude(school_id="")
-            .values("school_id")
-            .annotate(count=Count("af_id"))
-            .filter(count__gt=1)
-        }
-
-        issues = []
-        for account in models.Account.objects.filter(deleted_since=None):
-            account_issues = self.find_issues(account)
-            dup_count = duplicated_ax_id.get(account.ax_id)
-            if dup_count is not None:
-                account_issues.append(
-                    "Duplicated AX ID {}, shared with {} accounts".format(repr(account.ax_id), dup_count)
-                )
-
-            dup_count = duplicated_xorg_id.get(account.xorg_id)
-            if dup_count is not None:
-                account_issues.append(
-                    "Duplicated X.org ID {}, shared with {} accounts".format(repr(account.xorg_id), dup_count)
-                )
-
-            dup_count = duplicated_school_id.get(account.school_id)
-            if dup_count is not None:
-                account_issues.append(
-                    "Duplicated school ID {}, shared with {} accounts".format(repr(account.school_id), dup_count)
-                )
-
-            if account_issues:
-                issues.append(
-                    {
-                        "account": account,
-                        "issues": account_issues,
-                    }
-                )
-        context["issues"] = issues
+        issues_qs = models.AccountIssue.objects.order_by("pk")
+        issue_kind = self.request.GET.get("kind")
+        if issue_kind in dict(models.AccountIssue.KINDS):
+            issues_qs = issues_qs.filter(kind=issue_kind)
+        else:
+            issue_kind = None
+
+        accounts_qs = (
+            models.Account.objects.filter(af_id__in=issues_qs.values("account_id"))
+            .only("af_id", "ax_id", "xorg_id", "first_name", "last_name", "email_1")
+            .prefetch_related(Prefetch("issues", queryset=issues_qs))
+            .order_by("af_id")
+        )
+        paginator = Paginator(accounts_qs, ISSUES_PAGE_SIZE)
+        page = paginator.get_page(self.request.GET.get("page"))
+        context["issues"] = [
+            {
+                "account": account,
+                "issues": [issue.message for issue in account.issues.all()],
+            }
+            for account in page
+        ]
+        context["page_obj"] = page
+        context["issue_kind"] = issue_kind
+        context["issue_kinds"] = models.AccountIssue.KINDS
         return context
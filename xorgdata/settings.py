@@ -205,6 +205,35 @@ if USE_HTTPS:
 
 # All data that needs to be preserved between and beyond runs
 PERSISTENT_DIRECTORY = config.getstr("persistence.root_path", "/tmp")
+# Also write the problems found in imported files to files in PERSISTENT_DIRECTORY, as
+# current_problems_by_id/<kind>/<af_id>.rej and problem_archive/<kind>/*.txt
+PARSE_PROBLEMS_FILES_MIRROR = config.getbool("persistence.parse_problems_files_mirror", False)
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+_CACHE_BACKEND_MAP = {
+    "locmem": "django.core.cache.backends.locmem.LocMemCache",
+    "file": "django.core.cache.backends.filebased.FileBasedCache",
+    "dummy": "django.core.cache.backends.dummy.DummyCache",
+}
+_cache_backend = config.getstr("cache.backend", "locmem")
+if _cache_backend not in _CACHE_BACKEND_MAP:
+    raise ImproperlyConfigured(
+        "Cache backend %s is unknown; please choose from %s"
+        % (_cache_backend, ", ".join(sorted(_CACHE_BACKEND_MAP.keys())))
+    )
+if _cache_backend == "file":
+    _default_cache_location = os.path.join(PERSISTENT_DIRECTORY, "xorgdata-cache")
+else:
+    _default_cache_location = ""
+
+CACHES = {
+    "default": {
+        "BACKEND": _CACHE_BACKEND_MAP[_cache_backend],
+        "LOCATION": config.getstr("cache.location", _default_cache_location),
+    },
+}
 
 # AlumnForce FTPS settings
 ALUMNFORCE_FTP_HOST = config.getstr("alumnforce_ftp.host", "ftpsecure.alumnforce.org")
@@ -214,7 +243,16 @@ ALUMNFORCE_FTP_REMOTE_DIRECTORY = config.getstr("alumnforce_ftp.remote_directory
 ALUMNFORCE_FTP_LOCAL_DIRECTORY = config.getstr(
     "alumnforce_ftp.local_directory", os.path.join(PERSISTENT_DIRECTORY, "xorgdata-download")
 )
+# Number of FTPS connections used to download files in parallel
+ALUMNFORCE_FTP_DOWNLOAD_WORKERS = config.getint("alumnforce_ftp.download_workers", 3)
 
 # Settings for the xorgauth API which receives data
 XORGAUTH_HOST = config.getstr("xorgauth.host", "auth.polytechnique.org")
 XORGAUTH_PASSWORD = config.getstr("xorgauth.password")
+XORGAUTH_USE_HTTPS = config.getbool("xorgauth.use_https", True)
+XORGAUTH_PUSH_WORKERS = config.getint("xorgauth.push_workers", 2)
+# Number of days after which all the accounts are pushed again, instead of only the changed ones
+XORGAUTH_FULL_PUSH_INTERVAL = config.getint("xorgauth.full_push_interval_days", 7)
+# Payload format ("objects" or "arrays") and compression ("", "gzip" or "zstd") of the pushed data
+XORGAUTH_PUSH_FORMAT = config.getstr("xorgauth.push_format", "objects")
+XORGAUTH_PUSH_COMPRESSION = config.getstr("xorgauth.push_compression", "")